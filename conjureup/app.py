@@ -12,19 +12,24 @@ import signal
 import subprocess
 import sys
 import textwrap
+import time
 import uuid
+from functools import partial
 
-import raven
-import yaml
 from charmhelpers.core import unitdata
-from prettytable import PrettyTable
-from raven.transport.requests import RequestsHTTPTransport
 from termcolor import colored
-from ubuntui.ev import EventLoop
-from ubuntui.palette import STYLES
 
 from conjureup import __version__ as VERSION
-from conjureup import charm, consts, controllers, events, juju, utils
+from conjureup import (
+    charm,
+    consts,
+    controllers,
+    events,
+    juju,
+    spells_index,
+    trace,
+    utils
+)
 from conjureup.app_config import app
 from conjureup.download import (
     EndpointType,
@@ -32,14 +37,14 @@ from conjureup.download import (
     download,
     download_local,
     download_or_sync_registry,
-    get_remote_url
+    get_remote_url,
+    registry_sync_due
 )
 from conjureup.log import setup_logging
 from conjureup.models.addon import AddonModel
-from conjureup.models.provider import SchemaErrorUnknownCloud, load_schema
 from conjureup.models.step import StepModel
+from conjureup.scheduler import Scheduler
 from conjureup.telemetry import SENTRY_DSN, track_event, track_screen
-from conjureup.ui import ConjureUI
 
 
 def parse_options(argv):
@@ -53,6 +58,10 @@ def parse_options(argv):
     parser.add_argument('-d', '--debug', action='store_true',
                         dest='debug', default=False,
                         help='Enable debug logging.')
+    parser.add_argument('--trace', dest='trace', metavar='FILE',
+                        help='Write a timeline of the deployment to FILE '
+                        'in Chrome trace format, for chrome://tracing or '
+                        'https://ui.perfetto.dev')
     parser.add_argument('--show-env', action='store_true',
                         dest='show_env',
                         help='Shows what environment variables are used '
@@ -104,6 +113,27 @@ def parse_options(argv):
                         dest='nosync',
                         help='Opt out of syncing with spells '
                         'registry.')
+    parser.add_argument('--registry-sync-interval', type=int,
+                        dest='registry_sync_interval', default=30 * 60,
+                        metavar='<seconds>',
+                        help='Skip syncing with the spells registry if it '
+                        'was synced less than this long ago.')
+    parser.add_argument('--registry-sync-timeout', type=int,
+                        dest='registry_sync_timeout', default=60,
+                        metavar='<seconds>',
+                        help='Give up syncing with the spells registry '
+                        'after this long.')
+    parser.add_argument('--machine-batch-size', type=int,
+                        dest='machine_batch_size', default=50,
+                        metavar='<count>',
+                        help='Maximum number of machines to request from '
+                        'Juju in a single API call.')
+    parser.add_argument('--deploy-concurrency', type=int,
+                        dest='deploy_concurrency', default=10,
+                        metavar='<count>',
+                        help='Maximum number of deploy steps (machines, '
+                        'applications, relations) to run at once. '
+                        '0 for no limit.')
 
     # Channels
     parser.add_argument('--channel', type=str,
@@ -143,6 +173,218 @@ async def _start(*args, **kwargs):
         controllers.use('addons').render()
 
 
+def load_spells_index():
+    """ Loads the spells index from the spells registry
+    """
+    app.spells_index = spells_index.load(app.config['spells-dir'])
+
+
+async def _sync_registry(branch):
+    """ Syncs the spells registry in the background, reloading the spell
+    picker once the new spells are available
+    """
+    try:
+        await app.loop.run_in_executor(None, partial(
+            download_or_sync_registry,
+            app.argv.registry,
+            app.config['spells-dir'],
+            branch=branch,
+            timeout=app.argv.registry_sync_timeout))
+    except (subprocess.SubprocessError, OSError) as e:
+        app.log.debug('Could not sync spells from github: {}'.format(e))
+        return
+    load_spells_index()
+    if events.Error.is_set() or events.Shutdown.is_set():
+        return
+    controllers.use('spellpicker').reload()
+
+
+class PreflightError(Exception):
+    """ A start up check failed and conjure-up can't continue
+    """
+
+
+def check_juju_data(juju_dir):
+    """ Checks that the Juju client data can be read
+
+    Arguments:
+    juju_dir: Juju data directory
+
+    Returns:
+    list of paths that can't be read, empty if there are none or the
+    directory doesn't exist
+    """
+    if not os.path.isdir(juju_dir):
+        return []
+    if not os.access(juju_dir, os.R_OK | os.X_OK):
+        return [juju_dir]
+    unreadable = []
+    for entry in os.scandir(juju_dir):
+        if entry.is_file() and not os.access(entry.path, os.R_OK):
+            unreadable.append(entry.path)
+    return sorted(unreadable)
+
+
+def sync_registry(branch):
+    """ Syncs the spells registry before start up can continue
+    """
+    spells_dir = app.config['spells-dir']
+    if not os.path.exists(spells_dir):
+        utils.info("No spells found, syncing from registry, please wait.")
+    try:
+        download_or_sync_registry(
+            app.argv.registry,
+            spells_dir, branch=branch,
+            timeout=app.argv.registry_sync_timeout)
+    except (subprocess.SubprocessError, OSError) as e:
+        if not os.path.exists(spells_dir):
+            raise PreflightError("Could not load from registry")
+        app.log.debug('Could not sync spells from github: {}'.format(e))
+
+
+def load_spell(spell):
+    """ Copies the spell into the cache and loads its metadata, steps
+    and addons
+
+    Arguments:
+    spell: spell as given on the command line
+    """
+    opts = app.argv
+    spell_name = os.path.basename(os.path.abspath(spell))
+
+    if app.endpoint_type == EndpointType.LOCAL_SEARCH:
+        exact = utils.find_spells_exact(spell)
+        spells = exact or utils.find_spells_matching(spell)
+
+        if len(spells) == 0:
+            raise PreflightError(
+                "Can't find a spell matching '{}'".format(spell))
+
+        # Only a category or spell key naming a single spell is a
+        # direct match that we can copy now. Changing the endpoint type
+        # then stops us from showing the picker UI. Anything else,
+        # including a single keyword match, needs the picker UI, which
+        # defers the copy to SpellPickerController.finish(), so nothing
+        # to do here. Headless installs have no picker, so list the
+        # keyword matches instead of guessing.
+        if len(exact) != 1:
+            if not exact and opts.cloud:
+                raise PreflightError(
+                    "Can't find a spell named '{}', did you mean: "
+                    "{}".format(spell, ', '.join(
+                        sd['key'] for _, sd in spells)))
+            return
+        app.log.debug("found spell {}".format(spells[0][1]))
+        spell_key = spells[0][1]['key']
+        utils.set_chosen_spell(spell_name,
+                               os.path.join(opts.cache_dir, spell_key))
+        download_local(os.path.join(app.config['spells-dir'], spell_key),
+                       app.config['spell-dir'])
+        app.endpoint_type = EndpointType.LOCAL_DIR
+
+    # download spell if necessary
+    elif app.endpoint_type == EndpointType.LOCAL_DIR:
+        if not os.path.isdir(spell):
+            raise PreflightError("Could not find spell {}".format(spell))
+
+        if not os.path.exists(os.path.join(spell, "metadata.yaml")):
+            raise PreflightError(
+                "'{}' does not appear to be a spell. "
+                "{}/metadata.yaml was not found.".format(spell, spell))
+
+        utils.set_chosen_spell(spell_name,
+                               path.join(opts.cache_dir, spell_name))
+        download_local(spell, app.config['spell-dir'])
+
+    elif app.endpoint_type in [EndpointType.VCS, EndpointType.HTTP]:
+        utils.set_chosen_spell(spell_name,
+                               path.join(opts.cache_dir, spell_name))
+        remote = get_remote_url(spell)
+
+        if remote is None:
+            raise PreflightError(
+                "Can't guess URL matching '{}'".format(spell))
+
+        download(remote, app.config['spell-dir'], True)
+
+    else:
+        return
+
+    utils.set_spell_metadata()
+    StepModel.load_spell_steps()
+    AddonModel.load_spell_addons()
+
+
+def preflight(registry_branch=None):
+    """ Runs the start up checks, running those that don't depend on
+    each other at the same time, and logs how long each one took
+
+    Only the spells index has to wait on the registry sync, and a spell
+    given by name has to wait on the index. Everything else runs in the
+    default executor while the registry is being synced.
+
+    Arguments:
+    registry_branch: branch of the spells registry to sync before
+    loading the spells index, or None to use the local copy
+    """
+    def blocking(func, *args):
+        return lambda: app.loop.run_in_executor(None, partial(func, *args))
+
+    scheduler = Scheduler()
+    scheduler.add('juju-data', blocking(check_juju_data, utils.juju_path()))
+    scheduler.add('juju-version', blocking(utils.juju_version))
+    index_deps = []
+    if registry_branch is not None:
+        scheduler.add('registry-sync', blocking(sync_registry,
+                                                registry_branch), cost=10)
+        index_deps.append('registry-sync')
+    scheduler.add('spells-index', blocking(load_spells_index),
+                  deps=index_deps)
+    spell_deps = []
+    if app.endpoint_type == EndpointType.LOCAL_SEARCH:
+        spell_deps.append('spells-index')
+    scheduler.add('spell', blocking(load_spell, app.argv.spell),
+                  deps=spell_deps, cost=5)
+
+    started = time.time()
+    try:
+        results = app.loop.run_until_complete(scheduler.run())
+    finally:
+        for name, (start, finish) in scheduler.timings().items():
+            if start is not None and finish is not None:
+                app.log.debug('Start up: {} took {:.3f}s'.format(
+                    name, finish - start))
+        app.log.debug('Start up: preflight took {:.3f}s'.format(
+            time.time() - started))
+
+    unreadable = results['juju-data']
+    if unreadable:
+        raise PreflightError(
+            "Unable to read from {}, please double check your permissions "
+            "on that directory and its files: {}".format(
+                utils.juju_path(), ', '.join(unreadable)))
+
+    app.log.debug("Juju version: {}, "
+                  "conjure-up version: {}".format(results['juju-version'],
+                                                  VERSION))
+
+
+def setup_sentry():
+    """ Sets up the client for automatic error reports
+    """
+    import raven
+    from raven.transport.requests import RequestsHTTPTransport
+
+    app.sentry = raven.Client(
+        dsn=SENTRY_DSN,
+        release=VERSION,
+        transport=RequestsHTTPTransport,
+        processors=(
+            'conjureup.sentry.SanitizeDataProcessor',
+        )
+    )
+
+
 def apply_proxy():
     """ Sets up proxy information.
     """
@@ -158,6 +400,8 @@ def apply_proxy():
 def show_env():
     """ Shows environment variables from post deploy actions
     """
+    from prettytable import PrettyTable
+
     print("Available environment variables: \n")
     table = PrettyTable()
     table.field_names = ["ENV", "DEFAULT", ""]
@@ -187,24 +431,8 @@ def main():
         print("")
         sys.exit(1)
 
-    # Verify we can access ~/.local/share/juju if it exists
-    juju_dir = pathlib.Path('~/.local/share/juju').expanduser()
-    if juju_dir.exists():
-        try:
-            for f in juju_dir.iterdir():
-                if f.is_file():
-                    f.read_text()
-        except PermissionError:
-            print("")
-            print("  !! Unable to read from ~/.local/share/juju, please "
-                  "double check your permissions on that directory "
-                  "and its files. !!")
-            print("")
-            sys.exit(1)
-
     utils.set_terminal_title("conjure-up")
     opts = parse_options(sys.argv[1:])
-    spell = os.path.basename(os.path.abspath(opts.spell))
 
     if not os.path.isdir(opts.cache_dir):
         os.makedirs(opts.cache_dir)
@@ -219,6 +447,10 @@ def main():
     app.log = setup_logging(app,
                             os.path.join(opts.cache_dir, 'conjure-up.log'),
                             opts.debug)
+    if opts.trace:
+        trace.enable(opts.trace)
+    if opts.debug:
+        events.enable_tracing()
 
     if app.argv.conf_file.expanduser().exists():
         conf = configparser.ConfigParser()
@@ -230,12 +462,6 @@ def main():
     if app.argv.noreport:
         app.noreport = True
 
-    # Grab current LXD and Juju versions
-    app.log.debug("Juju version: {}, "
-                  "conjure-up version: {}".format(
-                      utils.juju_version(),
-                      VERSION))
-
     # Setup proxy
     apply_proxy()
 
@@ -248,95 +474,35 @@ def main():
     spells_index_path = os.path.join(app.config['spells-dir'],
                                      'spells-index.yaml')
     spells_registry_branch = os.getenv('CONJUREUP_REGISTRY_BRANCH', 'stable')
+    app.endpoint_type = detect_endpoint(opts.spell)
+    needs_registry_sync = False
+    background_sync = False
 
-    if not app.argv.nosync:
-        if not os.path.exists(spells_dir):
-            utils.info("No spells found, syncing from registry, please wait.")
-        try:
-            download_or_sync_registry(
-                app.argv.registry,
-                spells_dir, branch=spells_registry_branch)
-        except subprocess.CalledProcessError as e:
-            if not os.path.exists(spells_dir):
-                utils.error("Could not load from registry")
-                sys.exit(1)
-
-            app.log.debug(
-                'Could not sync spells from github: {}'.format(e))
-    else:
+    if app.argv.nosync:
         if not os.path.exists(spells_index_path):
             utils.error(
                 "You opted to not sync from the spells registry, however, "
                 "we could not find any suitable spells in: "
                 "{}".format(spells_dir))
             sys.exit(1)
+    elif not registry_sync_due(app.argv.registry, spells_dir,
+                               spells_registry_branch,
+                               app.argv.registry_sync_interval):
+        app.log.debug('Spells registry synced recently, skipping sync')
+    elif (os.path.exists(spells_index_path) and
+          app.endpoint_type is None and not app.argv.cloud):
+        # the spell picker can render the spells we already have and
+        # reload once the sync is done
+        background_sync = True
+    else:
+        needs_registry_sync = True
 
-    with open(spells_index_path) as fp:
-        app.spells_index = yaml.safe_load(fp.read())
-
-    spell_name = spell
-    app.endpoint_type = detect_endpoint(opts.spell)
-
-    if app.endpoint_type == EndpointType.LOCAL_SEARCH:
-        spells = utils.find_spells_matching(opts.spell)
-
-        if len(spells) == 0:
-            utils.error("Can't find a spell matching '{}'".format(opts.spell))
-            sys.exit(1)
-
-        # One result means it was a direct match and we can copy it
-        # now. Changing the endpoint type then stops us from showing
-        # the picker UI. More than one result means we need to show
-        # the picker UI and will defer the copy to
-        # SpellPickerController.finish(), so nothing to do here.
-        if len(spells) == 1:
-            app.log.debug("found spell {}".format(spells[0][1]))
-            spell = spells[0][1]
-            utils.set_chosen_spell(spell_name,
-                                   os.path.join(opts.cache_dir,
-                                                spell['key']))
-            download_local(os.path.join(app.config['spells-dir'],
-                                        spell['key']),
-                           app.config['spell-dir'])
-            utils.set_spell_metadata()
-            StepModel.load_spell_steps()
-            AddonModel.load_spell_addons()
-            app.endpoint_type = EndpointType.LOCAL_DIR
-
-    # download spell if necessary
-    elif app.endpoint_type == EndpointType.LOCAL_DIR:
-        if not os.path.isdir(opts.spell):
-            utils.warning("Could not find spell {}".format(opts.spell))
-            sys.exit(1)
-
-        if not os.path.exists(os.path.join(opts.spell,
-                                           "metadata.yaml")):
-            utils.warning("'{}' does not appear to be a spell. "
-                          "{}/metadata.yaml was not found.".format(
-                              opts.spell, opts.spell))
-            sys.exit(1)
-
-        spell_name = os.path.basename(os.path.abspath(spell))
-        utils.set_chosen_spell(spell_name,
-                               path.join(opts.cache_dir, spell_name))
-        download_local(opts.spell, app.config['spell-dir'])
-        utils.set_spell_metadata()
-        StepModel.load_spell_steps()
-        AddonModel.load_spell_addons()
-
-    elif app.endpoint_type in [EndpointType.VCS, EndpointType.HTTP]:
-
-        utils.set_chosen_spell(spell, path.join(opts.cache_dir, spell))
-        remote = get_remote_url(opts.spell)
-
-        if remote is None:
-            utils.warning("Can't guess URL matching '{}'".format(opts.spell))
-            sys.exit(1)
-
-        download(remote, app.config['spell-dir'], True)
-        utils.set_spell_metadata()
-        StepModel.load_spell_steps()
-        AddonModel.load_spell_addons()
+    app.loop = asyncio.get_event_loop()
+    try:
+        preflight(spells_registry_branch if needs_registry_sync else None)
+    except PreflightError as e:
+        utils.error(e)
+        sys.exit(1)
 
     app.env['CONJURE_UP_CACHEDIR'] = app.argv.cache_dir
 
@@ -347,22 +513,23 @@ def main():
 
         show_env()
 
-    app.sentry = raven.Client(
-        dsn=SENTRY_DSN,
-        release=VERSION,
-        transport=RequestsHTTPTransport,
-        processors=(
-            'conjureup.utils.SanitizeDataProcessor',
-        )
-    )
+    if not app.noreport:
+        setup_sentry()
 
     track_screen("Application Start")
     track_event("OS", platform.platform(), "")
 
-    app.loop = asyncio.get_event_loop()
     app.loop.add_signal_handler(signal.SIGINT, events.Shutdown.set)
+    if background_sync:
+        app.registry_sync = app.loop.create_task(
+            _sync_registry(spells_registry_branch))
     try:
         if app.argv.cloud:
+            from conjureup.models.provider import (
+                SchemaErrorUnknownCloud,
+                load_schema
+            )
+
             cloud = None
             region = None
             if '/' in app.argv.cloud:
@@ -402,6 +569,11 @@ def main():
             app.loop.run_forever()
 
         else:
+            # the UI stack is only needed when not headless
+            from ubuntui.ev import EventLoop
+            from ubuntui.palette import STYLES
+            from conjureup.ui import ConjureUI
+
             app.ui = ConjureUI()
 
             EventLoop.build_loop(app.ui, STYLES,
@@ -415,4 +587,9 @@ def main():
         # asyncio.create_subprocess_exec being cleaned up during final
         # garbage collection: https://github.com/python/asyncio/issues/396
         app.loop.close()
+        try:
+            if trace.save():
+                utils.info('Trace written to {}'.format(app.argv.trace))
+        except OSError as e:
+            utils.error('Unable to write trace: {}'.format(e))
     sys.exit(app.exit_code)
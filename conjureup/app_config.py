@@ -113,6 +113,9 @@ class AppConfig:
     # Spells index
     spells_index = None
 
+    # Spells registry sync running in the background, if any
+    registry_sync = None
+
     # Password for sudo, if needed
     sudo_pass = None
 
@@ -157,6 +160,7 @@ class AppConfig:
         precautions.
         """
         blacklist = ['loop', 'log', 'maas', 'argv', 'spells_index',
+                     'registry_sync',
                      'juju', 'ui', 'bootstrap', 'endpoint_type', 'provider',
                      'metadata_controller', 'state',
                      'env', 'sentry', 'steps', 'sudo_pass', 'addons']
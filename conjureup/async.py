@@ -1,12 +1,37 @@
 """ Async Handler
 Provides async operations for various api calls and other non-blocking
 work.
+
+Jobs are run on named queues, each with its own pool of worker threads.
+Queued jobs run in priority order, duplicate jobs can be coalesced into
+one, and every queue keeps metrics on how long its jobs waited and ran.
+
+Delayed and periodic jobs are scheduled on a single timer thread that
+sleeps until the next one is due, and hands them to their queue.
+
+Usage:
+
+from conjureup import async
+
+async.configure('maas-async-queue', workers=4)
+future = async.submit(partial(client.get, 'machines'), on_error,
+                      queue_name='maas-async-queue',
+                      priority=async.PRIORITY_HIGH,
+                      key='machines')
+timer = async.call_every(5, partial(client.get, 'machines'), jitter=0.2,
+                         queue_name='maas-async-queue')
+timer.cancel()
 """
 
+import heapq
+import itertools
 import logging
+import random
+import threading
 import time
+import weakref
 from collections import OrderedDict, defaultdict
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future
 from threading import Event
 
 log = logging.getLogger("async")
@@ -18,61 +43,558 @@ class ThreadCancelledException(Exception):
 
 ShutdownEvent = Event()
 
-_queues = defaultdict(lambda: ThreadPoolExecutor(1))
 DEFAULT_QUEUE = "DEFAULT"
+DEFAULT_WORKERS = 1
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Tokens are woken up on shutdown so nothing sleeping on them has to poll
+_tokens = weakref.WeakSet()
+
+
+class CancelToken:
+    """ Cooperative cancellation for a job
+
+    Cancelling a token stops a job that hasn't started yet from running.
+    A job that is already running has to check the token itself, or
+    pass it to sleep_until.
+    """
+
+    def __init__(self):
+        self._event = Event()
+        _tokens.add(self)
+        if ShutdownEvent.is_set():
+            self._event.set()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set() or ShutdownEvent.is_set()
+
+    def check(self):
+        """ Raises ThreadCancelledException if the token was cancelled
+        """
+        if self.cancelled:
+            raise ThreadCancelledException("Job cancelled")
+
+
+class _Job:
+    def __init__(self, func, priority, key, kind, token):
+        self.func = func
+        self.priority = priority
+        self.key = key
+        self.kind = kind
+        self.token = token
+        self.future = Future()
+        self.queued = time.time()
+
+
+class _KindStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.coalesced = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def to_dict(self):
+        ran = max(self.count - self.cancelled, 1)
+        return OrderedDict([
+            ('count', self.count),
+            ('errors', self.errors),
+            ('cancelled', self.cancelled),
+            ('coalesced', self.coalesced),
+            ('wait_avg', self.wait_total / max(self.count, 1)),
+            ('wait_max', self.wait_max),
+            ('run_avg', self.run_total / ran),
+            ('run_max', self.run_max),
+        ])
+
+
+class JobQueue:
+    def __init__(self, name, workers=DEFAULT_WORKERS):
+        """ Prioritized job queue served by a pool of worker threads
+
+        Arguments:
+        name: queue name, used to name the worker threads
+        workers: maximum number of jobs to run at once
+        """
+        self.name = name
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._heap = []
+        self._counter = itertools.count()
+        self._threads = []
+        self._idle = 0
+        self._inflight = {}
+        self._stats = defaultdict(_KindStats)
+        self._running = 0
+        self._closed = False
+
+    def submit(self, func, priority=PRIORITY_NORMAL, key=None, kind=None,
+               token=None):
+        """ Queues a job
+
+        Arguments:
+        func: callable taking no arguments
+        priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW, lower
+        values run first
+        key: jobs submitted with the same key while one is still queued
+        or running share its future instead of running again
+        kind: name to group the job's metrics under, defaults to key
+        or the function's name
+        token: CancelToken for the job
+
+        Returns:
+        concurrent.futures.Future of the job's result
+        """
+        kind = kind or key or _func_name(func)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(
+                    "Queue {} has been shut down".format(self.name))
+            if key is not None and key in self._inflight:
+                self._stats[kind].coalesced += 1
+                return self._inflight[key].future
+            job = _Job(func, priority, key, kind, token)
+            if key is not None:
+                self._inflight[key] = job
+            heapq.heappush(self._heap,
+                           (priority, next(self._counter), job))
+            if self._idle:
+                self._ready.notify()
+            # idle workers only leave the count once they wake up, so a
+            # burst needs new workers once it outnumbers the idle ones
+            if len(self._heap) > self._idle and \
+               len(self._threads) < self.workers:
+                self._start_worker()
+        return job.future
+
+    @property
+    def closed(self):
+        """ True once the queue has been shut down
+        """
+        with self._lock:
+            return self._closed
+
+    def _start_worker(self):
+        thread = threading.Thread(
+            target=self._work,
+            name='{}-{}'.format(self.name, len(self._threads)),
+            daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._heap and not self._closed:
+                    self._idle += 1
+                    self._ready.wait()
+                    self._idle -= 1
+                if self._closed:
+                    return
+                job = heapq.heappop(self._heap)[2]
+                self._running += 1
+            self._run(job)
+
+    def _done(self, job):
+        """ Takes a finished job out of the running and in flight jobs,
+        called with the lock held before its future is resolved so that
+        a job submitted again from then on runs again
+        """
+        self._running -= 1
+        if job.key is not None and self._inflight.get(job.key) is job:
+            del self._inflight[job.key]
+
+    def _run(self, job):
+        started = time.time()
+        with self._lock:
+            stats = self._stats[job.kind]
+            stats.count += 1
+            stats.wait_total += started - job.queued
+            stats.wait_max = max(stats.wait_max, started - job.queued)
+        token_cancelled = job.token is not None and job.token.cancelled
+        if token_cancelled or not job.future.set_running_or_notify_cancel():
+            with self._lock:
+                stats.cancelled += 1
+                self._done(job)
+            if token_cancelled:
+                _cancel_future(job.future)
+            return
+        error = None
+        try:
+            result = job.func()
+        except BaseException as e:
+            error = e
+        elapsed = time.time() - started
+        with self._lock:
+            if error is not None:
+                stats.errors += 1
+            stats.run_total += elapsed
+            stats.run_max = max(stats.run_max, elapsed)
+            self._done(job)
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    def stats(self):
+        """ Returns the queue's depth and per kind job metrics
+        """
+        with self._lock:
+            return OrderedDict([
+                ('workers', self.workers),
+                ('queued', len(self._heap)),
+                ('running', self._running),
+                ('kinds', OrderedDict(
+                    (kind, stats.to_dict())
+                    for kind, stats in sorted(self._stats.items()))),
+            ])
+
+    def shutdown(self):
+        """ Cancels queued jobs and stops the workers once they finish
+        the jobs they are running
+        """
+        with self._lock:
+            self._closed = True
+            jobs = [job for _, _, job in self._heap]
+            self._heap = []
+            self._inflight = {}
+            self._ready.notify_all()
+        for job in jobs:
+            _cancel_future(job.future)
+
+
+def _cancel_future(future):
+    """ Cancels a future that never started running, waking up anyone
+    in concurrent.futures.wait() on it, which cancel() alone doesn't
+    """
+    future.cancel()
+    future.set_running_or_notify_cancel()
+
+
+class Timer:
+    def __init__(self, service, when, func, interval, jitter, exc_callback,
+                 submit_args):
+        """ Delayed or periodic job, created by call_later or call_every
+        """
+        self.service = service
+        self.when = when
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.exc_callback = exc_callback
+        self.submit_args = submit_args
+        self.cancelled = False
+
+    def cancel(self):
+        """ Stops the timer, the job won't be submitted again
+        """
+        self.service.cancel(self)
+
+    def next_delay(self):
+        if not self.jitter:
+            return self.interval
+        spread = self.interval * self.jitter
+        return self.interval + random.uniform(-spread, spread)
+
+
+class TimerService:
+    def __init__(self):
+        """ Runs delayed and periodic jobs from one thread that sleeps
+        until the earliest one is due
+        """
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+        self._pending = 0
+        self._closed = False
+
+    def schedule(self, delay, func, interval=None, jitter=0,
+                 exc_callback=None, **submit_args):
+        """ Submits func to its queue after delay seconds, and then every
+        interval seconds after each run finishes if interval is given
+
+        Arguments:
+        delay: seconds until the first run
+        func: callable taking no arguments
+        interval: seconds between runs, or None to run once
+        jitter: fraction of the interval to randomly shift each run by,
+        so periodic jobs started together spread out
+        exc_callback: called with the exception if func raises one
+        submit_args: queue_name, priority, key and kind for submit
 
-ENABLE_LOG = False
-if ENABLE_LOG:
-    import q
-    _queueLog = defaultdict(OrderedDict)
+        Returns:
+        Timer
+        """
+        timer = Timer(self, time.monotonic() + delay, func, interval,
+                      jitter, exc_callback, submit_args)
+        with self._lock:
+            if self._closed:
+                timer.cancelled = True
+                return timer
+            self._pending += 1
+            self._push(timer)
+        return timer
 
+    def _push(self, timer):
+        heapq.heappush(self._heap, (timer.when, next(self._counter), timer))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='timers', daemon=True)
+            self._thread.start()
+        elif self._heap[0][2] is timer:
+            # the new timer is due before the one being waited on
+            self._wakeup.notify()
 
-def submit(func, exc_callback, queue_name="DEFAULT"):
+    def cancel(self, timer):
+        with self._lock:
+            if not timer.cancelled:
+                timer.cancelled = True
+                self._pending -= 1
+
+    def pending(self):
+        """ Returns the number of timers waiting to run
+        """
+        with self._lock:
+            return self._pending
+
+    def _run(self):
+        while True:
+            with self._lock:
+                timer = None
+                while not self._closed:
+                    if not self._heap:
+                        self._wakeup.wait()
+                        continue
+                    when, _, timer = self._heap[0]
+                    if timer.cancelled:
+                        heapq.heappop(self._heap)
+                        continue
+                    delay = when - time.monotonic()
+                    if delay > 0:
+                        self._wakeup.wait(delay)
+                        continue
+                    heapq.heappop(self._heap)
+                    if timer.interval is None:
+                        timer.cancelled = True
+                        self._pending -= 1
+                    break
+                if self._closed:
+                    return
+            self._fire(timer)
+
+    def _fire(self, timer):
+        future = submit(timer.func, timer.exc_callback or _log_timer_error,
+                        **timer.submit_args)
+        if timer.interval is None:
+            return
+        if future is None:
+            # nothing left to reschedule it from
+            log.debug("cancelling periodic timer {}, its job was not "
+                      "submitted".format(_func_name(timer.func)))
+            self.cancel(timer)
+            return
+        future.add_done_callback(lambda _: self._reschedule(timer))
+
+    def _reschedule(self, timer):
+        with self._lock:
+            if timer.cancelled or self._closed:
+                return
+            timer.when = time.monotonic() + timer.next_delay()
+            self._push(timer)
+
+    def shutdown(self):
+        """ Cancels every timer and stops the timer thread
+        """
+        with self._lock:
+            self._closed = True
+            for _, _, timer in self._heap:
+                timer.cancelled = True
+            self._heap = []
+            self._pending = 0
+            self._wakeup.notify_all()
+
+
+def _log_timer_error(e):
+    log.debug("timer job failed: {}".format(e))
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+_workers = {}
+_timers = TimerService()
+
+
+def _func_name(func):
+    func = getattr(func, 'func', func)  # functools.partial
+    return getattr(func, '__qualname__', None) or repr(func)
+
+
+def configure(queue_name, workers):
+    """ Sets the number of worker threads for a queue
+
+    Arguments:
+    queue_name: queue to configure
+    workers: maximum number of jobs the queue runs at once
+    """
+    with _queues_lock:
+        _workers[queue_name] = workers
+        if queue_name in _queues:
+            _queues[queue_name].workers = workers
+
+
+def get_queue(queue_name=DEFAULT_QUEUE):
+    """ Returns the named queue, creating it if needed or replacing it
+    if it has been shut down
+    """
+    with _queues_lock:
+        if queue_name not in _queues or _queues[queue_name].closed:
+            _queues[queue_name] = JobQueue(
+                queue_name, _workers.get(queue_name, DEFAULT_WORKERS))
+        return _queues[queue_name]
+
+
+def submit(func, exc_callback, queue_name=DEFAULT_QUEUE,
+           priority=PRIORITY_NORMAL, key=None, kind=None, token=None):
+    """ Runs func on a worker thread of the named queue
+
+    Arguments:
+    func: callable taking no arguments
+    exc_callback: called with the exception if func raises one
+    queue_name: queue to run func on
+    priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+    key: coalesce with a queued or running job submitted with this key
+    kind: name to group the job's metrics under
+    token: CancelToken for the job
+
+    Returns:
+    concurrent.futures.Future, or None if shutting down
+    """
     def cb(cb_f):
+        if cb_f.cancelled():
+            return
         e = cb_f.exception()
         if e:
             exc_callback(e)
-        if ENABLE_LOG:
-            now = time.time()
-            t = _queueLog[queue_name][func]
-            _queueLog[queue_name][func] = (t[0], t[1],
-                                           "done", time.time(),
-                                           e,
-                                           "elapsed", now - t[1])
-            q.q(qstatsf())
     if ShutdownEvent.is_set():
         log.debug("ignoring async.submit due to impending shutdown.")
         return None
-    f = _queues[queue_name].submit(func)
-    if ENABLE_LOG:
-        _queueLog[queue_name][func] = ("added", time.time(), None, None, None)
-        q.q(qstatsf())
+    try:
+        f = get_queue(queue_name).submit(func, priority, key, kind, token)
+    except RuntimeError:
+        log.debug("ignoring async.submit to closed queue {}.".format(
+            queue_name))
+        return None
     f.add_done_callback(cb)
     return f
 
 
-def qstatsf():
-    s = ""
-    for queue, od in _queueLog.items():
-        s += "{}:\n".format(queue)
-        for func, t in od.items():
-            s += "{} - {}\n".format(func, t)
-    return s
+def call_later(delay, func, exc_callback=None, **submit_args):
+    """ Submits func to a queue once delay seconds have passed
+
+    Arguments:
+    delay: seconds to wait
+    func: callable taking no arguments
+    exc_callback: called with the exception if func raises one
+    submit_args: queue_name, priority, key and kind for submit
+
+    Returns:
+    Timer that can be cancelled
+    """
+    return _timers.schedule(delay, func, exc_callback=exc_callback,
+                            **submit_args)
+
+
+def call_every(interval, func, jitter=0.1, exc_callback=None,
+               **submit_args):
+    """ Submits func to a queue every interval seconds, measured from
+    the end of the previous run
+
+    Arguments:
+    interval: seconds between runs
+    func: callable taking no arguments
+    jitter: fraction of the interval to randomly shift each run by
+    exc_callback: called with the exception if func raises one
+    submit_args: queue_name, priority, key and kind for submit
+
+    Returns:
+    Timer that can be cancelled
+    """
+    return _timers.schedule(interval, func, interval=interval,
+                            jitter=jitter, exc_callback=exc_callback,
+                            **submit_args)
+
+
+def pending_timers():
+    """ Returns the number of delayed and periodic jobs waiting to run
+    """
+    return _timers.pending()
+
+
+def stats():
+    """ Returns metrics for every queue
+
+    Returns:
+    mapping of queue names to their depth and per kind job counts,
+    wait and run times in seconds
+    """
+    with _queues_lock:
+        queues = sorted(_queues.items())
+    return OrderedDict((name, queue.stats()) for name, queue in queues)
+
+
+def log_stats():
+    """ Writes the queue metrics to the log
+    """
+    log.info("{} timers pending".format(pending_timers()))
+    for name, queue_stats in stats().items():
+        log.info("queue {}: {} workers, {} queued, {} running".format(
+            name, queue_stats['workers'], queue_stats['queued'],
+            queue_stats['running']))
+        for kind, s in queue_stats['kinds'].items():
+            log.info("  {}: {} jobs, {} errors, {} cancelled, {} coalesced, "
+                     "wait {:.3f}s avg {:.3f}s max, "
+                     "run {:.3f}s avg {:.3f}s max".format(
+                         kind, s['count'], s['errors'], s['cancelled'],
+                         s['coalesced'], s['wait_avg'], s['wait_max'],
+                         s['run_avg'], s['run_max']))
 
 
 def shutdown():
+    if ShutdownEvent.is_set():
+        return
     ShutdownEvent.set()
-    for queue in _queues.values():
-        queue.shutdown(wait=False)
+    pending = pending_timers()
+    _timers.shutdown()
+    for token in list(_tokens):
+        token._event.set()
+    with _queues_lock:
+        queues = list(_queues.values())
+    for queue in queues:
+        queue.shutdown()
+    log.info("{} timers cancelled".format(pending))
+    log_stats()
 
 
-def sleep_until(s):
+def sleep_until(s, token=None):
     """returns after 's' seconds.
-    If the ShutdownEvent is raised before the wait is over,
-    raises a ThreadCancelledException.
+    If the ShutdownEvent is raised or the token is cancelled before the
+    wait is over, raises a ThreadCancelledException.
     """
-    start = time.time()
-    while not ShutdownEvent.wait(timeout=.1):
-        if time.time() - start >= s:
-            return True
+    # tokens are set on shutdown as well, so there is one event to wait on
+    event = ShutdownEvent if token is None else token._event
+    if not event.wait(timeout=s):
+        return True
     raise ThreadCancelledException("Thread cancelled while sleeping")
@@ -3,20 +3,162 @@
 Api for the charmstore:
 https://github.com/juju/charmstore/blob/v5/docs/API.md
 """
+import asyncio
+import hashlib
+import json
+import os
 import os.path as path
+import threading
+import time
+from pathlib import Path
 
 import requests
 import yaml
+from bundleplacer.charmstore_api import CharmStoreID
+from requests.adapters import HTTPAdapter
+
+from conjureup.app_config import app
 
 cs = 'https://api.jujucharms.com/v5'
 CHANNELS = ['stable', 'candidate', 'beta', 'edge']
 
+# How long, in seconds, a resolved charm revision stays fresh per channel
+REVISION_TTLS = {
+    'stable': 60 * 60,
+    'candidate': 30 * 60,
+    'beta': 10 * 60,
+    'edge': 5 * 60,
+}
+
+# (connect, read) timeouts, in seconds, of charm store requests
+HTTP_TIMEOUT = (5, 30)
+
+# Requests served from the HTTP cache (hits, including 304 revalidations),
+# fetched in full (misses) and served from cache because the charm store
+# was unreachable (stale)
+http_cache_stats = {'hits': 0, 'misses': 0, 'stale': 0}
+_http_cache_lock = threading.Lock()
+_session = None
+
+# (channel, charm id without revision) : charm id with revision
+_revisions = {}
+# (channel, charm id without revision) : Future of a pending lookup
+_pending_revisions = {}
+
+
+def get_session():
+    """ Returns the shared session used for all charm store requests, so
+    connections are kept alive and reused
+    """
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session = session
+    return _session
+
+
+def _http_cache_paths(url):
+    if app.argv is None:
+        return None, None
+    cache_dir = Path(app.argv.cache_dir) / 'http-cache'
+    digest = hashlib.sha1(url.encode('utf8')).hexdigest()
+    return cache_dir / (digest + '.json'), cache_dir / digest
+
+
+def _count(stat):
+    with _http_cache_lock:
+        http_cache_stats[stat] += 1
+
+
+def _cached_response(url, meta, body_path):
+    resp = requests.Response()
+    resp.url = url
+    resp.status_code = 200
+    resp.headers.update(meta['headers'])
+    resp._content = body_path.read_bytes()
+    resp.encoding = meta.get('encoding')
+    return resp
+
+
+def _store_response(resp, meta_path, body_path):
+    headers = {k: v for k, v in resp.headers.items()
+               if k.lower() in ('content-type', 'etag', 'last-modified')}
+    meta = {'url': resp.url, 'headers': headers, 'encoding': resp.encoding}
+    suffix = '.{}.tmp'.format(threading.get_ident())
+    try:
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_body = body_path.with_name(body_path.name + suffix)
+        tmp_body.write_bytes(resp.content)
+        os.replace(str(tmp_body), str(body_path))
+        tmp_meta = meta_path.with_name(meta_path.name + suffix)
+        tmp_meta.write_text(json.dumps(meta))
+        os.replace(str(tmp_meta), str(meta_path))
+    except OSError as e:
+        app.log.debug('Unable to cache {}: {}'.format(resp.url, e))
+
+
+def http_get(url):
+    """ GETs a charm store url through the shared session and the on-disk
+    HTTP cache
+
+    Cached responses are revalidated with their ETag or Last-Modified
+    headers. If the charm store can't be reached, times out or fails with
+    a server error, the cached response is served even though it may be
+    stale.
+
+    Arguments:
+    url: url to fetch
+
+    Returns:
+    requests.Response
+    """
+    meta_path, body_path = _http_cache_paths(url)
+    meta = None
+    if meta_path is not None and body_path.exists():
+        try:
+            meta = json.loads(meta_path.read_text())
+        except (OSError, ValueError):
+            meta = None
+
+    headers = {}
+    if meta is not None:
+        if 'ETag' in meta['headers']:
+            headers['If-None-Match'] = meta['headers']['ETag']
+        if 'Last-Modified' in meta['headers']:
+            headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+
+    try:
+        resp = get_session().get(url, headers=headers, timeout=HTTP_TIMEOUT)
+        error = None
+        if resp.status_code >= 500:
+            error = '{} {}'.format(resp.status_code, resp.reason)
+    except requests.exceptions.RequestException as e:
+        if meta is None:
+            raise
+        error = e
+    if error is not None and meta is not None:
+        app.log.debug('Using cached {}, charm store unavailable: {}'.format(
+            url, error))
+        _count('stale')
+        return _cached_response(url, meta, body_path)
+
+    if resp.status_code == 304 and meta is not None:
+        _count('hits')
+        return _cached_response(url, meta, body_path)
+    _count('misses')
+    if resp.ok and meta_path is not None:
+        _store_response(resp, meta_path, body_path)
+    return resp
+
 
 def get_file(bundle, dst):
     """ Pulls a single file from the charmstore
     """
     bundle = path.join(cs, bundle, 'archive', dst)
-    req = requests.get(bundle)
+    req = http_get(bundle)
     if not req.ok:
         raise Exception("Could not query file in charmstore: {}".format(req))
     return req.text
@@ -51,7 +193,7 @@ def get_channel_info(bundle_name, channel='stable'):
     """
     query = path.join(cs, bundle_name,
                       "meta/id?channel={}".format(channel))
-    req = requests.get(query)
+    req = http_get(query)
     if not req.ok:
         raise Exception(
             "Problem getting channel information: {}".format(req)
@@ -82,8 +224,119 @@ def search(tags, promulgated=True):
     query_str += "&include=extra-info/conjure-up"
     query_str += "&type=bundle"
     query = path.join(cs, 'search?tags={}'.format(query_str))
-    req = requests.get(query)
+    req = http_get(query)
     if not req.ok:
         raise Exception(
             "Problem getting tagged bundles: {}".format(req))
     return req.json()
+
+
+def _revision_key(csid, series, channel):
+    """ Key identifying an unpinned charm in a channel
+    """
+    csid = CharmStoreID(csid.as_str())
+    if not csid.series:
+        csid.series = series
+    return channel, csid.as_str_without_rev(include_scheme=False)
+
+
+def _revision_cache_path():
+    return Path(app.argv.cache_dir) / 'charm-revisions.json'
+
+
+def _load_revision_cache():
+    """ Reads the on-disk revision cache, returning an empty one if it is
+    missing or unreadable
+    """
+    try:
+        with _revision_cache_path().open() as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return cache
+
+
+def _save_revision_cache(cache):
+    cache_path = _revision_cache_path()
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    try:
+        with tmp_path.open('w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(str(tmp_path), str(cache_path))
+    except OSError as e:
+        app.log.debug('Unable to save charm revision cache: {}'.format(e))
+
+
+async def resolve_charm_ids(charm_ids, series, channel='stable'):
+    """ Looks up the latest revision of every unpinned charm
+
+    Fresh revisions are taken from the on-disk cache under --cache-dir,
+    the rest are looked up concurrently and written back to it.
+
+    Arguments:
+    charm_ids: CharmStoreIDs to resolve, those with a revision are skipped
+    series: series to use for charms that don't specify one
+    channel: the release channel (ie stable, candidate, beta, edge)
+    """
+    keys = set(_revision_key(csid, series, channel)
+               for csid in charm_ids if csid.rev == "")
+    keys -= set(_revisions)
+    if not keys:
+        return
+
+    cache = _load_revision_cache()
+    channel_cache = cache.setdefault(channel, {})
+    ttl = REVISION_TTLS.get(channel, REVISION_TTLS['edge'])
+    now = time.time()
+    lookups = []
+    for key in sorted(keys):
+        entry = channel_cache.get(key[1])
+        if entry and now - entry['time'] < ttl:
+            _revisions[key] = entry['id']
+        elif key in _pending_revisions:
+            lookups.append(_pending_revisions[key])
+        else:
+            future = app.loop.run_in_executor(None, get_channel_info,
+                                              key[1], channel)
+            _pending_revisions[key] = future
+            lookups.append(future)
+    if not lookups:
+        return
+
+    start = time.time()
+    try:
+        await asyncio.gather(*lookups)
+    finally:
+        for key in keys:
+            future = _pending_revisions.get(key)
+            if future is None or not future.done():
+                continue
+            del _pending_revisions[key]
+            if not future.cancelled() and future.exception() is None:
+                _revisions[key] = future.result()['Id']
+                channel_cache[key[1]] = {'id': _revisions[key],
+                                         'time': now}
+        _save_revision_cache(cache)
+    app.log.debug('Resolved {} charm revision{} in {:.2f}s'.format(
+        len(lookups), 's' if len(lookups) > 1 else '', time.time() - start))
+
+
+async def get_charm_id(csid, series, channel='stable'):
+    """ Returns the charm id to deploy, including its revision
+
+    Only hits the network if the charm wasn't resolved up front by
+    resolve_charm_ids.
+
+    Arguments:
+    csid: CharmStoreID of the charm
+    series: series to use if the charm doesn't specify one
+    channel: the release channel (ie stable, candidate, beta, edge)
+    """
+    if csid.rev != "":
+        return csid.as_str()
+    key = _revision_key(csid, series, channel)
+    if key not in _revisions:
+        await resolve_charm_ids([csid], series, channel)
+    return _revisions[key]
@@ -9,14 +9,14 @@ from conjureup.telemetry import track_event
 class BaseBootstrapController:
     msg_cb = NotImplementedError()
 
-    def is_existing_controller(self):
-        controllers = juju.get_controllers()['controllers']
+    async def is_existing_controller(self):
+        controllers = (await juju.aget_controllers())['controllers']
         return app.provider.controller in controllers
 
     async def run(self):
         await app.provider.configure_tools()
 
-        if app.is_jaas or self.is_existing_controller():
+        if app.is_jaas or await self.is_existing_controller():
             await self.do_add_model()
         else:
             await self.do_bootstrap()
@@ -52,7 +52,9 @@ class BaseBootstrapController:
             err_log = log_file.read_text('utf8').splitlines()
             app.log.error("Error bootstrapping controller: "
                           "{}".format(err_log))
-            app.sentry.context.merge({'extra': {'err_log': err_log[-400:]}})
+            if app.sentry:
+                app.sentry.context.merge({'extra': {
+                    'err_log': err_log[-400:]}})
             raise Exception('Unable to bootstrap (cloud type: {})'.format(
                 app.provider.cloud_type))
 
@@ -16,8 +16,10 @@ class BootstrapController(common.BaseBootstrapController):
 
     def render(self):
         track_screen("Bootstrap")
+        app.loop.create_task(self._render())
 
-        if app.is_jaas or self.is_existing_controller():
+    async def _render(self):
+        if app.is_jaas or await self.is_existing_controller():
             bootstrap_stderr_path = None
             msg = 'Model'
         else:
@@ -4,7 +4,7 @@ from operator import attrgetter
 
 from bundleplacer.assignmenttype import AssignmentType, atype_to_label
 
-from conjureup import controllers, events, juju
+from conjureup import controllers, events, juju, placement
 from conjureup.app_config import app
 from conjureup.consts import cloud_types
 from conjureup.maas import setup_maas
@@ -23,6 +23,8 @@ class ConfigAppsController:
         self.assignments = defaultdict(list)
         self.deployed_juju_machines = {}
         self.maas_machine_map = {}
+        # system id -> future of the bulk tagging job covering it
+        self.id_tag_jobs = {}
         self.init_machines_assignments()
 
     def init_machines_assignments(self):
@@ -179,6 +181,35 @@ class ConfigAppsController:
 
         self.maas_machine_map[juju_machine_id] = maas_machine
 
+    def auto_place_machines(self, machines, assignments, pinned):
+        """Pick ready maas machines for the juju machines that aren't
+        pinned yet, spreading the machines of each application across
+        zones. Nothing is committed, so views can place their uncommitted
+        changes.
+
+        Arguments:
+        machines: dict of juju machine id to its bundle machine dict
+        assignments: dict of juju machine id to the (application,
+        assignment type) tuples on it, only machines listed are placed
+        pinned: dict of juju machine id to the maas machine it is pinned to
+
+        Returns:
+        tuple of a dict of juju machine id to maas machine, and a list of
+        the juju machine ids that couldn't be placed
+        """
+        juju_machines = {}
+        groups = {}
+        for j_id, al in assignments.items():
+            if len(al) == 0 or j_id in pinned:
+                continue
+            juju_machines[j_id] = juju.constraints_to_dict(
+                machines[j_id].get('constraints', ''))
+            groups[j_id] = tuple(sorted(set(a.service_name for a, _ in al)))
+        return placement.place(juju_machines,
+                               app.maas.client.get_machines() or [],
+                               pinned=pinned,
+                               groups=groups)
+
     def apply_assignments(self, application):
         new_assignments = []
         for juju_machine_id, at in self.get_all_assignments(application):
@@ -195,8 +226,18 @@ class ConfigAppsController:
         if machine_id not in self.maas_machine_map:
             return ''
         maas_machine = self.maas_machine_map[machine_id]
-        await app.loop.run_in_executor(
-            None, app.maas.client.assign_id_tags, [maas_machine])
+        if maas_machine.system_id not in self.id_tag_jobs:
+            # tag every pinned machine at once rather than one per call
+            untagged = [m for m in self.maas_machine_map.values()
+                        if m.system_id not in self.id_tag_jobs]
+            job = app.loop.run_in_executor(
+                None, app.maas.client.assign_id_tags, untagged)
+            for m in untagged:
+                self.id_tag_jobs[m.system_id] = job
+        results = await self.id_tag_jobs[maas_machine.system_id]
+        if not results.get(maas_machine.system_id):
+            app.log.warning("Unable to tag MAAS machine {}".format(
+                maas_machine.hostname))
         machine_tag = maas_machine.instance_id.split('/')[-2]
         return "tags={}".format(machine_tag)
 
@@ -4,8 +4,8 @@ from conjureup.consts import JAAS_CLOUDS, JAAS_ENDPOINT
 
 
 class BaseControllerPicker:
-    def check_jaas(self):
-        existing_controllers = juju.get_controllers()['controllers']
+    async def check_jaas(self):
+        existing_controllers = (await juju.aget_controllers())['controllers']
 
         app.jaas_ok = app.provider.cloud_type in JAAS_CLOUDS
         jaas_controller = {n for n, c in existing_controllers.items()
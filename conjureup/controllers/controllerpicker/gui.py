@@ -8,8 +8,11 @@ from . import common
 
 class ControllerPicker(common.BaseControllerPicker):
     def render(self):
-        existing_controllers = juju.get_controllers()['controllers']
-        self.check_jaas()
+        app.loop.create_task(self._render())
+
+    async def _render(self):
+        await self.check_jaas()
+        existing_controllers = (await juju.aget_controllers())['controllers']
 
         filtered_controllers = {n: d
                                 for n, d in existing_controllers.items()
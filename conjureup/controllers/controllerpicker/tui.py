@@ -5,7 +5,10 @@ from . import common
 
 class ControllerPicker(common.BaseControllerPicker):
     def render(self):
-        self.check_jaas()
+        app.loop.create_task(self._render())
+
+    async def _render(self):
+        await self.check_jaas()
         self.finish(app.argv.controller)
 
 
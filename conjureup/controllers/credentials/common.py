@@ -4,16 +4,22 @@ from conjureup.app_config import app
 
 class BaseCredentialsController:
     def __init__(self):
-        creds = juju.get_credentials().get(app.provider.cloud, {})
+        self.credentials = []
+        self.was_picker = False
+
+    async def load_credentials(self):
+        creds = (await juju.aget_credentials()).get(app.provider.cloud, {})
         creds.pop('default-region', None)
 
-        app.provider.credential = creds.pop('default-credential', None)
+        default_credential = creds.pop('default-credential', None)
         self.credentials = sorted(creds.keys())
 
+        # keep any credential already picked when coming back to this screen
+        if app.provider.credential not in self.credentials:
+            app.provider.credential = default_credential
+
         if len(self.credentials) == 1:
             app.provider.credential = self.credentials[0]
 
-        self.was_picker = False
-
     def finish(self):
         controllers.use('regions').render()
@@ -15,10 +15,15 @@ from . import common
 
 class CredentialsController(common.BaseCredentialsController):
     def render(self):
+        app.loop.create_task(self._render())
+
+    async def _render(self):
         if app.provider.cloud_type == cloud_types.LOCAL:
             # no credentials required for localhost
-            self.finish()
-        elif len(self.credentials) >= 1:
+            return self.finish()
+
+        await self.load_credentials()
+        if len(self.credentials) >= 1:
             self.render_picker()
         elif not app.provider.credential:
             self.render_form()
@@ -89,6 +94,7 @@ class CredentialsController(common.BaseCredentialsController):
         with open(cred_path, 'w') as cred_f:
             cred_f.write(yaml.safe_dump(existing_creds,
                                         default_flow_style=False))
+        juju.invalidate_cache()
 
         # Persist input fields in current provider, this is so we
         # can login to the provider for things like querying VSphere
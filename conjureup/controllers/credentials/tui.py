@@ -7,10 +7,15 @@ from . import common
 
 class CredentialsController(common.BaseCredentialsController):
     def render(self):
+        app.loop.create_task(self._render())
+
+    async def _render(self):
         if app.provider.cloud_type == cloud_types.LOCAL:
             # no credentials required for localhost
-            self.finish()
-        elif not self.credentials:
+            return self.finish()
+
+        await self.load_credentials()
+        if not self.credentials:
             utils.warning("You attempted to do an install against a cloud "
                           "that requires credentials that could not be "
                           "found.  If you wish to supply those "
@@ -1,49 +1,136 @@
-import asyncio
+from collections import OrderedDict
+from functools import partial
 from operator import attrgetter
 
 from conjureup import events, juju
 from conjureup.app_config import app
 from conjureup.models.step import StepModel
+from conjureup.scheduler import Scheduler
 
 
 async def do_deploy(msg_cb):
     await events.ModelConnected.wait()
-    cloud_types = juju.get_cloud_types_by_name()
+    cloud_types = await juju.aget_cloud_types_by_name()
     default_series = app.metadata_controller.series
     machines = app.metadata_controller.bundle.machines
     applications = sorted(app.metadata_controller.bundle.services,
                           key=attrgetter('service_name'))
 
     await pre_deploy(msg_cb=msg_cb)
-    machine_map = await juju.add_machines(applications,
-                                          machines,
-                                          msg_cb=msg_cb)
-    tasks = []
-    for service in applications:
-        if cloud_types[app.provider.cloud] == "localhost":
-            # ignore placement when deploying to localhost
+
+    if cloud_types[app.provider.cloud] == "localhost":
+        # ignore placement when deploying to localhost
+        for service in applications:
             service.placement_spec = None
-        elif service.placement_spec:
-            # remap machine references to actual deployed machine IDs
-            # (they will only ever not already match if deploying to
-            # an existing model that has other machines)
-            new_placements = []
-            for plabel in service.placement_spec:
-                if ':' in plabel:
-                    ptype, pid = plabel.split(':')
-                    new_placements.append(':'.join([ptype, machine_map[pid]]))
-                else:
-                    new_placements.append(machine_map[plabel])
-            service.placement_spec = new_placements
-
-        tasks.append(juju.deploy_service(service, default_series,
-                                         msg_cb=msg_cb))
-        tasks.append(juju.set_relations(service,
-                                        msg_cb=msg_cb))
-    await asyncio.gather(*tasks)
+
+    # pick up where an interrupted deploy left off
+    machine_map, missing_units = await juju.reconcile_model(applications,
+                                                            machines)
+    scheduler = Scheduler(concurrency=app.argv.deploy_concurrency)
+
+    async def add_machines(services, vmids):
+        machine_map.update(await juju.add_machines(
+            services,
+            {vmid: machines[vmid] for vmid in vmids},
+            msg_cb=msg_cb))
+
+    def remap(plabel):
+        # remap machine references to actual deployed machine IDs
+        # (they will only ever not already match if deploying to
+        # an existing model that has other machines)
+        if plabel is None:
+            return None
+        if ':' in plabel:
+            ptype, pid = plabel.split(':')
+            return ':'.join([ptype, machine_map[pid]])
+        return machine_map[plabel]
+
+    async def deploy_service(service):
+        if service.service_name in missing_units:
+            await juju.add_units(
+                service,
+                [remap(p) for p in missing_units[service.service_name]],
+                msg_cb=msg_cb)
+            return
+        if service.placement_spec:
+            service.placement_spec = [remap(p)
+                                      for p in service.placement_spec]
+        await juju.deploy_service(service, default_series, msg_cb=msg_cb)
+
+    def placements(service):
+        if service.service_name in missing_units:
+            return missing_units[service.service_name]
+        return service.placement_spec
+
+    to_deploy = [service for service in applications
+                 if not events.AppDeployed.is_set(service.service_name)]
+
+    # each missing bundle machine is added by the first application
+    # placed on it, and applications only wait for the machines they
+    # are placed on
+    machine_owners = OrderedDict()
+    for service in to_deploy:
+        for vmid in _placement_vmids(placements(service)):
+            if vmid not in machine_map:
+                machine_owners.setdefault(vmid, service)
+    owned = OrderedDict()
+    for vmid, service in machine_owners.items():
+        owned.setdefault(service.service_name, (service, []))[1].append(vmid)
+    for name, (service, vmids) in owned.items():
+        scheduler.add('machines:{}'.format(name),
+                      partial(add_machines, [service], vmids),
+                      cost=len(vmids))
+
+    for service in to_deploy:
+        deps = set('machines:{}'.format(machine_owners[vmid].service_name)
+                   for vmid in _placement_vmids(placements(service))
+                   if vmid in machine_owners)
+        scheduler.add('app:{}'.format(service.service_name),
+                      partial(deploy_service, service),
+                      deps=sorted(deps),
+                      cost=_deploy_cost(service))
+
+    for service in applications:
+        for endpoints in service.relations:
+            rel_pair = tuple(sorted(endpoints))
+            rel_name = '{} <-> {}'.format(*rel_pair)
+            name = 'relation:{}'.format(rel_name)
+            if name in scheduler.nodes or \
+               events.RelationsAdded.is_set(rel_name):
+                continue
+            # applications outside of the bundle are already deployed
+            deps = ['app:{}'.format(ep.split(':')[0]) for ep in rel_pair]
+            deps = [dep for dep in deps if dep in scheduler.nodes]
+            scheduler.add(name,
+                          partial(juju.add_relation, rel_pair, msg_cb=msg_cb),
+                          deps=deps)
+
+    await scheduler.run()
+    for name, (started, finished) in scheduler.timings().items():
+        app.log.debug('Deploy step {} took {:.2f}s'.format(
+            name, finished - started))
     events.DeploymentComplete.set()
 
 
+def _placement_vmids(placements):
+    """ Returns the bundle machines in a list of placements
+    """
+    return [plabel.split(':')[-1] for plabel in placements or []
+            if plabel is not None]
+
+
+def _deploy_cost(service):
+    """ Rough relative time it takes to deploy an application and have
+    it ready for relations, for ordering the deploy by critical path
+
+    Subordinates have no units of their own, while principals take
+    longer the more units they have.
+    """
+    if service.subordinate:
+        return 1
+    return 2 + service.num_units
+
+
 async def pre_deploy(msg_cb):
     """ runs pre deploy script if exists
     """
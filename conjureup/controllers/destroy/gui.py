@@ -1,3 +1,5 @@
+import asyncio
+
 from conjureup import controllers, juju
 from conjureup.app_config import app
 from conjureup.telemetry import track_screen
@@ -13,10 +15,14 @@ class Destroy:
         return controllers.use('destroyconfirm').render(controller, model)
 
     def render(self):
-        models_map = {}
-        existing_controllers = juju.get_controllers()['controllers']
-        for cname, d in existing_controllers.items():
-            models_map[cname] = juju.get_models(cname)
+        app.loop.create_task(self._render())
+
+    async def _render(self):
+        existing_controllers = (await juju.aget_controllers())['controllers']
+        names = sorted(existing_controllers.keys())
+        models = await asyncio.gather(*[juju.aget_models(cname)
+                                        for cname in names])
+        models_map = dict(zip(names, models))
 
         track_screen("Destroy Controller")
         excerpt = ("Press [ENTER] on the highlighted item to destroy")
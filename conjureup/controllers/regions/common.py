@@ -1,3 +1,5 @@
+import asyncio
+
 from conjureup import controllers, juju
 from conjureup.app_config import app
 from conjureup.consts import cloud_types
@@ -12,37 +14,49 @@ class BaseRegionsController:
         self._regions = {}
         self._default_regions = {}
 
+    async def load_regions(self):
+        """ Determines the regions and default region of the current cloud
+        """
+        if app.provider.cloud in self._regions:
+            return
+
+        no_regions = app.provider.cloud_type in ['maas', 'localhost']
+        queries = [juju.aget_credentials()]
+        if not no_regions and len(app.provider.regions) == 0:
+            queries.append(juju.aget_regions(app.provider.cloud))
+        creds, *juju_regions = await asyncio.gather(*queries)
+
+        if no_regions:
+            # No regions for these providers
+            regions = []
+        elif juju_regions:
+            regions = sorted(juju_regions[0].keys())
+        else:
+            regions = app.provider.regions
+        self._regions[app.provider.cloud] = regions
+
+        default_region = None
+        if len(app.provider.regions) == 1:
+            default_region = list(app.provider.regions)[0]
+        if not default_region:
+            cloud_creds = creds.get(app.provider.cloud, {})
+            default_region = cloud_creds.get('default-region', None)
+        if not default_region:
+            try:
+                schema = load_schema(app.provider.cloud)
+                default_region = schema.default_region
+            except Exception:
+                # if we can't find a schema for this cloud,
+                # just assume no default
+                pass
+        self._default_regions[app.provider.cloud] = default_region
+
     @property
     def default_region(self):
-        if app.provider.cloud not in self._default_regions:
-            app.provider.region = None
-            if len(app.provider.regions) == 1:
-                app.provider.region = list(app.provider.regions)[0]
-            if not app.provider.region:
-                creds = juju.get_credentials().get(app.provider.cloud, {})
-                app.provider.region = creds.get('default-region', None)
-            if not app.provider.region:
-                try:
-                    schema = load_schema(app.provider.cloud)
-                    app.provider.region = schema.default_region
-                except Exception:
-                    # if we can't find a schema for this cloud,
-                    # just assume no default
-                    pass
-            self._default_regions[app.provider.cloud] = app.provider.region
         return self._default_regions[app.provider.cloud]
 
     @property
     def regions(self):
-        if app.provider.cloud not in self._regions:
-            if app.provider.cloud_type in ['maas', 'localhost']:
-                # No regions for these providers
-                regions = []
-            elif len(app.provider.regions) > 0:
-                regions = app.provider.regions
-            else:
-                regions = sorted(juju.get_regions(app.provider.cloud).keys())
-            self._regions[app.provider.cloud] = regions
         return self._regions[app.provider.cloud]
 
     def finish(self, region):
@@ -1,4 +1,5 @@
 from conjureup import controllers
+from conjureup.app_config import app
 from conjureup.ui.views.regions import RegionPickerView
 
 from . import common
@@ -6,6 +7,10 @@ from . import common
 
 class RegionsController(common.BaseRegionsController):
     def render(self, back=False):
+        app.loop.create_task(self._render(back))
+
+    async def _render(self, back):
+        await self.load_regions()
         if len(self.regions) < 2:
             if back:
                 return self.back()
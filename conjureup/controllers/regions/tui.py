@@ -6,6 +6,10 @@ from . import common
 
 class RegionsController(common.BaseRegionsController):
     def render(self):
+        app.loop.create_task(self._render())
+
+    async def _render(self):
+        await self.load_regions()
         if app.provider.region or not self.regions:
             self.finish(app.provider.region)
         elif self.default_region:
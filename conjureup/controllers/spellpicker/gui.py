@@ -1,3 +1,4 @@
+import asyncio
 import os
 
 from conjureup import controllers, utils
@@ -13,21 +14,42 @@ class SpellPickerController:
 
     def __init__(self):
         self.view = None
+        self.finished = False
 
     def finish(self, spellname):
+        self.finished = True
+        app.loop.create_task(self._finish(spellname))
+
+    async def _finish(self, spellname):
+        if app.registry_sync is not None and not app.registry_sync.done():
+            # don't copy the spell while the registry is being updated
+            app.ui.set_footer('Waiting for the spells registry to sync...')
+            await asyncio.wait([app.registry_sync])
+        spell_path = os.path.join(app.config['spells-dir'], spellname)
+        if not os.path.isdir(spell_path):
+            self.finished = False
+            app.ui.set_footer('Could not load {} from the spells '
+                              'registry'.format(spellname))
+            return
         utils.set_terminal_title("conjure-up {}".format(spellname))
         utils.set_chosen_spell(spellname,
                                os.path.join(app.argv.cache_dir,
                                             spellname))
-        download_local(os.path.join(app.config['spells-dir'],
-                                    spellname),
-                       app.config['spell-dir'])
+        download_local(spell_path, app.config['spell-dir'])
         utils.set_spell_metadata()
         StepModel.load_spell_steps()
         AddonModel.load_spell_addons()
         utils.setup_metadata_controller()
         return controllers.use('addons').render()
 
+    def reload(self):
+        """ Re-renders the spell picker with the current spells index,
+        unless a spell has already been picked
+        """
+        if self.view is None or self.finished:
+            return
+        self.render()
+
     def render(self):
         spells = []
         track_screen("Spell Picker")
@@ -44,23 +66,14 @@ class SpellPickerController:
             spell['spell-dir'] = os.path.join(app.config['spells-dir'],
                                               spell['key'])
 
-        def spellcatsorter(t):
-            cat = t[0]
-            name = t[1]['name']
-            if cat == '_unassigned_spells':
-                return ('z', name)
-            return (cat, name)
-
-        view = SpellPickerView(app,
-                               sorted(spells,
-                                      key=spellcatsorter),
-                               self.finish)
+        # the spells index is already in display order
+        self.view = SpellPickerView(app, spells, self.finish)
 
         app.ui.set_header(
             title="Spell Selection",
             excerpt="Choose from this list of recommended spells"
         )
-        app.ui.set_body(view)
+        app.ui.set_body(self.view)
 
 
 _controller_class = SpellPickerController
@@ -13,7 +13,7 @@ from ubuntui.ev import EventLoop
 from ubuntui.palette import STYLES
 
 from conjureup import __version__ as VERSION
-from conjureup import controllers, events, utils
+from conjureup import controllers, events, trace, utils
 from conjureup.app_config import app
 from conjureup.log import setup_logging
 from conjureup.ui import ConjureUI
@@ -24,6 +24,10 @@ def parse_options(argv):
     parser.add_argument('-d', '--debug', action='store_true',
                         dest='debug',
                         help='Enable debug logging.')
+    parser.add_argument('--trace', dest='trace', metavar='FILE',
+                        help='Write a timeline of the deployment to FILE '
+                        'in Chrome trace format, for chrome://tracing or '
+                        'https://ui.perfetto.dev')
     parser.add_argument('--cache-dir', dest='cache_dir',
                         help='Download directory for spells',
                         default=os.path.expanduser("~/.cache/conjure-up"))
@@ -68,6 +72,8 @@ def main():
     app.log = setup_logging(app,
                             os.path.join(opts.cache_dir, 'conjure-down.log'),
                             opts.debug)
+    if opts.trace:
+        trace.enable(opts.trace)
 
     app.env = os.environ.copy()
     app.loop = asyncio.get_event_loop()
@@ -92,3 +98,8 @@ def main():
         # asyncio.create_subprocess_exec being cleaned up during final
         # garbage collection: https://github.com/python/asyncio/issues/396
         app.loop.close()
+        try:
+            if trace.save():
+                utils.info('Trace written to {}'.format(app.argv.trace))
+        except OSError as e:
+            utils.error('Unable to write trace: {}'.format(e))
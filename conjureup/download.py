@@ -1,12 +1,26 @@
+import fcntl
+import filecmp
+import hashlib
+import json
 import os
 import shutil
+import stat
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import Enum
+from functools import partial
 from subprocess import DEVNULL, CalledProcessError
 
 import requests
 from progressbar import (
     AnimatedMarker,
     Bar,
+    FileTransferSpeed,
     Percentage,
     ProgressBar,
     UnknownLength
@@ -14,7 +28,20 @@ from progressbar import (
 
 from conjureup.app_config import app
 from conjureup.consts import UNSPECIFIED_SPELL
-from conjureup.utils import chdir, run
+from conjureup.utils import run
+
+CHUNK_SIZE = 64 * 1024
+# Parallel range requests per download, and the smallest segment worth
+# splitting off
+SEGMENTS = 4
+SEGMENT_MIN_SIZE = 1024 * 1024
+# How much of a segment to download between saves of the resume state
+STATE_SAVE_INTERVAL = 1024 * 1024
+# (connect, read) timeouts for archive requests, so a stalled server
+# can't hang start up
+HTTP_TIMEOUT = (5, 30)
+# ioctl to share a file's extents with another (reflink), from linux/fs.h
+FICLONE = 0x40049409
 
 
 class EndpointType(Enum):
@@ -52,19 +79,157 @@ def remote_exists(path):
 
 
 def download_local(src, dst):
-    """ Copies spell from local filesystem into cache
+    """ Syncs spell from local filesystem into cache
+
+    Only files that differ from the cached copy are copied, and files
+    no longer in src are removed. New files are reflinked where the
+    filesystem supports it. They are never hardlinked, since steps and
+    addons may modify the spell in place, and that mustn't change src.
+
+    Arguments:
+    src: spell directory
+    dst: cache directory for the spell
     """
     try:
-        shutil.rmtree(dst, ignore_errors=True)
-        app.log.debug("Path is local filesystem, copying {} to {}".format(
+        src_files = _snapshot(src)
+        manifest_path = _manifest_path(dst)
+        manifest = {'src': os.path.abspath(src), 'files': src_files}
+        if _load_manifest(manifest_path) == manifest and \
+                _snapshot(dst) == src_files:
+            app.log.debug("Spell {} unchanged in {}".format(src, dst))
+            return
+        app.log.debug("Path is local filesystem, syncing {} to {}".format(
             src, dst))
-        shutil.copytree(src, dst)
-        return
+        _sync_tree(src, dst, src_files)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
     except Exception as e:
         app.log.debug("Failed to download local spell: {}".format(e))
         raise e
 
 
+def _manifest_path(dst):
+    dst = os.path.abspath(dst)
+    return os.path.join(os.path.dirname(dst),
+                        '.{}.manifest.json'.format(os.path.basename(dst)))
+
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _snapshot(root):
+    """ Returns the relative path of every file and directory under root,
+    mapped to [size, mtime_ns, mode] for files and None for directories
+    """
+    if not os.path.isdir(root):
+        return {}
+    snapshot = {}
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        rel_dir = os.path.relpath(dirpath, root)
+        for name in dirnames:
+            snapshot[os.path.normpath(os.path.join(rel_dir, name))] = None
+        for name in filenames:
+            st = os.stat(os.path.join(dirpath, name))
+            snapshot[os.path.normpath(os.path.join(rel_dir, name))] = [
+                st.st_size, st.st_mtime_ns, st.st_mode]
+    return snapshot
+
+
+def _sync_tree(src, dst, src_files):
+    """ Makes dst a copy of src, only touching files that differ
+    """
+    if os.path.exists(dst) and not os.path.isdir(dst):
+        os.remove(dst)
+    dst_files = _snapshot(dst)
+
+    # deepest paths first so directories are empty by the time they go
+    for rel_path in sorted(set(dst_files) - set(src_files), reverse=True):
+        path = os.path.join(dst, rel_path)
+        if dst_files[rel_path] is None:
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    os.makedirs(dst, exist_ok=True)
+    for rel_path in sorted(src_files):
+        src_path = os.path.join(src, rel_path)
+        dst_path = os.path.join(dst, rel_path)
+        if src_files[rel_path] is None:
+            if not os.path.isdir(dst_path):
+                if os.path.exists(dst_path):
+                    os.remove(dst_path)
+                os.makedirs(dst_path)
+            continue
+        dst_stat = dst_files.get(rel_path)
+        if dst_stat == src_files[rel_path]:
+            continue
+        if dst_stat is not None and dst_stat[0] == src_files[rel_path][0] \
+                and filecmp.cmp(src_path, dst_path, shallow=False):
+            # same content, only the timestamps or mode differ
+            shutil.copystat(src_path, dst_path)
+            continue
+        if os.path.lexists(dst_path):
+            if os.path.isdir(dst_path):
+                shutil.rmtree(dst_path)
+            else:
+                os.remove(dst_path)
+        _clone_file(src_path, dst_path)
+
+
+def _clone_file(src, dst):
+    """ Reflinks src to dst where the filesystem allows it, otherwise
+    copies it
+    """
+    try:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        shutil.copystat(src, dst)
+        return
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
+
+
+class _Progress:
+    """ Thread safe progress bar showing percentage and throughput
+    """
+
+    def __init__(self, message, total_length, initial=0):
+        if total_length:
+            widgets = [message,
+                       Bar(marker='=', left='[', right=']'),
+                       ' ', Percentage(), ' ', FileTransferSpeed()]
+            maxval = total_length
+        else:
+            widgets = [message, AnimatedMarker(), ' ', FileTransferSpeed()]
+            maxval = UnknownLength
+        self.progress_bar = ProgressBar(widgets=widgets, maxval=maxval)
+        self.total_read = initial
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.progress_bar.start()
+        self.progress_bar.update(self.total_read)
+
+    def update(self, length):
+        with self.lock:
+            self.total_read += length
+            try:
+                self.progress_bar.update(self.total_read)
+            except ValueError as e:
+                app.log.exception(
+                    "Failed on total_read({}) "
+                    "is not between 0-100: {}".format(self.total_read, e))
+
+    def finish(self):
+        self.progress_bar.finish()
+
+
 def download_requests_stream(request_stream, destination, message=None):
     """ This is a facility to download a request with nice progress bars.
     """
@@ -72,59 +237,325 @@ def download_requests_stream(request_stream, destination, message=None):
         message = 'Downloading {!r}'.format(os.path.basename(destination))
 
     total_length = int(request_stream.headers.get('Content-Length', '0'))
-    if total_length:
-        progress_bar = ProgressBar(
-            widgets=[message,
-                     Bar(marker='=', left='[', right=']'),
-                     ' ', Percentage()],
-            maxval=total_length)
-    else:
-        progress_bar = ProgressBar(
-            widgets=[message, AnimatedMarker()],
-            maxval=UnknownLength)
-
-    total_read = 0
-    progress_bar.start()
+    progress = _Progress(message, total_length)
+    progress.start()
     with open(destination, 'wb') as destination_file:
-        for buf in request_stream.iter_content(1024):
+        for buf in request_stream.iter_content(CHUNK_SIZE):
             destination_file.write(buf)
-            total_read += len(buf)
-            try:
-                progress_bar.update(total_read)
-            except ValueError as e:
-                app.log.exception(
-                    "Failed on total_read({}) "
-                    "is not between 0-100: {}".format(total_read, e))
-    progress_bar.finish()
+            progress.update(len(buf))
+    progress.finish()
 
 
-def download(src, dst, purge_top_level=True):
+def download(src, dst, purge_top_level=True, checksum=None):
     """ Download and extract archive
 
+    Servers that accept range requests are downloaded in parallel
+    segments, and an interrupted download is resumed on the next run if
+    the server sends an ETag or Last-Modified header to check it against.
+
     Arguments:
     src: path to archive
     dst: directory to change to before extract, this directory must already
          exist.
     purge_top_level: purge the toplevel directory and shift all contents up
                      during unzip.
+    checksum: optional '<algorithm>:<hexdigest>' the archive must match,
+              eg. 'sha256:9f86d0...'
     """
     try:
         shutil.rmtree(dst, ignore_errors=True)
         os.makedirs(dst)
-        request = requests.get(src, stream=True)
-        tmpfile = os.path.join(os.environ.get('TEMPDIR', '/tmp'),
-                               'temp.zip')
-        download_requests_stream(request, tmpfile)
-        bsdtar_cmd = "bsdtar -xf {} ".format(tmpfile)
-        if purge_top_level:
-            bsdtar_cmd += "-s'|[^/]*/||' "
-        bsdtar_cmd += "-C {}".format(dst)
-        app.log.debug("Extracting spell: {}".format(bsdtar_cmd))
-        run(bsdtar_cmd, shell=True, check=True, env=app.env)
-    except CalledProcessError as e:
+        with _partial_download(src) as (part_path, state_path):
+            _fetch(src, part_path, state_path)
+            if checksum:
+                _verify_checksum(src, part_path, checksum)
+            app.log.debug("Extracting spell {} to {}".format(src, dst))
+            extract(part_path, dst, purge_top_level)
+            os.remove(part_path)
+    except (requests.exceptions.RequestException, OSError,
+            zipfile.BadZipFile, tarfile.TarError) as e:
         raise Exception("Unable to download {}: {}".format(src, e))
 
 
+@contextmanager
+def _partial_download(src):
+    """ Locks and returns the paths of the partial download of src
+
+    The paths are stable so interrupted downloads can be resumed, unless
+    another process is already downloading src, in which case unique
+    paths are used and removed afterwards.
+    """
+    tmpdir = os.environ.get('TEMPDIR', tempfile.gettempdir())
+    name = 'conjure-up-{}'.format(
+        hashlib.sha1(src.encode('utf8')).hexdigest())
+    lock_path = os.path.join(tmpdir, name + '.lock')
+    lock_file = _lock(lock_path)
+    if lock_file is not None:
+        part_path = os.path.join(tmpdir, name + '.part')
+    else:
+        fd, part_path = tempfile.mkstemp(prefix=name + '-',
+                                         suffix='.part', dir=tmpdir)
+        os.close(fd)
+    state_path = part_path + '.json'
+    try:
+        yield part_path, state_path
+    finally:
+        if lock_file is None:
+            paths = [part_path, state_path]
+        elif not os.path.exists(part_path):
+            paths = [state_path]
+        else:
+            paths = []
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        if lock_file is not None:
+            # removed while still locked, so no one else can lock it
+            # and find it gone from under them
+            os.remove(lock_path)
+            lock_file.close()
+
+
+def _lock(lock_path):
+    """ Takes an exclusive lock on lock_path without waiting
+
+    Returns:
+    the open lock file, or None if someone else holds the lock
+    """
+    while True:
+        lock_file = open(lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == \
+                    os.stat(lock_path).st_ino:
+                return lock_file
+        except OSError:
+            pass
+        # the holder removed the file between our open and flock
+        lock_file.close()
+
+
+def _fetch(src, part_path, state_path):
+    """ Downloads src into part_path, resuming from the segments recorded
+    in state_path if the remote archive hasn't changed
+    """
+    session = requests.Session()
+    head = session.head(src, allow_redirects=True, timeout=HTTP_TIMEOUT)
+    url = head.url if head.ok else src
+    total_length = int(head.headers.get('Content-Length', '0'))
+    validator = head.headers.get('ETag', head.headers.get('Last-Modified'))
+    ranges = (head.ok and head.headers.get('Accept-Ranges') == 'bytes' and
+              total_length > 0)
+
+    message = 'Downloading {!r}'.format(os.path.basename(src))
+    if not ranges:
+        app.log.debug("Range requests not supported by {}".format(url))
+        resp = session.get(url, stream=True, timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+        download_requests_stream(resp, part_path, message)
+        return
+
+    state = None
+    if os.path.exists(state_path) and os.path.exists(part_path):
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except ValueError:
+            state = None
+    # without a validator there's no telling whether the partial
+    # download still matches the remote archive, so start over
+    if state is None or validator is None or state['url'] != url or \
+            state['length'] != total_length or \
+            state['validator'] != validator:
+        segment_size = max(SEGMENT_MIN_SIZE,
+                           -(-total_length // SEGMENTS))
+        state = {
+            'url': url,
+            'length': total_length,
+            'validator': validator,
+            # [next byte to fetch, end byte (exclusive)] per segment
+            'segments': [[start, min(start + segment_size, total_length)]
+                         for start in range(0, total_length, segment_size)],
+        }
+        with open(part_path, 'wb') as f:
+            f.truncate(total_length)
+    else:
+        app.log.debug("Resuming download of {}".format(url))
+
+    remaining = sum(end - start for start, end in state['segments'])
+    progress = _Progress(message, total_length, total_length - remaining)
+    state_lock = threading.Lock()
+
+    def save_state():
+        with state_lock:
+            with open(state_path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(state_path + '.tmp', state_path)
+
+    def fetch_segment(segment):
+        if segment[0] >= segment[1]:
+            return
+        headers = {'Range': 'bytes={}-{}'.format(segment[0], segment[1] - 1)}
+        if validator:
+            headers['If-Range'] = validator
+        resp = session.get(url, headers=headers, stream=True,
+                           timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            raise requests.exceptions.RequestException(
+                "{} changed during download".format(url))
+        unsaved = 0
+        with open(part_path, 'r+b') as f:
+            f.seek(segment[0])
+            for buf in resp.iter_content(CHUNK_SIZE):
+                buf = buf[:segment[1] - segment[0]]
+                f.write(buf)
+                segment[0] += len(buf)
+                progress.update(len(buf))
+                unsaved += len(buf)
+                if unsaved >= STATE_SAVE_INTERVAL:
+                    f.flush()
+                    save_state()
+                    unsaved = 0
+        if segment[0] < segment[1]:
+            raise requests.exceptions.RequestException(
+                "Incomplete download of {}".format(url))
+
+    progress.start()
+    try:
+        with ThreadPoolExecutor(max_workers=SEGMENTS) as executor:
+            list(executor.map(fetch_segment, state['segments']))
+    finally:
+        save_state()
+    progress.finish()
+    os.remove(state_path)
+
+
+def _verify_checksum(src, path, checksum):
+    algorithm, _, expected = checksum.partition(':')
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for buf in iter(partial(f.read, CHUNK_SIZE), b''):
+            digest.update(buf)
+    if digest.hexdigest() != expected.lower():
+        os.remove(path)
+        raise Exception("Checksum mismatch for {}: expected {}, got {}".format(
+            src, expected, digest.hexdigest()))
+
+
+def _member_path(name, purge_top_level):
+    """ Returns the relative path to extract an archive member to, or None
+    if it should be skipped
+    """
+    parts = [p for p in name.split('/') if p not in ('', '.')]
+    if purge_top_level:
+        parts = parts[1:]
+    if not parts or '..' in parts:
+        return None
+    return os.path.join(*parts)
+
+
+def _inside(root, path):
+    return os.path.commonpath([root, path]) == root
+
+
+def _extract_target(root, rel_path, link=None):
+    """ Returns the path to extract an archive member to, or None if it,
+    or the target of the symlink it is, would end up outside root
+
+    Paths are resolved against what has been extracted so far, so
+    members can't escape through a chain of earlier symlinks.
+
+    Arguments:
+    root: real path of the directory being extracted into
+    rel_path: path of the member relative to root
+    link: target of the member if it is a symlink
+    """
+    parent = os.path.realpath(os.path.join(root, os.path.dirname(rel_path)))
+    if not _inside(root, parent):
+        return None
+    if link is not None and (os.path.isabs(link) or not _inside(
+            root, os.path.realpath(os.path.join(parent, link)))):
+        return None
+    target = os.path.join(parent, os.path.basename(rel_path))
+    if os.path.islink(target) or os.path.isfile(target):
+        # never write through an earlier member
+        os.remove(target)
+    return target
+
+
+def _write_member(target, src, mode, link=None):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if link is not None:
+        os.symlink(link, target)
+        return
+    with src() as src_file, open(target, 'wb') as dst_file:
+        shutil.copyfileobj(src_file, dst_file, CHUNK_SIZE)
+    if mode & 0o777:
+        os.chmod(target, mode & 0o777)
+
+
+def extract(archive, dst, purge_top_level=True):
+    """ Extracts a zip or tar archive, keeping file modes and symlinks
+    that point inside dst
+
+    Members that would be written outside dst, directly or through
+    symlinks, are skipped.
+
+    Arguments:
+    archive: path to archive
+    dst: directory to extract into
+    purge_top_level: purge the toplevel directory and shift all contents up
+    """
+    root = os.path.realpath(dst)
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                rel_path = _member_path(info.filename, purge_top_level)
+                if rel_path is None:
+                    continue
+                mode = info.external_attr >> 16
+                link = None
+                if stat.S_ISLNK(mode):
+                    link = zf.read(info).decode('utf8')
+                target = _extract_target(root, rel_path, link)
+                if target is None:
+                    app.log.debug("Skipping {}, outside of {}".format(
+                        info.filename, dst))
+                elif info.filename.endswith('/'):
+                    os.makedirs(target, exist_ok=True)
+                else:
+                    _write_member(target, partial(zf.open, info), mode, link)
+        return
+
+    with tarfile.open(archive) as tf:
+        dirs = []
+        for member in tf:
+            rel_path = _member_path(member.name, purge_top_level)
+            if rel_path is None or not (member.isfile() or member.isdir() or
+                                        member.issym()):
+                continue
+            link = member.linkname if member.issym() else None
+            target = _extract_target(root, rel_path, link)
+            if target is None:
+                app.log.debug("Skipping {}, outside of {}".format(
+                    member.name, dst))
+            elif member.isdir():
+                os.makedirs(target, exist_ok=True)
+                dirs.append((target, member.mode))
+            else:
+                _write_member(target, partial(tf.extractfile, member),
+                              member.mode, link)
+        # directories last, in case they aren't writable
+        for target, mode in dirs:
+            if mode & 0o777:
+                os.chmod(target, mode & 0o777)
+
+
 def get_remote_url(path):
     """ Cycles through known locations to autodetect where to download
     spells from
@@ -156,39 +587,98 @@ def get_remote_url(path):
     return None
 
 
-def download_or_sync_registry(remote_registry, spells_dir, branch='master'):
+def registry_sync_due(remote_registry, spells_dir, branch, interval):
+    """ Checks whether the spells registry should be synced, based on
+    when it was last synced successfully
+
+    Arguments:
+    remote_registry: git location of spells registry
+    spells_dir: cache location of local spells directory
+    branch: registry branch in use
+    interval: seconds a sync stays fresh for
+
+    Returns:
+    True if the registry is missing or stale
+    """
+    if not os.path.exists(spells_dir):
+        return True
+    try:
+        with open(_registry_stamp_path(spells_dir)) as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return True
+    if stamp.get('registry') != remote_registry or \
+            stamp.get('branch') != branch:
+        return True
+    return time.time() - stamp.get('time', 0) >= interval
+
+
+def _registry_stamp_path(spells_dir):
+    return os.path.normpath(spells_dir) + '.synced'
+
+
+def _replace_registry(spells_dir, clone):
+    """ Clones a fresh copy of the registry next to spells_dir and swaps it
+    in, leaving spells_dir as it was if the clone fails
+    """
+    parent = os.path.dirname(os.path.abspath(spells_dir))
+    fresh = tempfile.mkdtemp(prefix='.spells-', dir=parent)
+    old = fresh + '.old'
+    try:
+        clone(fresh)
+        os.rename(spells_dir, old)
+        os.rename(fresh, spells_dir)
+    finally:
+        shutil.rmtree(fresh, ignore_errors=True)
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def download_or_sync_registry(remote_registry, spells_dir, branch='master',
+                              timeout=None):
     """ If first time run this git clones the spell registry, otherwise
-    will pull the latest spells down.
+    will fetch the latest spells down.
 
     To specify a different branch to use you must set the environment variable
     CONJUREUP_REGISTRY_BRANCH=<branchname>. This should be used for testing
     new spells before they make it into the master branch.
 
+    Runs git with its working directory set rather than changing ours, so
+    it is safe to call from a background thread. An existing registry is
+    only replaced once a fresh copy has been cloned, so it stays usable
+    when the sync fails, eg. offline.
+
     Arguments:
     remote_registry: git location of spells registry
     spells_dir: cache location of local spells directory
     branch: switch to branch
+    timeout: seconds to allow the fetch to take, raises
+             subprocess.TimeoutExpired when exceeded
 
     """
-    def clone():
-        run("git clone -q --depth 1 --no-single-branch {} {}".format(
-            remote_registry, spells_dir),
-            shell=True, check=True, stdout=DEVNULL, stderr=DEVNULL)
+    def clone(dest):
+        run(['git', 'clone', '-q', '--depth', '1', '--no-single-branch',
+             remote_registry, dest],
+            check=True, stdout=DEVNULL, stderr=DEVNULL)
+        run(['git', 'checkout', '-q', branch], check=True, cwd=dest,
+            stdout=DEVNULL, stderr=DEVNULL)
+
+    def git(*args, **kwargs):
+        run(['git'] + list(args), check=True, cwd=spells_dir,
+            stdout=DEVNULL, stderr=DEVNULL, **kwargs)
 
     if not os.path.exists(spells_dir):
-        clone()
-    try:
-        with chdir(spells_dir):
-            run("git reset --hard HEAD", shell=True, check=True,
-                stdout=DEVNULL, stderr=DEVNULL)
-
-            run("git checkout -q {}".format(branch),
-                shell=True, check=True, stdout=DEVNULL, stderr=DEVNULL)
-
-            run("git pull", shell=True, check=True,
-                stdout=DEVNULL, stderr=DEVNULL)
-    except CalledProcessError:
-        app.log.debug(
-            "Failed to update spells registry, re-pulling fresh copy.")
-        shutil.rmtree(spells_dir)
-        clone()
+        clone(spells_dir)
+    else:
+        try:
+            git('fetch', '-q', '--depth', '1', 'origin', branch,
+                timeout=timeout)
+            git('checkout', '-q', '-f', '-B', branch, 'FETCH_HEAD')
+        except CalledProcessError:
+            app.log.debug(
+                "Failed to update spells registry, re-pulling fresh copy.")
+            _replace_registry(spells_dir, clone)
+
+    with open(_registry_stamp_path(spells_dir), 'w') as f:
+        json.dump({'registry': remote_registry,
+                   'branch': branch,
+                   'time': time.time()}, f)
@@ -1,16 +1,81 @@
 import asyncio
 import errno
-import inspect
+import sys
+import time
+from collections import deque
 from concurrent.futures import CancelledError
 from pathlib import Path
 
-from ubuntui.ev import EventLoop
-from urwid import ExitMainLoop
-
-from conjureup import utils
+from conjureup import trace, utils
 from conjureup.app_config import app
+from conjureup.async import shutdown as shutdown_queues
 from conjureup.telemetry import track_exception
-from conjureup.ui.views.lxdsetup import LXDSetupViewError
+
+# Event transitions are recorded into a ring buffer rather than logged
+# as they happen, since a deploy fires thousands of them. The buffer is
+# written to the log on errors and, when tracing, on shutdown.
+TRACE_SIZE = 4096
+_trace = deque(maxlen=TRACE_SIZE)
+_tracing = False
+_trace_epoch = time.monotonic()
+_event_methods = ('set', 'clear', 'wait')
+
+
+def enable_tracing(size=TRACE_SIZE):
+    """ Records the caller of each event transition as well
+
+    Arguments:
+    size: number of transitions to keep
+    """
+    global _trace, _tracing
+    _trace = deque(_trace, maxlen=size)
+    _tracing = True
+
+
+def _caller():
+    """ Returns the code and line number of the frame that called into
+    an event, skipping the event methods themselves
+    """
+    frame = sys._getframe(3)
+    while (frame.f_code.co_filename == __file__ and
+           frame.f_code.co_name in _event_methods):
+        frame = frame.f_back
+    return frame.f_code, frame.f_lineno
+
+
+def _format_caller(caller):
+    code, lineno = caller
+    base_path = Path(__file__).parent.parent
+    try:
+        filename = Path(code.co_filename).relative_to(base_path)
+    except ValueError:
+        filename = Path(code.co_filename)
+    return '{}:{} in {}'.format(filename, lineno, code.co_name)
+
+
+def get_trace():
+    """ Returns the recorded event transitions, oldest first
+
+    Returns:
+    list of (seconds since start, event, action, task id, caller) tuples,
+    caller is None unless tracing is enabled
+    """
+    return list(_trace)
+
+
+def dump_trace(reason):
+    """ Writes the recorded event transitions to the log
+    """
+    entries = get_trace()
+    app.log.debug('Event trace ({}), last {} transitions:'.format(
+        reason, len(entries)))
+    for elapsed, name, action, task_id, caller in entries:
+        line = '  {:10.3f} {} {}'.format(elapsed, action, name)
+        if task_id is not None:
+            line += ' in task {:x}'.format(task_id)
+        if caller is not None:
+            line += ' at {}'.format(_format_caller(caller))
+        app.log.debug(line)
 
 
 class Event(asyncio.Event):
@@ -19,50 +84,30 @@ class Event(asyncio.Event):
         super().__init__()
 
     def _log(self, action):
-        base_path = Path(__file__).parent.parent
-        frame = inspect.stack()[2]
-        event_methods = ('set', 'clear', 'wait')
-        if frame.filename == __file__ and frame.function in event_methods:
-            # NamedEvent wraps these methods and we want the original
-            # caller, so we need to jump up an extra stack frame
-            frame = inspect.stack()[3]
-        task = getattr(asyncio.Task.current_task(), '_coro', '')
-        try:
-            frame_file = Path(frame.filename).relative_to(base_path)
-        except ValueError:
-            frame_file = Path(frame.filename)
-        frame_lineno = frame.lineno
-        if task:
-            code = task.cr_frame.f_code
-            task_name = code.co_name
-            try:
-                task_file = Path(code.co_filename).relative_to(base_path)
-            except ValueError:
-                task_file = Path(code.co_filename)
-            task_lineno = task.cr_frame.f_lineno
-            if task_file != frame_file or task_lineno != frame_lineno:
-                task = ' in task {} at {}:{}'.format(task_name,
-                                                     task_file,
-                                                     task_lineno)
-            else:
-                task = ''
-        app.log.debug('{} {} at {}:{}{}'.format(action,
-                                                self._name,
-                                                frame_file,
-                                                frame_lineno,
-                                                task))
+        task = asyncio.Task.current_task()
+        _trace.append((time.monotonic() - _trace_epoch,
+                       self._name,
+                       action,
+                       None if task is None else id(task),
+                       _caller() if _tracing else None))
 
     def set(self):
         self._log('Setting')
+        trace.instant('event', 'set {}'.format(self._name))
         super().set()
 
     def clear(self):
         self._log('Clearing')
+        trace.instant('event', 'clear {}'.format(self._name))
         super().clear()
 
     async def wait(self):
         self._log('Awaiting')
-        await super().wait()
+        if self.is_set():
+            await super().wait()
+        else:
+            with trace.span('event', 'wait {}'.format(self._name)):
+                await super().wait()
         self._log('Received')
 
 
@@ -109,6 +154,7 @@ ModelConnected = Event('ModelConnected')
 PreDeployComplete = Event('PreDeployComplete')
 MachinePending = NamedEvent('MachinePending')
 MachineCreated = NamedEvent('MachineCreated')
+MachineFailed = NamedEvent('MachineFailed')
 AppMachinesCreated = NamedEvent('AppMachinesCreated')
 AppDeployed = NamedEvent('AppDeployed')
 PendingRelations = NamedEvent('PendingRelations')
@@ -119,16 +165,24 @@ PostDeployComplete = Event('PostDeployComplete')
 LXDAvailable = Event('LXDAvailable')
 
 
+def _is_lxd_setup_error(exc):
+    # the UI stack is only imported when it is in use
+    from conjureup.ui.views.lxdsetup import LXDSetupViewError
+    return isinstance(exc, LXDSetupViewError)
+
+
 # Keep a list of exceptions we know that shouldn't be logged
 # into sentry.
 NOTRACK_EXCEPTIONS = [
     lambda exc: isinstance(exc, OSError) and exc.errno == errno.ENOSPC,
     lambda exc: isinstance(exc, utils.SudoError),
-    lambda exc: isinstance(exc, LXDSetupViewError)
+    _is_lxd_setup_error
 ]
 
 
 def unhandled_input(key):
+    from ubuntui.ev import EventLoop
+
     if key in ['q', 'Q']:
         Shutdown.set()
     if key in ['R']:
@@ -136,6 +190,8 @@ def unhandled_input(key):
 
 
 def handle_exception(loop, context):
+    from urwid import ExitMainLoop
+
     exc = context.get('exception')
     if exc is None or isinstance(exc, CancelledError):
         return  # not an error, cleanup message
@@ -157,6 +213,7 @@ def handle_exception(loop, context):
     if 'future' in context:
         msg += ' in {}'.format(context['future'])
     app.log.exception(msg, exc_info=exc)
+    dump_trace('unhandled exception')
 
     if app.headless:
         msg = str(exc)
@@ -190,6 +247,7 @@ async def shutdown_watcher():
             app.log.info('Disconnected')
 
         if not app.headless:
+            from ubuntui.ev import EventLoop
             EventLoop.remove_alarms()
 
         for task in asyncio.Task.all_tasks(app.loop):
@@ -200,6 +258,11 @@ async def shutdown_watcher():
                 app.log.debug('Cancelling pending task: {}'.format(task))
                 task.cancel()
         await asyncio.sleep(0.1)  # give tasks a chance to see the cancel
+
+        # stop the job queues, logging their metrics
+        shutdown_queues()
+        if _tracing:
+            dump_trace('shutdown')
     except Exception as e:
         app.log.exception('Error in cleanup code: {}'.format(e))
     app.loop.stop()
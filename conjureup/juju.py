@@ -4,28 +4,146 @@ import asyncio
 import json
 import logging
 import os
-from concurrent import futures
+import time
+from copy import deepcopy
+from functools import wraps
 from pathlib import Path
 from subprocess import DEVNULL, PIPE, CalledProcessError
 from tempfile import NamedTemporaryFile
 
 import yaml
 from bundleplacer.charmstore_api import CharmStoreID
-from juju.model import Model
 
-from conjureup import consts, events, utils
+from conjureup import charm, consts, events, trace, utils
 from conjureup.app_config import app
+from conjureup.units import human_to_mb
 from conjureup.utils import is_linux, juju_path, run, spew
 
 JUJU_ASYNC_QUEUE = "juju-async-queue"
 
 PENDING_DEPLOYS = 0
 
+# Annotation recording the spell and bundle machine a Juju machine was
+# added for, so an interrupted deploy only reuses its own machines
+MACHINE_ANNOTATION = 'conjure-up-machine'
+
+# Results of read-only Juju queries keyed by query and arguments, along
+# with the state of the Juju config files they were derived from.
+_query_cache = {}
+
 
 class ControllerNotFoundException(Exception):
     "An error when a controller can't be found in juju's config"
 
 
+def _config_stamp(names):
+    """ Returns the (mtime, size) of each named Juju config file, or None
+    for files which don't exist
+    """
+    stamp = []
+    for name in names:
+        try:
+            st = os.stat(os.path.join(juju_path(), "{}.yaml".format(name)))
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def cached_query(*config_names, key=None):
+    """ Caches the result of a read-only Juju query
+
+    The result is reused until one of the named Juju config files changes
+    on disk or invalidate_cache() is called. Callers get their own copy of
+    the result so they are free to modify it. Works for both plain
+    functions and coroutines.
+
+    Arguments:
+    config_names: Juju config files (without extension) the query reads
+    key: name to cache results under, allows the sync and async versions
+         of a query to share results; defaults to the function name
+    """
+    def decorator(func):
+        query = key or func.__name__
+
+        def lookup(args, kwargs):
+            cache_key = (query, args, tuple(sorted(kwargs.items())))
+            return cache_key, _config_stamp(config_names)
+
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                cache_key, stamp = lookup(args, kwargs)
+                cached = _query_cache.get(cache_key)
+                if cached is None or cached[0] != stamp:
+                    cached = (stamp, await func(*args, **kwargs))
+                    _query_cache[cache_key] = cached
+                return deepcopy(cached[1])
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            cache_key, stamp = lookup(args, kwargs)
+            cached = _query_cache.get(cache_key)
+            if cached is None or cached[0] != stamp:
+                cached = (stamp, func(*args, **kwargs))
+                _query_cache[cache_key] = cached
+            return deepcopy(cached[1])
+        return wrapper
+    return decorator
+
+
+def invalidate_cache():
+    """ Drops all cached Juju query results
+
+    Should be called after anything that changes Juju's configuration.
+    """
+    _query_cache.clear()
+
+
+def _juju(*args):
+    """ Runs a read-only juju command
+
+    Returns:
+    tuple of (returncode, stdout, stderr)
+    """
+    sh = run(['juju'] + list(args), stdout=PIPE, stderr=PIPE)
+    return (sh.returncode,
+            sh.stdout.decode('utf8'),
+            sh.stderr.decode('utf8'))
+
+
+def _juju_query(reader, args, parse):
+    """ Answers a query from Juju's config files, falling back to the CLI
+
+    Arguments:
+    reader: callable reading the answer from Juju's config files, or None
+    args: juju command arguments to fall back to
+    parse: callable turning the (returncode, stdout, stderr) of the juju
+           command into the answer
+
+    Returns:
+    query result
+    """
+    if reader is not None:
+        try:
+            return reader()
+        except JujuConfigError as e:
+            app.log.debug("Falling back to juju {}: {}".format(args[0], e))
+    return parse(*_juju(*args))
+
+
+async def _ajuju_query(reader, args, parse):
+    """ Async version of _juju_query
+    """
+    if reader is not None:
+        try:
+            return reader()
+        except JujuConfigError as e:
+            app.log.debug("Falling back to juju {}: {}".format(args[0], e))
+    return parse(*await utils.arun(['juju'] + list(args)))
+
+
 def read_config(name):
     """ Reads a juju config file
 
@@ -41,6 +159,185 @@ def read_config(name):
     return yaml.safe_load(open(abs_path))
 
 
+class JujuConfigError(Exception):
+    "Juju's config files are missing or in a format we don't understand"
+
+
+# The localhost cloud is built into Juju and never written to clouds.yaml
+BUILTIN_CLOUDS = {
+    'localhost': {
+        'defined': 'built-in',
+        'type': 'lxd',
+        'description': 'LXD Container Hypervisor',
+        'auth-types': ['certificate'],
+        'regions': {'localhost': {}},
+    }
+}
+
+
+def _read_config_section(name, key):
+    """ Reads a top-level mapping out of a Juju config file
+
+    Arguments:
+    name: filename without extension
+    key: top-level key holding the mapping
+
+    Returns:
+    mapping stored under key, or raises JujuConfigError if the file is
+    missing or not structured as expected
+    """
+    try:
+        data = read_config(name)
+    except Exception as e:
+        raise JujuConfigError(str(e))
+    if not isinstance(data, dict):
+        raise JujuConfigError("Unknown format for {}.yaml".format(name))
+    section = data.get(key) or {}
+    if not isinstance(section, dict) or \
+       not all(isinstance(v, dict) for v in section.values()):
+        raise JujuConfigError("Unknown format for {}.yaml".format(name))
+    return data, section
+
+
+def read_controllers():
+    """ Reads known controllers from Juju's config files
+
+    Returns:
+    Dictionary in the same format as `juju list-controllers`
+    """
+    data, controllers = _read_config_section('controllers', 'controllers')
+    try:
+        _, accounts = _read_config_section('accounts', 'controllers')
+    except JujuConfigError:
+        accounts = {}
+    try:
+        _, models = _read_config_section('models', 'controllers')
+    except JujuConfigError:
+        models = {}
+
+    result = {}
+    for name, details in controllers.items():
+        account = accounts.get(name, {})
+        user = account.get('user')
+        api_endpoints = details.get('api-endpoints') or []
+        controller = {
+            'uuid': details.get('uuid'),
+            'api-endpoints': api_endpoints,
+            'ca-cert': details.get('ca-cert'),
+            'cloud': details.get('cloud'),
+        }
+        current_model = models.get(name, {}).get('current-model')
+        if current_model:
+            owner, _, short_name = current_model.rpartition('/')
+            if owner == user:
+                current_model = short_name
+            controller['current-model'] = current_model
+        if user:
+            controller['user'] = user
+        if account.get('last-known-access'):
+            controller['access'] = account['last-known-access']
+        if api_endpoints:
+            controller['recent-server'] = api_endpoints[0]
+        for key in ['region', 'agent-version', 'model-count',
+                    'machine-count']:
+            if details.get(key):
+                controller[key] = details[key]
+        if 'controller-machine-count' in details:
+            controller['controller-machines'] = {
+                'active': details.get('active-controller-machine-count', 0),
+                'total': details['controller-machine-count'],
+            }
+        result[name] = controller
+
+    env = {'controllers': result}
+    if data.get('current-controller'):
+        env['current-controller'] = data['current-controller']
+    return env
+
+
+def read_clouds():
+    """ Reads known clouds from Juju's config files
+
+    Public clouds are only known to us once Juju has written
+    public-clouds.yaml; until then their definitions are compiled into
+    the Juju binary.
+
+    Returns:
+    Dictionary in the same format as `juju list-clouds`
+    """
+    clouds = {}
+    for defined, filename in [('public', 'public-clouds'),
+                              ('local', 'clouds')]:
+        try:
+            _, section = _read_config_section(filename, 'clouds')
+        except JujuConfigError:
+            if defined == 'public':
+                raise
+            section = {}
+        for name, cloud in section.items():
+            if not isinstance(cloud.get('regions') or {}, dict):
+                raise JujuConfigError(
+                    "Unknown format for {}.yaml".format(filename))
+            if defined == 'public' and name in BUILTIN_CLOUDS:
+                continue
+            clouds[name] = dict(cloud, defined=defined)
+    for name, cloud in BUILTIN_CLOUDS.items():
+        clouds.setdefault(name, deepcopy(cloud))
+    return clouds
+
+
+def read_credentials():
+    """ Reads known credentials from Juju's config files
+
+    Returns:
+    Dictionary in the same format as `juju list-credentials --show-secrets`
+    """
+    _, credentials = _read_config_section('credentials', 'credentials')
+    return credentials
+
+
+def read_models(controller):
+    """ Reads known models for a controller from Juju's config files
+
+    Only the details Juju stores locally are available; anything which
+    needs the controller (status, life, machines) requires `get_models`.
+
+    Arguments:
+    controller: existing controller to get models for
+
+    Returns:
+    Dictionary in the same format as `juju list-models`
+    """
+    _, controllers = _read_config_section('controllers', 'controllers')
+    _, models = _read_config_section('models', 'controllers')
+    if controller not in controllers or controller not in models:
+        raise JujuConfigError(
+            "Unknown controller in models.yaml: {}".format(controller))
+
+    controller_models = models[controller].get('models') or {}
+    result = []
+    for name in sorted(controller_models.keys()):
+        details = controller_models[name]
+        owner, _, short_name = name.rpartition('/')
+        model = {
+            'name': name,
+            'short-name': short_name,
+            'model-uuid': details.get('uuid'),
+            'controller-uuid': controllers[controller].get('uuid'),
+            'controller-name': controller,
+            'owner': owner,
+        }
+        if details.get('type'):
+            model['type'] = details['type']
+        result.append(model)
+
+    env = {'models': result}
+    current_model = models[controller].get('current-model')
+    if current_model:
+        env['current-model'] = current_model
+    return env
+
+
 def get_bootstrap_config(controller_name):
     try:
         bootstrap_config = read_config("bootstrap-config")
@@ -76,10 +373,7 @@ def get_controller(id):
     Arguments:
     id: controller id
     """
-    if 'controllers' in get_controllers() \
-       and id in get_controllers()['controllers']:
-        return get_controllers()['controllers'][id]
-    return None
+    return get_controllers().get('controllers', {}).get(id, None)
 
 
 def get_controller_in_cloud(cloud):
@@ -98,6 +392,7 @@ def get_controller_in_cloud(cloud):
     return None
 
 
+@trace.traced('juju')
 async def login():
     """ Login to Juju API server
     """
@@ -110,6 +405,9 @@ async def login():
     if app.provider.model is None:
         raise Exception("Tried to login with no current model set.")
 
+    # libjuju is slow to import and only needed once a model is in use
+    from juju.model import Model
+
     app.juju.client = Model(app.loop)
     model_name = '{}:{}'.format(app.provider.controller,
                                 app.provider.model)
@@ -123,6 +421,8 @@ async def login():
     app.log.info('Connected')
 
 
+@trace.traced('juju', name=lambda controller, cloud, *args, **kwargs:
+              'bootstrap {}'.format(cloud))
 async def bootstrap(controller, cloud, model='conjure-up', series="xenial",
                     credential=None):
     """ Performs juju bootstrap
@@ -187,6 +487,7 @@ async def bootstrap(controller, cloud, model='conjure-up', series="xenial",
             app.log.debug('waiting for proc')
             await proc.wait()
             app.log.debug('proc done')
+    invalidate_cache()
     if proc.returncode < 0:
         raise Exception('Bootstrap killed by user: {}'.format(
             proc.returncode))
@@ -206,6 +507,7 @@ def has_jaas_auth():
     return False
 
 
+@trace.traced('juju')
 async def register_controller(name, endpoint, email, password, twofa,
                               timeout=30, fail_cb=None, timeout_cb=None):
     app.log.info('Registering controller {}'.format(name))
@@ -218,6 +520,7 @@ async def register_controller(name, endpoint, email, password, twofa,
                          for f in [email, password, twofa])
         stdout, stderr = await asyncio.wait_for(proc.communicate(stdin),
                                                 timeout)
+        invalidate_cache()
         stdout = stdout.decode('utf8')
         stderr = stderr.decode('utf8')
 
@@ -245,6 +548,7 @@ async def register_controller(name, endpoint, email, password, twofa,
     return True
 
 
+@trace.traced('juju')
 async def model_available(name):
     """ Checks if juju is available
 
@@ -266,6 +570,8 @@ def autoload_credentials():
         run('juju autoload-credentials', shell=True, check=True)
     except CalledProcessError:
         return False
+    finally:
+        invalidate_cache()
     return True
 
 
@@ -295,10 +601,11 @@ def get_credential(cloud, cred_name=None):
         return None
 
 
+@cached_query('credentials', key='credentials')
 def get_credentials(secrets=True):
     """ List credentials
 
-    This will fallback to reading the credentials file directly
+    Credentials are read from Juju's credentials file when possible
 
     Arguments:
     secrets: True/False whether to show secrets (ie password)
@@ -306,22 +613,32 @@ def get_credentials(secrets=True):
     Returns:
     List of credentials
     """
-    cmd = 'juju list-credentials --format yaml'
+    return _juju_query(*_credentials_query(secrets))
+
+
+@cached_query('credentials', key='credentials')
+async def aget_credentials(secrets=True):
+    """ Async version of get_credentials
+    """
+    return await _ajuju_query(*_credentials_query(secrets))
+
+
+def _credentials_query(secrets):
+    args = ['list-credentials', '--format', 'yaml']
     if secrets:
-        cmd += ' --show-secrets'
-    sh = run(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    if sh.returncode > 0:
-        try:
-            env = read_config('credentials')
-            return env['credentials']
-        except:
-            raise Exception(
-                "Unable to list credentials: {}".format(
-                    sh.stderr.decode('utf8')))
-    env = yaml.safe_load(sh.stdout.decode('utf8'))
-    return env['credentials']
+        args.append('--show-secrets')
+    # the config file always holds secrets, so can't be used without them
+    reader = read_credentials if secrets else None
+    return reader, args, _parse_credentials
+
+
+def _parse_credentials(returncode, stdout, stderr):
+    if returncode > 0:
+        raise Exception("Unable to list credentials: {}".format(stderr))
+    return yaml.safe_load(stdout)['credentials']
 
 
+@cached_query('clouds', 'public-clouds', key='regions')
 def get_regions(cloud):
     """ List available regions for cloud
 
@@ -331,11 +648,28 @@ def get_regions(cloud):
     Returns:
     Dictionary of all known regions for cloud
     """
-    sh = run('juju list-regions {} --format yaml'.format(cloud),
-             shell=True, stdout=PIPE, stderr=PIPE)
-    stdout = sh.stdout.decode('utf8')
-    stderr = sh.stderr.decode('utf8')
-    if sh.returncode > 0:
+    return _juju_query(*_regions_query(cloud))
+
+
+@cached_query('clouds', 'public-clouds', key='regions')
+async def aget_regions(cloud):
+    """ Async version of get_regions
+    """
+    return await _ajuju_query(*_regions_query(cloud))
+
+
+def _regions_query(cloud):
+    def reader():
+        clouds = read_clouds()
+        if cloud not in clouds:
+            raise JujuConfigError("Unknown cloud: {}".format(cloud))
+        return clouds[cloud].get('regions') or {}
+    args = ['list-regions', cloud, '--format', 'yaml']
+    return reader, args, _parse_regions
+
+
+def _parse_regions(returncode, stdout, stderr):
+    if returncode > 0:
         raise Exception("Unable to list regions: {}".format(stderr))
     if 'no regions' in stdout:
         return {}
@@ -348,19 +682,31 @@ def get_regions(cloud):
     return result
 
 
+@cached_query('clouds', 'public-clouds', key='clouds')
 def get_clouds():
     """ List available clouds
 
     Returns:
     Dictionary of all known clouds including newly created MAAS/Local
     """
-    sh = run('juju list-clouds --format yaml',
-             shell=True, stdout=PIPE, stderr=PIPE)
-    if sh.returncode > 0:
-        raise Exception(
-            "Unable to list clouds: {}".format(sh.stderr.decode('utf8'))
-        )
-    return yaml.safe_load(sh.stdout.decode('utf8'))
+    return _juju_query(*_clouds_query())
+
+
+@cached_query('clouds', 'public-clouds', key='clouds')
+async def aget_clouds():
+    """ Async version of get_clouds
+    """
+    return await _ajuju_query(*_clouds_query())
+
+
+def _clouds_query():
+    return read_clouds, ['list-clouds', '--format', 'yaml'], _parse_clouds
+
+
+def _parse_clouds(returncode, stdout, stderr):
+    if returncode > 0:
+        raise Exception("Unable to list clouds: {}".format(stderr))
+    return yaml.safe_load(stdout)
 
 
 def get_compatible_clouds(cloud_types=None):
@@ -433,7 +779,17 @@ def get_cloud_types_by_name():
 
     This accounts for some normalizations that get_clouds() doesn't.
     """
-    clouds = {n: c['type'] for n, c in get_clouds().items()}
+    return _cloud_types_by_name(get_clouds())
+
+
+async def aget_cloud_types_by_name():
+    """ Async version of get_cloud_types_by_name
+    """
+    return _cloud_types_by_name(await aget_clouds())
+
+
+def _cloud_types_by_name(all_clouds):
+    clouds = {n: c['type'] for n, c in all_clouds.items()}
 
     # normalize 'lxd' cloud type to localhost; 'lxd' can happen
     # depending on how the controller was bootstrapped
@@ -454,6 +810,7 @@ def get_cloud_types_by_name():
     return clouds
 
 
+@trace.traced('juju')
 def add_cloud(name, config):
     """ Adds a cloud
 
@@ -473,6 +830,7 @@ def add_cloud(name, config):
         spew(tempf.name, output)
         sh = run('juju add-cloud {} {}'.format(name, tempf.name),
                  shell=True, stdout=PIPE, stderr=PIPE)
+        invalidate_cache()
         if sh.returncode > 0:
             raise Exception(
                 "Unable to add cloud: {}".format(sh.stderr.decode('utf8')))
@@ -486,8 +844,9 @@ def get_cloud(name):
     Returns:
     Dictionary of cloud attributes
     """
-    if name in get_clouds().keys():
-        return get_clouds()[name]
+    clouds = get_clouds()
+    if name in clouds:
+        return clouds[name]
     raise LookupError("Unable to locate cloud: {}".format(name))
 
 
@@ -524,6 +883,7 @@ def constraints_from_dict(cdict):
     return " ".join(["{}={}".format(k, v) for k, v in cdict.items()])
 
 
+@trace.traced('juju')
 def deploy(bundle):
     """ Juju deploy bundle
 
@@ -538,45 +898,50 @@ def deploy(bundle):
         raise e
 
 
-async def add_machines(applications, machines, msg_cb):
+@trace.traced('juju')
+async def add_machines(applications, machines, msg_cb, batch_size=None):
     """Add machines to model
 
+    New machines are requested from Juju in batches, each batch being a
+    single AddMachines API call.
+
     Arguments:
 
     app: name of app to which the machines belong
     machines: a mapping of virtual machine numbers to machine attributes.
     The key 'series' is required, and 'constraints' is the only other
     supported key
+    batch_size: maximum number of machines to request per API call,
+    defaults to the --machine-batch-size option
 
     """
     if not events.PreDeployComplete.is_set():
         # block until after pre-deploy
         await events.PreDeployComplete.wait()
 
-    new_machines = {}
-    tasks = []
+    if batch_size is None:
+        batch_size = app.argv.machine_batch_size
+
+    new_vmids = []
+    waiting_vmids = []
     for vmid in sorted(machines.keys()):
         if events.MachineCreated.is_set(vmid):
-            tasks.append(asyncio.sleep(0))  # no-op
+            continue
         elif events.MachinePending.is_set(vmid):
-            tasks.append(events.MachineCreated.wait(vmid))
+            waiting_vmids.append(vmid)
         else:
+            events.MachineFailed.clear(vmid)
             events.MachinePending.set(vmid)
-            machine = machines[vmid]
-            series = machine['series']
-            constraints = constraints_to_dict(machine.get('constraints', ''))
-            tasks.append(app.juju.client.add_machine(series=series,
-                                                     constraints=constraints))
-            new_machines[vmid] = None
+            new_vmids.append(vmid)
 
-    if new_machines:
+    if new_vmids:
         msg = 'Adding machine{}: {}'.format(
-            's' if len(new_machines) > 1 else '',
+            's' if len(new_vmids) > 1 else '',
             ', '.join(
                 '{}: ({}, {})'.format(v,
                                       machines[v]['series'],
                                       machines[v].get('constraints', ''))
-                for v in sorted(new_machines.keys())),
+                for v in new_vmids),
         )
         app.log.info(msg)
         msg_cb(msg)
@@ -584,14 +949,23 @@ async def add_machines(applications, machines, msg_cb):
         app.log.info('No new machines to add for {}'.format(
             ', '.join(a.service_name for a in applications)))
 
-    results = await asyncio.gather(*tasks)
-    for vmid, task_result in zip(sorted(machines.keys()), results):
-        if vmid not in new_machines:
-            # this is an events.MachinePending.wait() or no-op result
-            continue
-        events.MachinePending.clear(vmid)
-        events.MachineCreated.set(vmid)
-        new_machines[vmid] = task_result.id
+    new_machines = {}
+    for i in range(0, len(new_vmids), batch_size):
+        batch = new_vmids[i:i + batch_size]
+        try:
+            new_machines.update(await _add_machine_batch(batch, machines))
+        except Exception:
+            # neither the failed batch nor the ones after it are pending,
+            # and anyone waiting on those machines needs to know
+            for vmid in new_vmids[i:]:
+                events.MachinePending.clear(vmid)
+                if not events.MachineCreated.is_set(vmid):
+                    events.MachineFailed.set(vmid)
+            raise
+    # only wait on machines other calls are adding once ours are added,
+    # so nothing is left unawaited if a batch fails
+    await asyncio.gather(*[_wait_for_machine(vmid)
+                           for vmid in waiting_vmids])
 
     if new_machines:
         msg = "Added machine{}: {}".format(
@@ -609,11 +983,146 @@ async def add_machines(applications, machines, msg_cb):
     return new_machines
 
 
+async def _wait_for_machine(vmid):
+    """ Waits for a machine another add_machines call is adding
+
+    Raises:
+    ValueError if that call failed to add it
+    """
+    waits = [asyncio.ensure_future(events.MachineCreated.wait(vmid)),
+             asyncio.ensure_future(events.MachineFailed.wait(vmid))]
+    try:
+        await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for wait in waits:
+            wait.cancel()
+    if not events.MachineCreated.is_set(vmid):
+        raise ValueError("Error adding machine {}".format(vmid))
+
+
+@trace.traced('juju', name=lambda vmids, *args, **kwargs:
+              'add machines {}'.format(', '.join(map(str, vmids))))
+async def _add_machine_batch(vmids, machines):
+    """ Requests a batch of machines from Juju in a single API call
+
+    Arguments:
+    vmids: bundle machine ids to add
+    machines: a mapping of bundle machine ids to machine attributes
+
+    Returns:
+    mapping of bundle machine ids to the ids of the new Juju machines
+    """
+    from juju.client import client
+
+    params = []
+    for vmid in vmids:
+        machine = machines[vmid]
+        params.append(client.AddMachineParams(
+            jobs=['JobHostUnits'],
+            series=machine['series'],
+            constraints=constraints_to_dict(machine.get('constraints', '')),
+        ))
+
+    facade = client.ClientFacade.from_connection(app.juju.client.connection)
+    start = time.time()
+    results = await facade.AddMachines(params)
+    app.log.info('AddMachines for {} machine{} took {:.2f}s'.format(
+        len(vmids), 's' if len(vmids) > 1 else '', time.time() - start))
+
+    if len(results.machines) != len(vmids):
+        for vmid in vmids:
+            events.MachinePending.clear(vmid)
+        raise ValueError("Error adding machines {}: got {} results".format(
+            ', '.join(vmids), len(results.machines)))
+
+    new_machines = {}
+    errors = []
+    for vmid, result in zip(vmids, results.machines):
+        events.MachinePending.clear(vmid)
+        if result.error:
+            errors.append('{}: {}'.format(vmid, result.error.message))
+            continue
+        events.MachineCreated.set(vmid)
+        new_machines[vmid] = result.machine
+    if new_machines:
+        await _record_machines(new_machines)
+    if errors:
+        raise ValueError("Error adding machines {}".format(
+            '; '.join(errors)))
+    return new_machines
+
+
+async def _record_machines(new_machines):
+    """ Annotates new Juju machines with the spell and bundle machine they
+    were added for
+
+    Arguments:
+    new_machines: mapping of bundle machine ids to Juju machine ids
+    """
+    from juju.client import client
+
+    annotations = [
+        client.EntityAnnotations(
+            entity='machine-{}'.format(machine_id),
+            annotations={MACHINE_ANNOTATION: '{}:{}'.format(
+                app.config['spell'], vmid)})
+        for vmid, machine_id in sorted(new_machines.items())]
+    try:
+        facade = client.AnnotationsFacade.from_connection(
+            app.juju.client.connection)
+        results = await facade.Set(annotations)
+    except Exception as e:
+        # the machines exist either way, a resumed deploy just won't
+        # reuse them
+        app.log.warning('Could not annotate machines {}: {}'.format(
+            ', '.join(sorted(new_machines.values())), e))
+        return
+    for ann, result in zip(annotations, results.results or []):
+        if result.error:
+            app.log.warning('Could not annotate {}: {}'.format(
+                ann.entity, result.error.message))
+
+
+async def _recorded_machines(machine_ids):
+    """ Looks up which bundle machines of this spell the given Juju
+    machines were added for
+
+    Arguments:
+    machine_ids: ids of Juju machines
+
+    Returns:
+    mapping of bundle machine ids to Juju machine ids
+    """
+    from juju.client import client
+
+    if not machine_ids:
+        return {}
+    try:
+        facade = client.AnnotationsFacade.from_connection(
+            app.juju.client.connection)
+        results = await facade.Get([
+            client.Entity(tag='machine-{}'.format(m_id))
+            for m_id in machine_ids])
+    except Exception as e:
+        # idle machines just won't be reused, the deploy can go on
+        app.log.warning('Could not read machine annotations: {}'.format(e))
+        return {}
+    recorded = {}
+    for machine_id, result in zip(machine_ids, results.results or []):
+        label = (result.annotations or {}).get(MACHINE_ANNOTATION, '')
+        spell, _, vmid = label.rpartition(':')
+        if vmid and spell == app.config['spell']:
+            recorded.setdefault(vmid, machine_id)
+    return recorded
+
+
+@trace.traced('juju', name=lambda service, *args, **kwargs:
+              'deploy {}'.format(service.service_name))
 async def deploy_service(service, default_series, msg_cb):
     """Juju deploy service.
 
-    If the service's charm ID doesn't have a revno, will query charm
-    store to get latest revno for the charm.
+    If the service's charm ID doesn't have a revno, will use the latest
+    revno for the charm, as resolved by charm.resolve_charm_ids.
 
     If the service's charm ID has a series, use that, otherwise use
     the provided default series.
@@ -624,21 +1133,17 @@ async def deploy_service(service, default_series, msg_cb):
     exc_cb: exception handler callback
 
     Returns a future that will be completed after the deploy has been
-    submitted to juju
+    submitted to juju. Any machines the service is placed on must
+    already exist. Does nothing if the service is already deployed.
 
     """
-    name = service.service_name
-    if not events.AppMachinesCreated.is_set(name):
-        # block until we have machines
-        await events.AppMachinesCreated.wait(name)
-        app.log.debug('Machines for {} are ready'.format(name))
+    if events.AppDeployed.is_set(service.service_name):
+        return
 
     if service.csid.rev == "":
-        id_no_rev = service.csid.as_str_without_rev()
-        mc = app.metadata_controller
-        futures.wait([mc.metadata_future])
-        info = mc.get_charm_info(id_no_rev, lambda _: None)
-        service.csid = CharmStoreID(info["Id"])
+        # normally resolved up front by setup_metadata_controller
+        service.csid = CharmStoreID(await charm.get_charm_id(
+            service.csid, default_series, app.argv.channel))
 
     deploy_args = {}
     deploy_args = dict(
@@ -671,41 +1176,214 @@ async def deploy_service(service, default_series, msg_cb):
     events.AppDeployed.set(service.service_name)
 
 
-async def set_relations(service, msg_cb):
-    """ Juju set relations
+@trace.traced('juju', name=lambda endpoints, *args, **kwargs:
+              'relate {}'.format(' <-> '.join(endpoints)))
+async def add_relation(endpoints, msg_cb):
+    """ Juju add relation
+
+    Both applications must already be deployed.
 
     Arguments:
-    service: service with relations to set
+    endpoints: pair of application endpoints to relate
+    msg_cb: message callback
+    """
+    rel_pair = tuple(sorted(endpoints))
+    rel_name = '{} <-> {}'.format(*rel_pair)
+    pending = events.PendingRelations.is_set(rel_name)
+    added = events.RelationsAdded.is_set(rel_name)
+    if pending or added:
+        return
+
+    msg = "Setting relation {}".format(rel_name)
+    app.log.info(msg)
+    msg_cb(msg)
+    events.PendingRelations.set(rel_name)
+    await app.juju.client.add_relation(*rel_pair)
+    events.PendingRelations.clear(rel_name)
+    events.RelationsAdded.set(rel_name)
+
+
+def _unit_number(unit_name):
+    return int(unit_name.split('/')[-1])
+
+
+def _machine_key(machine_id):
+    return (len(machine_id), machine_id)
+
+
+def _endpoint_matches(wanted, live):
+    """ Whether a live (application, endpoint name) pair is the bundle's
+    'application[:name]' endpoint
+    """
+    app_name, _, name = wanted.partition(':')
+    return live[0] == app_name and (not name or live[1] == name)
+
+
+def _machine_fits(machine, attrs):
+    """ Whether a machine in the model can stand in for a bundle machine,
+    going by its series and by the hardware it reports once provisioned
+
+    Tag constraints, which pin bundle machines to MAAS nodes, have to be
+    confirmed by the hardware; other constraints are only checked when
+    the hardware is known.
     """
-    relations = set()
-    for a, b in service.relations:
-        rel_pair = tuple(sorted((a, b)))
-        if rel_pair in relations:
+    if attrs.get('series') and machine.series and \
+            machine.series != attrs['series']:
+        return False
+    hardware = dict(item.partition('=')[::2]
+                    for item in (machine.hardware or '').split())
+    for constraint in (attrs.get('constraints') or '').split():
+        key, _, value = constraint.partition('=')
+        have = hardware.get(key)
+        if key == 'tags':
+            if have is None or \
+                    not set(value.split(',')) <= set(have.split(',')):
+                return False
+        elif have is None:
             continue
-        a_app = a.split(':')[0]
-        b_app = b.split(':')[0]
-        await asyncio.gather(
-            events.AppDeployed.wait(a_app),
-            events.AppDeployed.wait(b_app),
-        )
-        relations.add(rel_pair)
+        elif key == 'arch':
+            if have != value:
+                return False
+        elif key in ('cores', 'mem', 'root-disk'):
+            try:
+                if human_to_mb(have) < human_to_mb(value):
+                    return False
+            except (KeyError, ValueError):
+                continue
+    return True
+
+
+@trace.traced('juju')
+async def reconcile_model(applications, machines):
+    """ Works out what of the bundle is still missing from the model
+
+    Lets an interrupted deploy carry on where it stopped. The model is
+    read with a single status call. AppDeployed is set for the bundle
+    applications that have all their units, RelationsAdded for the
+    bundle relations that exist, and MachineCreated for the bundle
+    machines found in the model: the ones units were placed on, and
+    machines without units that an earlier deploy of the spell added
+    for them, as long as they still fit the bundle machine's series and
+    constraints. Other machines of the model are left alone.
+
+    Arguments:
+    applications: bundle applications
+    machines: a mapping of bundle machine ids to machine attributes
 
-    for rel_pair in relations:
-        rel_name = '{} <-> {}'.format(*rel_pair)
-        pending = events.PendingRelations.is_set(rel_name)
-        added = events.RelationsAdded.is_set(rel_name)
-        if pending or added:
+    Returns:
+    tuple of the mapping of bundle machine ids to the ids of the
+    existing Juju machines, and a mapping of the names of partially
+    deployed applications to the bundle placements of their missing
+    units, None for units without a placement
+    """
+    status = await app.juju.client.get_status()
+    live_apps = status.applications or {}
+    live_machines = status.machines or {}
+
+    machine_map = {}
+    missing_units = {}
+    deployed = []
+    for service in applications:
+        live_app = live_apps.get(service.service_name)
+        if live_app is None:
+            continue
+        units = live_app.units or {}
+        placements = service.placement_spec or []
+        if len(units) >= service.num_units:
+            deployed.append(service.service_name)
+            events.AppDeployed.set(service.service_name)
+        else:
+            missing = service.num_units - len(units)
+            missing_units[service.service_name] = (
+                placements[len(units):] + [None] * missing)[:missing]
+            app.log.info('{} has {} of {} units, adding the rest'.format(
+                service.service_name, len(units), service.num_units))
+        # units are placed in the order of the placement spec
+        for plabel, unit_name in zip(placements,
+                                     sorted(units, key=_unit_number)):
+            vmid = plabel.split(':')[-1]
+            machine_id = (units[unit_name].machine or '').split('/')[0]
+            if vmid in machines and machine_id in live_machines:
+                machine_map.setdefault(vmid, machine_id)
+
+    used = set(machine_map.values())
+    for live_app in live_apps.values():
+        for unit in (live_app.units or {}).values():
+            used.add((unit.machine or '').split('/')[0])
+    idle = [m_id for m_id in sorted(live_machines, key=_machine_key)
+            if m_id not in used and
+            'JobManageModel' not in (live_machines[m_id].jobs or [])]
+    recorded = await _recorded_machines(idle)
+    reused = 0
+    for vmid in sorted(machines, key=_machine_key):
+        m_id = recorded.get(vmid)
+        if vmid in machine_map or m_id not in idle:
             continue
+        if _machine_fits(live_machines[m_id], machines[vmid]):
+            machine_map[vmid] = m_id
+            idle.remove(m_id)
+            reused += 1
 
-        msg = "Setting relation {}".format(rel_name)
-        app.log.info(msg)
-        msg_cb(msg)
-        events.PendingRelations.set(rel_name)
-        await app.juju.client.add_relation(*rel_pair)
-        events.PendingRelations.clear(rel_name)
+    for vmid in machine_map:
+        events.MachinePending.clear(vmid)
+        events.MachineCreated.set(vmid)
+
+    live_relations = []
+    for relation in status.relations or []:
+        endpoints = [(ep.application, ep.name) for ep in relation.endpoints]
+        if len(endpoints) == 2:
+            live_relations.append(endpoints)
+    related = set()
+    for service in applications:
+        for endpoints in service.relations:
+            rel_pair = tuple(sorted(endpoints))
+            for live in live_relations:
+                if any(_endpoint_matches(rel_pair[0], a) and
+                       _endpoint_matches(rel_pair[1], b)
+                       for a, b in (live, live[::-1])):
+                    related.add('{} <-> {}'.format(*rel_pair))
+                    break
+    for rel_name in related:
         events.RelationsAdded.set(rel_name)
 
-    events.RelationsAdded.set(service.service_name)
+    app.log.info('Model has {} of {} applications, {} partially, {} of {} '
+                 'machines ({} without units) and {} relations of the '
+                 'bundle; {} other machines left alone'.format(
+                     len(deployed), len(applications), len(missing_units),
+                     len(machine_map), len(machines), reused, len(related),
+                     len(idle)))
+    return machine_map, missing_units
+
+
+@trace.traced('juju', name=lambda service, *args, **kwargs:
+              'add units {}'.format(service.service_name))
+async def add_units(service, placements, msg_cb):
+    """ Adds the missing units of a partially deployed application
+
+    Arguments:
+    service: Service to add units to
+    placements: placement directive of each unit to add, None for units
+    going on new machines
+    msg_cb: message callback
+    """
+    msg = 'Adding {} unit{} to {}...'.format(
+        len(placements), '' if len(placements) == 1 else 's',
+        service.service_name)
+    app.log.info(msg)
+    msg_cb(msg)
+
+    app_inst = app.juju.client.applications[service.service_name]
+    unplaced = placements.count(None)
+    if unplaced:
+        await app_inst.add_unit(count=unplaced)
+    for to in placements:
+        if to is not None:
+            await app_inst.add_unit(to=to)
+
+    msg = '{}: units added, installing.'.format(service.service_name)
+    app.log.info(msg)
+    msg_cb(msg)
+    events.AppDeployed.set(service.service_name)
 
 
 def get_controller_info(name=None):
@@ -714,35 +1392,60 @@ def get_controller_info(name=None):
     Arguments:
     name: if set shows info controller, otherwise displays current.
     """
-    cmd = 'juju show-controller --format yaml'
+    return _juju_query(*_controller_info_query(name))
+
+
+async def aget_controller_info(name=None):
+    """ Async version of get_controller_info
+    """
+    return await _ajuju_query(*_controller_info_query(name))
+
+
+def _controller_info_query(name):
+    # show-controller asks the controller for live details, which don't
+    # change the local config files, so it isn't cached
+    args = ['show-controller', '--format', 'yaml']
     if name is not None:
-        cmd += ' {}'.format(name)
-    sh = run(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    sh_out = sh.stdout.decode('utf8')
-    sh_err = sh.stderr.decode('utf8')
-    try:
-        data = yaml.safe_load(sh_out)
-    except yaml.parser.ParserError:
-        data = None
-    if sh.returncode != 0 or not data:
-        raise Exception("Unable to get info for "
-                        "controller {}: {}".format(name, sh_err))
-    return next(iter(data.values()))
+        args.append(name)
+
+    def parse(returncode, stdout, stderr):
+        try:
+            data = yaml.safe_load(stdout)
+        except yaml.parser.ParserError:
+            data = None
+        if returncode != 0 or not data:
+            raise Exception("Unable to get info for "
+                            "controller {}: {}".format(name, stderr))
+        return next(iter(data.values()))
+    return None, args, parse
 
 
+@cached_query('controllers', 'accounts', 'models', key='controllers')
 def get_controllers():
     """ List available controllers
 
     Returns:
     List of known controllers
     """
-    sh = run('juju list-controllers --format yaml',
-             shell=True, stdout=PIPE, stderr=PIPE)
-    if sh.returncode > 0:
-        raise LookupError(
-            "Unable to list controllers: {}".format(sh.stderr.decode('utf8')))
-    env = yaml.safe_load(sh.stdout.decode('utf8'))
-    return env
+    return _juju_query(*_controllers_query())
+
+
+@cached_query('controllers', 'accounts', 'models', key='controllers')
+async def aget_controllers():
+    """ Async version of get_controllers
+    """
+    return await _ajuju_query(*_controllers_query())
+
+
+def _controllers_query():
+    args = ['list-controllers', '--format', 'yaml']
+    return read_controllers, args, _parse_controllers
+
+
+def _parse_controllers(returncode, stdout, stderr):
+    if returncode > 0:
+        raise LookupError("Unable to list controllers: {}".format(stderr))
+    return yaml.safe_load(stdout)
 
 
 def get_account(controller):
@@ -785,7 +1488,10 @@ def get_model(controller, name):
     Returns:
     Dictionary of model information
     """
-    models = get_models(controller)['models']
+    try:
+        models = read_models(controller)['models']
+    except JujuConfigError:
+        models = get_models(controller)['models']
     for m in models:
         if m['short-name'] == name:
             return m
@@ -793,6 +1499,7 @@ def get_model(controller, name):
         "Unable to find model: {}".format(name))
 
 
+@trace.traced('juju')
 async def add_model(name, controller, cloud, credential=None):
     """ Adds a model to current controller
 
@@ -812,6 +1519,7 @@ async def add_model(name, controller, cloud, credential=None):
     proc = await asyncio.create_subprocess_exec(*cmd,
                                                 stdout=DEVNULL, stderr=PIPE)
     _, stderr = await proc.communicate()
+    invalidate_cache()
     if proc.returncode > 0:
         raise Exception(
             "Unable to create model: {}".format(stderr.decode('utf8')))
@@ -824,6 +1532,7 @@ async def add_model(name, controller, cloud, credential=None):
     await login()
 
 
+@trace.traced('juju')
 async def destroy_model(controller, model):
     """ Destroys a model within a controller
 
@@ -835,6 +1544,7 @@ async def destroy_model(controller, model):
         'juju', 'destroy-model', '-y', ':'.join([controller, model]),
         stdout=DEVNULL, stderr=PIPE)
     _, stderr = await proc.communicate()
+    invalidate_cache()
     if proc.returncode > 0:
         raise Exception(
             "Unable to destroy model: {}".format(stderr.decode('utf8')))
@@ -850,18 +1560,43 @@ def get_models(controller):
     Returns:
     List of known models
     """
-    sh = run('juju list-models --format yaml -c {}'.format(controller),
-             shell=True, stdout=PIPE, stderr=PIPE)
-    if sh.returncode > 0:
-        raise LookupError(
-            "Unable to list models: {}".format(sh.stderr.decode('utf8')))
-    out = yaml.safe_load(sh.stdout.decode('utf8'))
-    return out
+    return _juju_query(*_models_query(controller))
+
+
+async def aget_models(controller):
+    """ Async version of get_models
+    """
+    return await _ajuju_query(*_models_query(controller))
+
 
+def _models_query(controller):
+    # models.yaml doesn't have the live status callers need, so this
+    # always has to ask the controller, and isn't cached since models
+    # added or removed by other clients don't change the local files
+    args = ['list-models', '--format', 'yaml', '-c', controller]
+    return None, args, _parse_models
 
-def get_current_model():
+
+def _parse_models(returncode, stdout, stderr):
+    if returncode > 0:
+        raise LookupError("Unable to list models: {}".format(stderr))
+    return yaml.safe_load(stdout)
+
+
+def get_current_model(controller=None):
+    """ Grabs the current model of a controller
+
+    Arguments:
+    controller: controller to check, defaults to the current controller
+    """
+    if controller is None:
+        controller = get_current_controller()
+    try:
+        return read_models(controller).get('current-model')
+    except JujuConfigError:
+        pass
     try:
-        return get_models()['current-model']
+        return get_models(controller)['current-model']
     except:
         return None
 
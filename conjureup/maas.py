@@ -1,22 +1,123 @@
 """ simple maas client
 """
 
+import asyncio
+import threading
 import time
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import CancelledError
 from enum import Enum
 from functools import partial
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1
 
 from conjureup import juju
 from conjureup.app_config import app
-from conjureup.async import submit
-from conjureup.units import human_to_gb
+from conjureup.async import PRIORITY_HIGH, call_every, configure, submit
+from conjureup.units import human_to_gb, human_to_mb
+
+MAAS_ASYNC_QUEUE = "maas-async-queue"
+configure(MAAS_ASYNC_QUEUE, workers=4)
+MAAS_TAG_QUEUE = "maas-tag-queue"
+configure(MAAS_TAG_QUEUE, workers=8)
+
+
+class MaasAPIError(Exception):
+    pass
+
+
+class MaasResource:
+    def __init__(self, client, key, id_field=None):
+        """ Local copy of a MAAS collection, kept up to date by a single
+        poller and updated item by item
+
+        Arguments:
+        client: MaasClient
+        key: collection to fetch, eg. machines
+        id_field: field identifying an item, or None to compare the
+        collection as a whole
+        """
+        self.client = client
+        self.key = key
+        self.id_field = id_field
+        self.items = OrderedDict()
+        self.loaded = False
+        self.etag = None
+        self.last_modified = None
+        self.last_read = time.time()
+        self.timer = None
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def values(self):
+        """ Returns the items, or None if they haven't been loaded yet
+        """
+        self.last_read = time.time()
+        with self._lock:
+            if not self.loaded:
+                return None
+            return list(self.items.values())
+
+    def refresh(self):
+        """ Fetches the collection, unless MAAS says it hasn't changed
+
+        Returns:
+        tuple of lists of added, changed and removed item ids
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        r = self.client.get("/{}/".format(self.key), headers=headers)
+        if r.status_code == 304:
+            return [], [], []
+        if r.status_code != 200:
+            raise MaasAPIError("Error in MAAS API: {}".format(r.text))
+        self.etag = r.headers.get('ETag')
+        self.last_modified = r.headers.get('Last-Modified')
+        return self.update(r.json())
+
+    def update(self, items):
+        """ Replaces the collection, notifying listeners of the items that
+        were added, changed or removed
+
+        Returns:
+        tuple of lists of added, changed and removed item ids
+        """
+        if self.id_field is None:
+            new = OrderedDict(enumerate(items))
+        else:
+            new = OrderedDict((item[self.id_field], item) for item in items)
+        with self._lock:
+            old = self.items
+            added = [item_id for item_id in new if item_id not in old]
+            changed = [item_id for item_id, item in new.items()
+                       if item_id in old and old[item_id] != item]
+            removed = [item_id for item_id in old if item_id not in new]
+            first_load = not self.loaded
+            self.items = new
+            self.loaded = True
+        if first_load or added or changed or removed:
+            for listener in list(self.listeners):
+                listener(self, added, changed, removed)
+        return added, changed, removed
 
 
 class MaasClient:
     API_VERSION = '2.0'
-    CACHE = {}
+    REFRESH_INTERVAL = 5
+    # stop refreshing keys that haven't been read for this long
+    REFRESH_IDLE = 60
+    ID_FIELDS = {
+        'machines': 'system_id',
+        'tags': 'name',
+    }
+    # machines added to a tag per update_nodes call
+    TAG_BATCH_SIZE = 100
 
     def __init__(self, server_address, consumer_key,
                  token_key, token_secret):
@@ -34,23 +135,33 @@ class MaasClient:
                             resource_owner_key=token_key,
                             resource_owner_secret=token_secret,
                             signature_method='PLAINTEXT')
+        # keep connections to the region controller alive between calls
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.auth = self.oauth
+        self.session.headers['Accept'] = 'application/json'
+        self._resources = {}
+        self._resources_lock = threading.Lock()
+        self._machines = {}
 
     def _prepare_url(self, url):
         if not url.endswith('/'):
             url = url + '/'
         return self.api_url + url
 
-    def get(self, url, params=None):
+    def get(self, url, params=None, headers=None):
         """ Performs a authenticated GET against a MAAS endpoint
 
         Arguments:
         url: MAAS endpoint
         params: extra data sent with the HTTP request
+        headers: extra HTTP headers
         """
-        return requests.get(url=self._prepare_url(url),
-                            headers={'Accept': 'application/json'},
-                            auth=self.oauth,
-                            params=params)
+        return self.session.get(url=self._prepare_url(url),
+                                params=params,
+                                headers=headers)
 
     def post(self, url, params=None):
         """ Performs a authenticated POST against a MAAS endpoint
@@ -59,10 +170,8 @@ class MaasClient:
         url: MAAS endpoint
         params: extra data sent with the HTTP request
         """
-        return requests.post(url=self._prepare_url(url),
-                             headers={'Accept': 'application/json'},
-                             auth=self.oauth,
-                             data=params)
+        return self.session.post(url=self._prepare_url(url),
+                                 data=params)
 
     def put(self, url, params=None):
         """ Performs a authenticated PUT against a MAAS endpoint
@@ -71,10 +180,8 @@ class MaasClient:
         url: MAAS endpoint
         params: extra data sent with the HTTP request
         """
-        return requests.put(url=self._prepare_url(url),
-                            headers={'Accept': 'application/json'},
-                            auth=self.oauth,
-                            data=params)
+        return self.session.put(url=self._prepare_url(url),
+                                data=params)
 
     def delete(self, url, params=None):
         """ Performs a authenticated DELETE against a MAAS endpoint
@@ -83,20 +190,91 @@ class MaasClient:
         url: MAAS endpoint
         params: extra data sent with the HTTP request
         """
-        return requests.delete(url=self._prepare_url(url),
-                               headers={'Accept': 'application/json'},
-                               auth=self.oauth)
+        return self.session.delete(url=self._prepare_url(url))
 
     # Higher level API
     def _get_key_sync(self, key):
         r = self.get("/{}/".format(key))
         if r.status_code != 200:
-            raise Exception("Error in MAAS API: {}".format(r.text))
+            raise MaasAPIError("Error in MAAS API: {}".format(r.text))
         return r.json()
 
-    def _update_cache(self, key, future):
-        val = future.result()
-        self.CACHE[key] = (val, time.time())
+    def resource(self, key):
+        """ Returns the local copy of a MAAS collection, creating it if
+        needed
+        """
+        with self._resources_lock:
+            if key not in self._resources:
+                resource = MaasResource(self, key, self.ID_FIELDS.get(key))
+                if key == 'machines':
+                    resource.listeners.append(self._update_machines)
+                self._resources[key] = resource
+            return self._resources[key]
+
+    def _refresh_args(self, resource):
+        # a refresh that is already queued or running is shared rather
+        # than repeated
+        return dict(queue_name=MAAS_ASYNC_QUEUE,
+                    priority=PRIORITY_HIGH,
+                    key='{}{}'.format(self.api_url, resource.key),
+                    kind='maas:{}'.format(resource.key))
+
+    def _submit_refresh(self, resource):
+        return submit(partial(self._refresh, resource), lambda _: None,
+                      **self._refresh_args(resource))
+
+    def _refresh(self, resource):
+        """ Refreshes a collection, called periodically from the timer
+        thread until nobody has read it for REFRESH_IDLE seconds
+        """
+        if time.time() - resource.last_read > self.REFRESH_IDLE:
+            self.stop_polling(resource.key)
+            return None
+        return resource.refresh()
+
+    def _start_polling(self, resource):
+        with self._resources_lock:
+            if resource.timer is not None:
+                return
+            resource.timer = call_every(
+                self.REFRESH_INTERVAL,
+                partial(self._refresh, resource),
+                jitter=0.2,
+                exc_callback=lambda _: None,
+                **self._refresh_args(resource))
+        self._submit_refresh(resource)
+
+    def stop_polling(self, key):
+        """ Stops refreshing a collection in the background
+        """
+        with self._resources_lock:
+            resource = self._resources.get(key)
+            if resource is None or resource.timer is None:
+                return
+            timer, resource.timer = resource.timer, None
+        timer.cancel()
+
+    def subscribe(self, key, listener):
+        """ Calls listener(resource, added, changed, removed) whenever
+        the collection changes, and starts polling it
+        """
+        resource = self.resource(key)
+        resource.listeners.append(listener)
+        self._start_polling(resource)
+
+    async def arefresh(self, key):
+        """ Refreshes a collection now, sharing a refresh that is
+        already queued or running
+
+        Returns:
+        tuple of lists of added, changed and removed item ids
+        """
+        resource = self.resource(key)
+        resource.last_read = time.time()
+        future = self._submit_refresh(resource)
+        if future is None:
+            return [], [], []
+        return await asyncio.wrap_future(future)
 
     def get_cached(self, key):
         """cached API GET call, refreshes in background every 5 seconds
@@ -104,25 +282,55 @@ class MaasClient:
         returns None on the first call so you know it's just loading
         instead of an actual empty list
         """
+        resource = self.resource(key)
+        self._start_polling(resource)
+        return resource.values()
 
-        now = time.time()
-        c_val, c_ts = self.CACHE.get(key, (None, now))
-        if c_val is None or now - c_ts > 5:
-            f = submit(partial(self._get_key_sync, key),
-                       lambda _: None)
-            if f:
-                f.add_done_callback(partial(self._update_cache, key))
-
-        return c_val
+    def _update_machines(self, resource, added, changed, removed):
+        """ Rebuilds the MaasMachine of each machine that was added or
+        changed, so unchanged machines keep their objects
+        """
+        machines = dict(self._machines)
+        for system_id in removed:
+            machines.pop(system_id, None)
+        for system_id in added + changed:
+            machines[system_id] = MaasMachine(resource.items[system_id])
+        self._machines = machines
+
+    def get_machine(self, system_id):
+        """ Returns the cached machine with system_id, or None if it
+        isn't known
+        """
+        return self._machines.get(system_id)
 
     def get_machines(self):
         """
         cached get of /machines/
         """
-        cval = self.get_cached('machines')
-        if cval is None:
-            return cval
-        return [MaasMachine(d) for d in cval]
+        resource = self.resource('machines')
+        self._start_polling(resource)
+        items = resource.values()
+        if items is None:
+            return None
+        machines = self._machines
+        return [machines[item['system_id']] for item in items
+                if item['system_id'] in machines]
+
+    def tag_names(self):
+        """ Returns the set of tag names, fetching them if the cached
+        collection hasn't loaded yet
+        """
+        resource = self.resource('tags')
+        tags = resource.values()
+        if tags is None:
+            resource.refresh()
+            tags = resource.values()
+        return set(t['name'] for t in tags)
+
+    def _create_tag(self, tag):
+        res = self.post('/tags/', dict(comment="Machine-generated",
+                                       name=tag))
+        return res.ok
 
     def tag_new(self, tag):
         """ Create tag if it doesn't exist.
@@ -130,17 +338,8 @@ class MaasClient:
         :param tag: Tag name
         :returns: Success/Fail boolean
         """
-        tags = self.get_cached('tags')
-
-        # ensure that we get the actual result if cache is empty
-        if tags is None:
-            tags = self._get_key_sync('tags')
-
-        comment = "Machine-generated"
-        if tag not in [t['name'] for t in tags]:
-            res = self.post('/tags/', dict(comment=comment,
-                                           name=tag))
-            return res.ok
+        if tag not in self.tag_names():
+            return self._create_tag(tag)
         return False
 
     def tag_machine(self, tag, system_id):
@@ -153,23 +352,92 @@ class MaasClient:
         :returns: Success or Fail
         :rtype: bool
         """
+        return len(self.tag_machines(tag, [system_id])) == 1
 
-        res = self.post('/tags/{}/'.format(system_id),
-                        dict(op='update_nodes',
-                             add=[system_id]))
-        if res.ok:
-            return True
-        return False
+    def tag_machines(self, tag, system_ids):
+        """ Tag machines with the specified tag, TAG_BATCH_SIZE machines
+        per request
+
+        :param tag: Tag name
+        :param system_ids: IDs of nodes
+        :returns: IDs of the nodes tagged
+        :rtype: list
+        """
+        tagged = []
+        for i in range(0, len(system_ids), self.TAG_BATCH_SIZE):
+            batch = system_ids[i:i + self.TAG_BATCH_SIZE]
+            res = self.post('/tags/{}/'.format(tag),
+                            dict(op='update_nodes',
+                                 add=batch))
+            if res.ok:
+                tagged += batch
+        return tagged
+
+    def _apply_tag(self, tag, system_ids, existing):
+        if tag not in existing:
+            # if someone else created it meanwhile, tagging still works
+            self._create_tag(tag)
+        return self.tag_machines(tag, system_ids)
+
+    def bulk_tag(self, node_tags):
+        """ Applies tags to machines, creating the missing tags
+
+        The tag list is read once, and each tag is created and applied on
+        the MAAS_TAG_QUEUE workers, so tags are handled concurrently.
+
+        Arguments:
+        node_tags: dict of tag name to list of system ids to tag
+
+        Returns:
+        dict of system id to True if every tag was applied to it
+        """
+        results = {}
+        for system_ids in node_tags.values():
+            results.update(dict.fromkeys(system_ids, True))
+        if not results:
+            return results
+
+        existing = self.tag_names()
+        futures = {}
+        for tag, system_ids in node_tags.items():
+            futures[tag] = submit(
+                partial(self._apply_tag, tag, list(system_ids), existing),
+                lambda _: None,
+                queue_name=MAAS_TAG_QUEUE,
+                kind='maas:tag')
+
+        for tag, future in futures.items():
+            tagged = set()
+            if future is not None:
+                try:
+                    tagged = set(future.result())
+                except requests.RequestException as e:
+                    app.log.warning("Unable to apply MAAS tag {}: {}".format(
+                        tag, e))
+                except CancelledError:
+                    app.log.warning("Applying MAAS tag {} was "
+                                    "cancelled".format(tag))
+            for system_id in node_tags[tag]:
+                if system_id not in tagged:
+                    results[system_id] = False
+        return results
 
     def assign_id_tags(self, nodes):
         """ Tag each managed node with its unique system id
+
+        Returns:
+        dict of system id to True if the node is tagged
         """
+        results = {}
+        node_tags = {}
         for machine in nodes:
             system_id = machine.system_id
-            if 'tag_names' not in machine.tag_names or \
-               system_id not in machine.tag_names:
-                self.tag_new(system_id)
-                self.tag_machine(system_id, system_id)
+            if system_id in machine.tag_names:
+                results[system_id] = True
+            else:
+                node_tags[system_id] = [system_id]
+        results.update(self.bulk_tag(node_tags))
+        return results
 
 
 class MaasMachineStatus(Enum):
@@ -206,11 +474,69 @@ class MaasMachineStatus(Enum):
         return self.name.lower()
 
 
+def _to_number(value):
+    """ Parses a numeric MAAS field
+
+    Returns:
+    float, or None if the value is missing, invalid or '*', which
+    matches any constraint
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
 class MaasMachine:
-    """ Single maas machine """
+    """ Single maas machine
+
+    The fields used to list, sort, filter and match machines are parsed
+    once from the MAAS API record, with memory and storage in gigabytes.
+    Other fields are read from the record when asked for.
+    """
+
+    __slots__ = ('machine', 'system_id', 'hostname', 'status', 'cpu_cores',
+                 'mem_gb', 'storage_gb', 'arch', 'tag_names', 'mem',
+                 'storage', 'sort_key', '_filter_label')
 
     def __init__(self, machine):
         self.machine = machine
+        self.system_id = machine.get('system_id', '')
+        self.hostname = machine.get('hostname', '')
+        self.status = MaasMachineStatus(machine.get('status',
+                                                    MaasMachineStatus.UNKNOWN))
+        self.arch = machine.get('architecture')
+        self.tag_names = machine.get('tag_names', [])
+
+        cores = _to_number(machine.get('cpu_count', 0))
+        self.cpu_cores = 0 if cores is None else int(cores)
+
+        mem = _to_number(machine.get('memory'))
+        if mem is None:
+            self.mem_gb = None
+            self.mem = "N/A"
+        else:
+            self.mem_gb = mem / 1024
+            if mem > 1024:
+                self.mem = "{:.1f} G".format(mem / 1024)
+            else:
+                self.mem = "{:.1f} M".format(mem)
+
+        storage = _to_number(machine.get('storage'))
+        if storage is None:
+            self.storage_gb = None
+            self.storage = "N/A"
+        else:
+            self.storage_gb = storage / 1024
+            self.storage = "{size:.1f} G".format(size=self.storage_gb)
+
+        if self.status == MaasMachineStatus.READY:
+            status_key = 'A'
+        else:
+            status_key = str(self.status)
+        self.sort_key = status_key + self.hostname + " ".join(
+            map(str, [self.arch, self.cpu_cores, self.mem, self.storage]))
+        self._filter_label = None
 
     def __eq__(self, other):
         return self.hostname == other.hostname
@@ -218,25 +544,6 @@ class MaasMachine:
     def __hash__(self):
         return hash(self.hostname)
 
-    @property
-    def hostname(self):
-        """ Query hostname reported by MaaS
-
-        :returns: hostname
-        :rtype: str
-        """
-        return self.machine.get('hostname', '')
-
-    @property
-    def status(self):
-        """ Status of machine state
-
-        :returns: status enum
-        :rtype: MaasMachineStatus
-        """
-        return MaasMachineStatus(self.machine.get('status',
-                                                  MaasMachineStatus.UNKNOWN))
-
     @property
     def zone(self):
         """ Zone information
@@ -246,54 +553,6 @@ class MaasMachine:
         """
         return self.machine.get('zone', {})
 
-    @property
-    def cpu_cores(self):
-        """ Returns number of cpu-cores
-
-        :returns: number of cpus
-        :rtype: str
-        """
-        return self.machine.get('cpu_count', '0')
-
-    @property
-    def storage(self):
-        """ Return storage in gigabytes
-
-        :returns: storage size
-        :rtype: str
-        """
-        try:
-            _storage_in_gb = float(self.machine.get('storage')) / 1024
-        except ValueError:
-            return "N/A"
-        return "{size:.1f} G".format(size=_storage_in_gb)
-
-    @property
-    def arch(self):
-        """ Return architecture
-
-        :returns: architecture type
-        :rtype: str
-        """
-        return self.machine.get('architecture')
-
-    @property
-    def mem(self):
-        """ Return memory
-
-        :returns: memory size
-        :rtype: str
-        """
-        try:
-            _mem = float(self.machine.get('memory'))
-        except ValueError:
-            return "N/A"
-        if _mem > 1024:
-            _mem = _mem / 1024
-            return "{:.1f} G".format(_mem)
-        else:
-            return "{:.1f} M".format(_mem)
-
     @property
     def power_type(self):
         """ Machine power type
@@ -312,15 +571,6 @@ class MaasMachine:
         """
         return self.machine.get('resource_uri', '')
 
-    @property
-    def system_id(self):
-        """ Returns system id of a maas machine
-
-        :returns: system id of machine
-        :rtype: str
-        """
-        return self.machine.get('system_id', '')
-
     @property
     def ip_addresses(self):
         """ Ip addresses for machine
@@ -339,15 +589,6 @@ class MaasMachine:
         """
         return self.machine.get('macaddress_set', [])
 
-    @property
-    def tag_names(self):
-        """ Tag names for machine
-
-        :returns: tags associated with machine
-        :rtype: list
-        """
-        return self.machine.get('tag_names', [])
-
     @property
     def tag(self):
         """ Machine tag
@@ -377,14 +618,17 @@ class MaasMachine:
         return repr(self)
 
     def filter_label(self):
-        d = dict(dns_name=self.hostname,
-                 arch=self.arch,
-                 tag=self.tag,
-                 mem=self.mem,
-                 storage=self.storage,
-                 cpus=self.cpu_cores)
-        return ("hostname:{dns_name} tag:{tag} mem:{mem} arch:{arch}"
+        if self._filter_label is None:
+            d = dict(dns_name=self.hostname,
+                     arch=self.arch,
+                     tag=self.tag,
+                     mem=self.mem,
+                     storage=self.storage,
+                     cpus=self.cpu_cores)
+            self._filter_label = (
+                "hostname:{dns_name} tag:{tag} mem:{mem} arch:{arch}"
                 "storage:{storage} cores:{cpus}").format(**d)
+        return self._filter_label
 
 
 def setup_maas():
@@ -424,6 +668,25 @@ def setup_maas():
                                  token_secret=token_secret)
 
 
+SIZE_CONSTRAINTS = ('mem', 'storage', 'root-disk')
+CORES_CONSTRAINTS = ('cpu_cores', 'cores', 'cpu-cores')
+
+
+def _constraint_gb(value):
+    """ Converts a Juju size constraint to gigabytes, plain numbers being
+    megabytes
+    """
+    return human_to_mb(str(value)) / 1024
+
+
+def _arch_clean(arch):
+    if '/' in arch:
+        ar, subar = arch.split('/')
+        return ar, subar
+    else:
+        return arch, 'generic'
+
+
 def satisfies(machine, constraints):
     """Evaluates whether a MAAS machine's hardware matches constraints.
 
@@ -441,53 +704,214 @@ def satisfies(machine, constraints):
     :returns: (bool, [list-of-failed constraint keys])
 
     """
-    kmap = {'mem': 'memory',
-            'arch': 'architecture',
-            'storage': 'storage',
-            'cpu_cores': 'cpu_count',
-            'cores': 'cpu_count',
-            'cpu-cores': 'cpu_count',
-            'root-disk': 'storage',
-            'tags': 'tag_names'}
-
     cons_checks = []
 
     if constraints is None:
         return (True, [])
 
-    def _arch_clean(arch):
-        if '/' in arch:
-            ar, subar = arch.split('/')
-            return ar, subar
-        else:
-            return arch, 'generic'
-
     for k, v in constraints.items():
         if k == 'arch':
-            mval = machine.machine[kmap[k]]
+            mval = machine.arch
             if mval == '*':
                 continue
-            if _arch_clean(mval) != _arch_clean(v):
+            if mval is None or _arch_clean(mval) != _arch_clean(v):
                 cons_checks.append(k)
 
         elif k == 'tags':
-            mval = machine.machine[kmap[k]]
-            if set(mval) != set(v):
+            if set(machine.tag_names) != set(v):
                 cons_checks.append(k)
-        else:
-            if kmap[k] == 'storage':
-                mval = machine.storage
-            else:
-                mval = machine.machine[kmap[k]]
 
-            if mval == '*':
+        elif k in SIZE_CONSTRAINTS:
+            if k == 'mem':
+                mval = machine.mem_gb
+            else:
+                mval = machine.storage_gb
+            if mval is None:
                 # '*' always satisfies.
                 continue
+            if mval < _constraint_gb(v):
+                cons_checks.append(k)
 
-            mval = human_to_gb(str(mval))
-            v = human_to_gb(str(v))
-            if mval < v:
+        elif k in CORES_CONSTRAINTS:
+            if machine.machine.get('cpu_count') == '*':
+                continue
+            if machine.cpu_cores < human_to_gb(str(v)):
                 cons_checks.append(k)
 
     rval = (len(cons_checks) == 0), cons_checks
     return rval
+
+
+# positions of the set bits in each byte value
+_BYTE_BITS = [tuple(b for b in range(8) if value >> b & 1)
+              for value in range(256)]
+
+
+def _bits(indices, size):
+    """ Returns an int bitset with the bits at indices set
+    """
+    data = bytearray((size + 7) // 8)
+    for i in indices:
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(data, 'little')
+
+
+def _indices(mask):
+    """ Returns the positions of the bits set in mask, in order
+    """
+    indices = []
+    data = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+    for byte_index, byte in enumerate(data):
+        if byte:
+            base = byte_index << 3
+            indices.extend(base + b for b in _BYTE_BITS[byte])
+    return indices
+
+
+class _SizeColumn:
+    """ Numeric machine field sorted by value, for threshold queries
+    """
+
+    def __init__(self, values, wildcards, size):
+        order = sorted((i for i, v in enumerate(values)
+                        if i not in wildcards),
+                       key=values.__getitem__)
+        self.order = order
+        self.keys = [values[i] for i in order]
+        self.size = size
+
+    def below(self, threshold):
+        """ Returns the bitset of machines with a value under threshold
+        """
+        pos = bisect_left(self.keys, threshold)
+        return _bits(self.order[:pos], self.size)
+
+
+class MatchResult:
+    """ Machines matching a set of constraints
+
+    Attributes:
+    indices: positions of the matching machines, in order
+    failed: dict of constraint key to the bitset of machines failing it
+    """
+
+    def __init__(self, matcher, constraints, indices, failed):
+        self.matcher = matcher
+        self.constraints = constraints
+        self.indices = indices
+        self.failed = failed
+
+    def __len__(self):
+        return len(self.indices)
+
+    def machines(self):
+        return [self.matcher.machines[i] for i in self.indices]
+
+    def failures(self, index):
+        """ Returns the constraint keys a machine failed, as satisfies()
+        would
+        """
+        bit = 1 << index
+        return [k for k in self.constraints
+                if self.failed.get(k, 0) & bit]
+
+
+class MachineMatcher:
+    """ Evaluates constraints over many machines at once
+
+    The fields satisfies() checks are stored by column: cores, memory and
+    storage sorted by value, machines grouped by architecture and by tag
+    set. A constraint dict is evaluated as one bitset per constraint, with
+    a bit for each machine, instead of a Python loop over the machines.
+    Results match satisfies() for every machine, including '*' values.
+
+    Usage:
+
+    matcher = MachineMatcher(app.maas.client.get_machines())
+    result = matcher.match({'mem': 4096, 'cores': 4})
+    ready = result.machines()
+    """
+
+    def __init__(self, machines):
+        self.machines = list(machines)
+        self.size = len(self.machines)
+        self.all = (1 << self.size) - 1
+
+        mem = []
+        storage = []
+        cores = []
+        self._mem_wild = set()
+        self._storage_wild = set()
+        self._cores_wild = set()
+        self._arches = {}
+        self._tags = {}
+        for i, m in enumerate(self.machines):
+            mem.append(m.mem_gb)
+            if m.mem_gb is None:
+                self._mem_wild.add(i)
+            storage.append(m.storage_gb)
+            if m.storage_gb is None:
+                self._storage_wild.add(i)
+            cores.append(m.cpu_cores)
+            if m.machine.get('cpu_count') == '*':
+                self._cores_wild.add(i)
+            if m.arch == '*':
+                arch = '*'
+            elif m.arch is None:
+                arch = None
+            else:
+                arch = _arch_clean(m.arch)
+            self._arches.setdefault(arch, []).append(i)
+            self._tags.setdefault(frozenset(m.tag_names), []).append(i)
+
+        self._mem = _SizeColumn(mem, self._mem_wild, self.size)
+        self._storage = _SizeColumn(storage, self._storage_wild, self.size)
+        self._cores = _SizeColumn(cores, self._cores_wild, self.size)
+        self._masks = {}
+
+    def __len__(self):
+        return self.size
+
+    def _group_mask(self, groups, key):
+        cache_key = (id(groups), key)
+        mask = self._masks.get(cache_key)
+        if mask is None:
+            mask = _bits(groups.get(key, ()), self.size)
+            self._masks[cache_key] = mask
+        return mask
+
+    def failing(self, key, value):
+        """ Returns the bitset of machines failing a single constraint, or
+        0 for constraints satisfies() doesn't check
+        """
+        if key == 'arch':
+            return self.all & ~(self._group_mask(self._arches,
+                                                 _arch_clean(value)) |
+                                self._group_mask(self._arches, '*'))
+        if key == 'tags':
+            return self.all & ~self._group_mask(self._tags, frozenset(value))
+        if key in SIZE_CONSTRAINTS:
+            column = self._mem if key == 'mem' else self._storage
+            return column.below(_constraint_gb(value))
+        if key in CORES_CONSTRAINTS:
+            return self._cores.below(human_to_gb(str(value)))
+        return 0
+
+    def match(self, constraints):
+        """ Evaluates constraints over all machines
+
+        Arguments:
+        constraints: dict of constraints, as given to satisfies()
+
+        Returns:
+        MatchResult
+        """
+        failed = {}
+        passing = self.all
+        for k, v in (constraints or {}).items():
+            mask = self.failing(k, v)
+            if mask:
+                failed[k] = mask
+                passing &= ~mask
+        return MatchResult(self, constraints or {}, _indices(passing),
+                           failed)
@@ -0,0 +1,318 @@
+""" Filter expressions for machine lists
+
+    cores>=8 mem>=64G zone:az1 tag:ssd status:ready host~compute
+
+Each space separated term narrows the list down. A term is a field, an
+operator and a value, or a bare word, which matches machines whose host
+name contains it or that have an architecture, series, status, tag or
+zone containing it.
+
+Operators:
+>= > <= < =  compare cores, mem and storage; sizes default to GiB and
+             take M, G, T or P suffixes
+: =          equal to, or for host names, containing
+~            containing
+
+The text is compiled once per edit, and the filter is evaluated against
+a MachineIndex, which keeps an index per field up to date as machines are
+added and removed: sorted values for numbers, sets of machines per value
+for keywords, and trigrams for host names.
+
+Usage:
+
+index = MachineIndex()
+for m in app.maas.client.get_machines():
+    index.add(m.instance_id, maas_machine_fields(m))
+matching_ids = compile_filter('cores>=8 tag:ssd').match(index)
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+
+from conjureup.units import human_to_mb
+
+
+class FilterError(Exception):
+    pass
+
+
+FIELD_ALIASES = {
+    'arch': 'arch',
+    'az': 'zone',
+    'cores': 'cores',
+    'cpu': 'cores',
+    'cpus': 'cores',
+    'disk': 'storage',
+    'host': 'host',
+    'hostname': 'host',
+    'id': 'host',
+    'mem': 'mem',
+    'memory': 'mem',
+    'name': 'host',
+    'root-disk': 'storage',
+    'series': 'series',
+    'status': 'status',
+    'storage': 'storage',
+    'tag': 'tag',
+    'tags': 'tag',
+    'zone': 'zone',
+}
+NUMBER_FIELDS = ('cores', 'mem', 'storage')
+SIZE_FIELDS = ('mem', 'storage')
+KEYWORD_FIELDS = ('arch', 'series', 'status', 'tag', 'zone')
+
+_TERM_RE = re.compile(r'^([a-z_-]+)(>=|<=|>|<|=|:|~)(.*)$')
+_SIZE_RE = re.compile(r'^(\d+(?:\.\d+)?)([mgtp]?)(?:i?b)?$')
+_SIZE_UNITS = {'': 1, 'm': 1 / 1024, 'g': 1, 't': 1024, 'p': 1024 * 1024}
+
+Term = namedtuple('Term', ['field', 'op', 'value'])
+
+
+def _parse_number(field, value):
+    match = _SIZE_RE.match(value)
+    if match is None or (field not in SIZE_FIELDS and match.group(2)):
+        raise FilterError("Invalid {} '{}'".format(field, value))
+    return float(match.group(1)) * _SIZE_UNITS[match.group(2)]
+
+
+def _parse_term(word):
+    match = _TERM_RE.match(word)
+    if match is None or match.group(1) not in FIELD_ALIASES:
+        return Term(None, '~', word)
+    field = FIELD_ALIASES[match.group(1)]
+    op, value = match.group(2), match.group(3)
+    if value == '':
+        raise FilterError("Missing value for {}".format(match.group(1)))
+    if field in NUMBER_FIELDS:
+        if op == '~':
+            raise FilterError("{} can't use ~".format(field))
+        if op == ':':
+            op = '='
+        return Term(field, op, _parse_number(field, value))
+    if op in ('>=', '>', '<=', '<'):
+        raise FilterError("{} can't use {}".format(field, op))
+    if field == 'host' and op == ':':
+        op = '~'
+    return Term(field, op, value)
+
+
+class Filter:
+    """ A compiled filter expression
+    """
+
+    def __init__(self, text, terms):
+        self.text = text
+        self.terms = terms
+
+    def __bool__(self):
+        return len(self.terms) > 0
+
+    def __repr__(self):
+        return "<Filter {!r}>".format(self.text)
+
+    def match(self, index):
+        """ Evaluates the filter
+
+        Arguments:
+        index: MachineIndex of the machines to filter
+
+        Returns:
+        set of the ids of the matching machines, or None if the filter is
+        empty and matches every machine
+        """
+        if not self.terms:
+            return None
+        result = None
+        for term in self.terms:
+            ids = index.lookup(term)
+            result = set(ids) if result is None else result & ids
+            if not result:
+                break
+        return result
+
+
+def compile_filter(text):
+    """ Parses a filter expression
+
+    Raises FilterError if a term can't be parsed.
+    """
+    return Filter(text, [_parse_term(word)
+                         for word in text.lower().split()])
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+class MachineIndex:
+    """ Per field indexes of a list of machines
+
+    Machines are described by a dict of fields, as returned by
+    maas_machine_fields() and juju_machine_fields().
+    """
+    NGRAM = 3
+
+    def __init__(self):
+        self.fields = {}
+        # field -> sorted values and the machine ids in the same order
+        self._values = defaultdict(list)
+        self._value_ids = defaultdict(list)
+        # field -> value -> machine ids
+        self._keywords = defaultdict(lambda: defaultdict(set))
+        self._hosts = {}
+        # trigram -> machine ids
+        self._grams = defaultdict(set)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __contains__(self, machine_id):
+        return machine_id in self.fields
+
+    def _ngrams(self, text):
+        return set(text[i:i + self.NGRAM]
+                   for i in range(len(text) - self.NGRAM + 1))
+
+    def add(self, machine_id, fields):
+        """ Indexes a machine, replacing any earlier fields it had
+        """
+        if self.fields.get(machine_id) == fields:
+            return
+        self.remove(machine_id)
+        self.fields[machine_id] = fields
+        for field in NUMBER_FIELDS:
+            value = fields.get(field)
+            if value is None:
+                continue
+            pos = bisect_right(self._values[field], value)
+            self._values[field].insert(pos, value)
+            self._value_ids[field].insert(pos, machine_id)
+        for field in KEYWORD_FIELDS:
+            for value in _as_list(fields.get(field)):
+                self._keywords[field][value.lower()].add(machine_id)
+        host = (fields.get('host') or '').lower()
+        self._hosts[machine_id] = host
+        for gram in self._ngrams(host):
+            self._grams[gram].add(machine_id)
+
+    def remove(self, machine_id):
+        """ Drops a machine from the index, if it is there
+        """
+        fields = self.fields.pop(machine_id, None)
+        if fields is None:
+            return
+        for field in NUMBER_FIELDS:
+            value = fields.get(field)
+            if value is None:
+                continue
+            values = self._values[field]
+            ids = self._value_ids[field]
+            pos = bisect_left(values, value)
+            while ids[pos] != machine_id:
+                pos += 1
+            del values[pos]
+            del ids[pos]
+        for field in KEYWORD_FIELDS:
+            for value in _as_list(fields.get(field)):
+                postings = self._keywords[field][value.lower()]
+                postings.discard(machine_id)
+                if not postings:
+                    del self._keywords[field][value.lower()]
+        host = self._hosts.pop(machine_id)
+        for gram in self._ngrams(host):
+            self._grams[gram].discard(machine_id)
+            if not self._grams[gram]:
+                del self._grams[gram]
+
+    def _numbers(self, field, op, value):
+        values = self._values[field]
+        ids = self._value_ids[field]
+        if op == '>=':
+            return set(ids[bisect_left(values, value):])
+        if op == '>':
+            return set(ids[bisect_right(values, value):])
+        if op == '<=':
+            return set(ids[:bisect_right(values, value)])
+        if op == '<':
+            return set(ids[:bisect_left(values, value)])
+        return set(ids[bisect_left(values, value):
+                       bisect_right(values, value)])
+
+    def _keyword(self, field, op, value):
+        keywords = self._keywords[field]
+        if op == '~':
+            ids = set()
+            for keyword, postings in keywords.items():
+                if value in keyword:
+                    ids |= postings
+            return ids
+        return keywords.get(value, set())
+
+    def _host(self, op, value):
+        if op != '~':
+            return set(machine_id for machine_id, host in self._hosts.items()
+                       if host == value)
+        if len(value) < self.NGRAM:
+            return set(machine_id for machine_id, host in self._hosts.items()
+                       if value in host)
+        postings = sorted((self._grams.get(gram, set())
+                           for gram in self._ngrams(value)), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return set(machine_id for machine_id in candidates
+                   if value in self._hosts[machine_id])
+
+    def lookup(self, term):
+        """ Returns the set of ids of the machines matching a term
+        """
+        if term.field is None:
+            ids = self._host('~', term.value)
+            for field in KEYWORD_FIELDS:
+                ids |= self._keyword(field, '~', term.value)
+            return ids
+        if term.field in NUMBER_FIELDS:
+            return self._numbers(term.field, term.op, term.value)
+        if term.field == 'host':
+            return self._host(term.op, term.value)
+        return self._keyword(term.field, term.op, term.value)
+
+
+def maas_machine_fields(machine):
+    """ Returns the fields of a MaasMachine to index
+    """
+    arch = machine.arch or ''
+    return {'host': machine.hostname,
+            'cores': machine.cpu_cores,
+            'mem': machine.mem_gb,
+            'storage': machine.storage_gb,
+            'arch': sorted(set([arch, arch.split('/')[0]])),
+            'tag': list(machine.tag_names),
+            'zone': (machine.zone or {}).get('name'),
+            'status': machine.status.name}
+
+
+def juju_machine_fields(juju_machine_id, machine):
+    """ Returns the fields of a bundle machine to index, with sizes from
+    its constraints
+    """
+    fields = {'host': juju_machine_id,
+              'series': machine.get('series')}
+    for constraint in machine.get('constraints', '').split():
+        key, _, value = constraint.partition('=')
+        if not value:
+            continue
+        try:
+            if key == 'cores':
+                fields['cores'] = int(value)
+            elif key in ('mem', 'root-disk'):
+                field = 'mem' if key == 'mem' else 'storage'
+                fields[field] = human_to_mb(value) / 1024
+            elif key in ('arch', 'tags'):
+                fields[FIELD_ALIASES[key]] = value.split(',')
+        except (KeyError, ValueError):
+            continue
+    return fields
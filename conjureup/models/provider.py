@@ -16,7 +16,6 @@ from conjureup.consts import cloud_types
 from conjureup.juju import get_cloud
 from conjureup.models.credential import CredentialManager
 from conjureup.utils import arun, is_valid_hostname
-from conjureup.vsphere import VSphereClient, VSphereInvalidLogin
 
 
 """ Defining the schema
@@ -599,6 +598,9 @@ class VSphere(BaseProvider):
         self._datacenters = None
 
     async def login(self):
+        # pyVmomi is slow to import, so only load it for vSphere
+        from conjureup.vsphere import VSphereClient, VSphereInvalidLogin
+
         if self.authenticated:
             return
 
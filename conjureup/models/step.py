@@ -7,7 +7,7 @@ from pathlib import Path
 import aiofiles
 import yaml
 
-from conjureup import juju
+from conjureup import juju, trace
 from conjureup.app_config import app
 from conjureup.telemetry import track_event
 from conjureup.utils import SudoError, can_sudo, is_linux, sentry_report
@@ -77,6 +77,8 @@ class StepModel:
                                                         self.cloud_whitelist,
                                                         self.filename)
 
+    @trace.traced('step', name=lambda self, *args, **kwargs:
+                  'step {}'.format(self.title))
     async def run(self, msg_cb, event_name=None):
         # Define STEP_NAME for use in determining where to store
         # our step results,
@@ -106,7 +108,7 @@ class StepModel:
                 'passwordless sudo required',
             ))
 
-        cloud_types = juju.get_cloud_types_by_name()
+        cloud_types = await juju.aget_cloud_types_by_name()
         provider_type = cloud_types[app.provider.cloud]
 
         app.env['JUJU_PROVIDERTYPE'] = provider_type
@@ -141,24 +143,26 @@ class StepModel:
 
         async with aiofiles.open(step_path + ".out", 'w') as outf:
             async with aiofiles.open(step_path + ".err", 'w') as errf:
-                proc = await asyncio.create_subprocess_exec(step_path,
-                                                            env=app.env,
-                                                            stdout=outf,
-                                                            stderr=errf)
-                async with aiofiles.open(step_path + '.out', 'r') as f:
-                    while proc.returncode is None:
-                        async for line in f:
-                            msg_cb(line)
-                        await asyncio.sleep(0.01)
+                with trace.span('subprocess', step_path):
+                    proc = await asyncio.create_subprocess_exec(step_path,
+                                                                env=app.env,
+                                                                stdout=outf,
+                                                                stderr=errf)
+                    async with aiofiles.open(step_path + '.out', 'r') as f:
+                        while proc.returncode is None:
+                            async for line in f:
+                                msg_cb(line)
+                            await asyncio.sleep(0.01)
 
         out_log = Path(step_path + '.out').read_text()
         err_log = Path(step_path + '.err').read_text()
 
         if proc.returncode != 0:
-            app.sentry.context.merge({'extra': {
-                'out_log_tail': out_log[-400:],
-                'err_log_tail': err_log[-400:],
-            }})
+            if app.sentry:
+                app.sentry.context.merge({'extra': {
+                    'out_log_tail': out_log[-400:],
+                    'err_log_tail': err_log[-400:],
+                }})
             raise Exception("Failure in step {}".format(self.filename))
 
         # special case for 00_deploy-done to report masked
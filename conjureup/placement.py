@@ -0,0 +1,198 @@
+""" Automatic placement of Juju machines onto MAAS machines
+
+Picks a ready MAAS machine for each Juju machine of a bundle, in place of
+pinning them one at a time.
+
+Usage:
+
+from conjureup import placement
+
+pins, unplaced = placement.place(
+    {'0': {'mem': 4096}, '1': {'mem': 4096}, '2': {'cores': 8}},
+    app.maas.client.get_machines(),
+    groups={'0': 'mysql', '1': 'mysql', '2': 'nova-compute'})
+for juju_machine_id, maas_machine in pins.items():
+    controller.set_machine_pin(juju_machine_id, maas_machine)
+
+Juju machines are placed most constrained first, each on the smallest
+free MAAS machine that satisfies its constraints. Machines in the same
+group, such as the units of one application, are spread across
+availability zones. For small bundles, Juju machines the heuristic
+couldn't place are placed by moving earlier choices along augmenting
+paths, which places as many Juju machines as any assignment could.
+"""
+
+from collections import OrderedDict, defaultdict
+
+from conjureup.maas import MaasMachineStatus, MachineMatcher
+
+# Largest number of Juju machines to run the exact pass for by default
+EXACT_LIMIT = 100
+
+DEFAULT_ZONE = 'default'
+
+
+def _constraints_key(constraints):
+    return tuple(sorted((k, str(v)) for k, v in (constraints or {}).items()))
+
+
+def _machine_key(juju_machine_id):
+    return (len(juju_machine_id), juju_machine_id)
+
+
+def _size_key(machine):
+    """ Orders MAAS machines smallest first, with '*' values last
+    """
+    inf = float('inf')
+    return (machine.cpu_cores,
+            inf if machine.mem_gb is None else machine.mem_gb,
+            inf if machine.storage_gb is None else machine.storage_gb,
+            machine.hostname)
+
+
+def zone_name(machine):
+    return (machine.zone or {}).get('name') or DEFAULT_ZONE
+
+
+class _Candidates:
+    """ Free MAAS machines satisfying one set of constraints, by zone and
+    smallest first
+    """
+
+    def __init__(self, indices, zones, sizes):
+        self.indices = indices
+        self.zones = OrderedDict()
+        for idx in sorted(indices, key=sizes.__getitem__):
+            self.zones.setdefault(zones[idx], []).append(idx)
+        self.cursors = dict.fromkeys(self.zones, 0)
+
+    def heads(self, used):
+        """ Yields (zone, smallest free index) for each zone with a free
+        machine left
+        """
+        for zone, indices in self.zones.items():
+            pos = self.cursors[zone]
+            while pos < len(indices) and indices[pos] in used:
+                pos += 1
+            self.cursors[zone] = pos
+            if pos < len(indices):
+                yield zone, indices[pos]
+
+
+def _augment(juju_machine_id, candidates, owner, visited):
+    """ Frees a candidate for juju_machine_id by moving the Juju machines
+    holding them to other candidates
+    """
+    stack = [(juju_machine_id, iter(candidates[juju_machine_id]))]
+    # (Juju machine, MAAS machine it moves to) down the stack
+    path = []
+    while stack:
+        j_id, remaining = stack[-1]
+        for idx in remaining:
+            if idx in visited:
+                continue
+            visited.add(idx)
+            other = owner.get(idx)
+            if other is None:
+                owner[idx] = j_id
+                for moved_id, moved_idx in path:
+                    owner[moved_idx] = moved_id
+                return True
+            path.append((j_id, idx))
+            stack.append((other, iter(candidates[other])))
+            break
+        else:
+            stack.pop()
+            if path:
+                path.pop()
+    return False
+
+
+def place(juju_machines, maas_machines, pinned=None, groups=None,
+          spread_zones=True, exact=None):
+    """ Assigns Juju machines to ready MAAS machines
+
+    Arguments:
+    juju_machines: dict of Juju machine id to its constraints dict
+    maas_machines: list of MaasMachine to choose from, only ready ones
+    are used
+    pinned: dict of Juju machine id to the MaasMachine it is already
+    pinned to, those Juju machines are skipped and MAAS machines not
+    reused
+    groups: dict of Juju machine id to a key, such as the application
+    name, of the machines to spread across zones
+    spread_zones: whether to spread groups across zones
+    exact: whether to run the exact pass when some Juju machines can't
+    be placed, defaults to bundles of up to EXACT_LIMIT machines
+
+    Returns:
+    tuple of a dict of Juju machine id to MaasMachine, and a list of the
+    Juju machine ids that couldn't be placed
+    """
+    pinned = pinned or {}
+    groups = groups or {}
+    taken = set(m.instance_id for m in pinned.values())
+    nodes = [m for m in maas_machines
+             if m.status == MaasMachineStatus.READY and
+             m.instance_id not in taken]
+    todo = [j_id for j_id in juju_machines if j_id not in pinned]
+
+    matcher = MachineMatcher(nodes)
+    zones = [zone_name(m) for m in nodes]
+    sizes = [_size_key(m) for m in nodes]
+
+    # Juju machines mostly share a few sets of constraints, so each set
+    # is matched once
+    candidate_sets = {}
+    candidates = {}
+    for j_id in todo:
+        key = _constraints_key(juju_machines[j_id])
+        if key not in candidate_sets:
+            indices = matcher.match(juju_machines[j_id]).indices
+            candidate_sets[key] = _Candidates(indices, zones, sizes)
+        candidates[j_id] = candidate_sets[key]
+
+    todo.sort(key=lambda j_id: (len(candidates[j_id].indices),
+                                _machine_key(j_id)))
+    used = set()
+    owner = {}
+    unplaced = []
+    zone_counts = defaultdict(lambda: defaultdict(int))
+    for j_id in todo:
+        counts = zone_counts[groups.get(j_id)]
+        best = None
+        for zone, idx in candidates[j_id].heads(used):
+            if spread_zones:
+                rank = (counts[zone], sizes[idx], zone)
+            else:
+                rank = (sizes[idx], zone)
+            if best is None or rank < best[0]:
+                best = (rank, zone, idx)
+        if best is None:
+            unplaced.append(j_id)
+            continue
+        _, zone, idx = best
+        used.add(idx)
+        owner[idx] = j_id
+        counts[zone] += 1
+
+    if exact is None:
+        exact = len(todo) <= EXACT_LIMIT
+    if unplaced and exact:
+        indices = {j_id: candidates[j_id].indices for j_id in todo}
+        still_unplaced = []
+        # MAAS machines searched by a failed attempt stay out of reach
+        # until an attempt succeeds
+        visited = set()
+        for j_id in unplaced:
+            if _augment(j_id, indices, owner, visited):
+                visited = set()
+            else:
+                still_unplaced.append(j_id)
+        unplaced = still_unplaced
+
+    pins = OrderedDict()
+    for idx, j_id in sorted(owner.items(),
+                            key=lambda item: _machine_key(item[1])):
+        pins[j_id] = nodes[idx]
+    return pins, sorted(unplaced, key=_machine_key)
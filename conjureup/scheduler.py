@@ -0,0 +1,173 @@
+""" Dependency graph scheduler
+
+Runs a set of coroutines whose ordering is described by explicit
+dependencies rather than by tasks waiting on each other's events.
+
+Usage:
+
+from conjureup.scheduler import Scheduler
+
+scheduler = Scheduler(concurrency=10)
+scheduler.add('machines:mysql', add_mysql_machines)
+scheduler.add('app:mysql', deploy_mysql, deps=['machines:mysql'], cost=3)
+scheduler.add('app:wordpress', deploy_wordpress, cost=3)
+scheduler.add('relation:mysql <-> wordpress', relate,
+              deps=['app:mysql', 'app:wordpress'])
+await scheduler.run()
+
+Ready nodes are started in critical path order: the node with the most
+(cost weighted) work left behind it goes first, so long chains aren't
+held up behind short ones when the concurrency cap is reached.
+"""
+
+import asyncio
+import heapq
+import time
+from collections import OrderedDict
+
+from conjureup import trace
+
+
+class SchedulerError(Exception):
+    pass
+
+
+class Node:
+    def __init__(self, name, func, deps, cost):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.cost = cost
+        self.dependents = []
+        self.priority = None
+        self.started = None
+        self.finished = None
+        self.result = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+
+class Scheduler:
+    def __init__(self, concurrency=None):
+        """ Scheduler
+
+        Arguments:
+        concurrency: maximum number of nodes to run at once, unlimited
+        if None or 0
+        """
+        self.concurrency = concurrency
+        self.nodes = OrderedDict()
+
+    def add(self, name, func, deps=(), cost=1):
+        """ Adds a node to the graph
+
+        Arguments:
+        name: unique name of the node
+        func: callable taking no arguments and returning an awaitable
+        deps: names of nodes that have to finish before this one starts
+        cost: relative expected duration, used to find the critical path
+
+        Returns:
+        the new Node
+        """
+        if name in self.nodes:
+            raise SchedulerError('Duplicate node: {}'.format(name))
+        node = Node(name, func, deps, cost)
+        self.nodes[name] = node
+        return node
+
+    def _prioritize(self):
+        """ Links dependents and computes each node's critical path length
+
+        Returns:
+        nodes in topological order
+        """
+        for node in self.nodes.values():
+            node.dependents = []
+        for node in self.nodes.values():
+            for dep in node.deps:
+                if dep not in self.nodes:
+                    raise SchedulerError('Unknown dependency {} of {}'.format(
+                        dep, node.name))
+                self.nodes[dep].dependents.append(node)
+
+        pending = {name: len(node.deps) for name, node in self.nodes.items()}
+        ready = [node for node in self.nodes.values() if not node.deps]
+        order = []
+        while ready:
+            node = ready.pop()
+            order.append(node)
+            for dependent in node.dependents:
+                pending[dependent.name] -= 1
+                if pending[dependent.name] == 0:
+                    ready.append(dependent)
+        if len(order) != len(self.nodes):
+            cycle = sorted(name for name, count in pending.items() if count)
+            raise SchedulerError('Dependency cycle between: {}'.format(
+                ', '.join(cycle)))
+
+        for node in reversed(order):
+            node.priority = node.cost + max(
+                [dependent.priority for dependent in node.dependents] or [0])
+        return order
+
+    async def run(self):
+        """ Runs every node once its dependencies have finished
+
+        If a node fails, the nodes still running are cancelled and the
+        exception is raised.
+
+        Returns:
+        mapping of node names to results
+        """
+        self._prioritize()
+        index = {name: i for i, name in enumerate(self.nodes)}
+        pending = {name: len(node.deps) for name, node in self.nodes.items()}
+        ready = [(-node.priority, index[node.name], node)
+                 for node in self.nodes.values() if not node.deps]
+        heapq.heapify(ready)
+        running = {}
+        try:
+            while ready or running:
+                while ready and (not self.concurrency or
+                                 len(running) < self.concurrency):
+                    node = heapq.heappop(ready)[2]
+                    node.started = time.time()
+                    running[asyncio.ensure_future(self._run_node(node))] = node
+
+                done, _ = await asyncio.wait(
+                    list(running), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node = running.pop(task)
+                    node.finished = time.time()
+                    node.result = task.result()
+                    for dependent in node.dependents:
+                        pending[dependent.name] -= 1
+                        if pending[dependent.name] == 0:
+                            heapq.heappush(ready, (-dependent.priority,
+                                                   index[dependent.name],
+                                                   dependent))
+        finally:
+            for task in running:
+                task.cancel()
+        return OrderedDict((name, node.result)
+                           for name, node in self.nodes.items())
+
+    async def _run_node(self, node):
+        with trace.span('schedule', node.name,
+                        {'deps': node.deps, 'priority': node.priority}):
+            return await node.func()
+
+    def timings(self):
+        """ Returns the start and finish timestamps of each node
+
+        Returns:
+        mapping of node names to (started, finished) tuples, either of
+        which is None if the node hasn't reached that point
+        """
+        return OrderedDict((name, (node.started, node.finished))
+                           for name, node in self.nodes.items())
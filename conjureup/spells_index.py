@@ -0,0 +1,215 @@
+""" Compiled spells index
+
+Parsing spells-index.yaml and every spell's metadata.yaml is only done
+when the registry changes. The result is pickled into the spells
+directory and loaded from there on later runs.
+
+Usage:
+
+from conjureup import spells_index
+
+index = spells_index.load(spells_dir)
+index.find_matching('openstack')
+"""
+
+import os
+import pickle
+import re
+from collections import OrderedDict, defaultdict
+from copy import deepcopy
+
+import yaml
+
+from conjureup.app_config import app
+from conjureup.utils import is_darwin
+
+INDEX_FILE = 'spells-index.yaml'
+COMPILED_FILE = '.spells-index.pickle'
+# Bump when the compiled layout changes to force a rebuild
+VERSION = 1
+
+_token_re = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    """ Splits text into lowercase keywords
+    """
+    return _token_re.findall(str(text).lower())
+
+
+def _registry_revision(spells_dir):
+    """ Identifies the state of the spells registry without parsing it
+
+    Returns:
+    tuple of the checked out git commit, if any, and the size and
+    modification time of the spells index
+    """
+    commit = None
+    git_dir = os.path.join(spells_dir, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+        if head.startswith('ref: '):
+            ref = head[len('ref: '):]
+            try:
+                with open(os.path.join(git_dir, ref)) as f:
+                    commit = f.read().strip()
+            except FileNotFoundError:
+                with open(os.path.join(git_dir, 'packed-refs')) as f:
+                    for line in f:
+                        if line.rstrip().endswith(' ' + ref):
+                            commit = line.split()[0]
+        else:
+            commit = head
+    except OSError:
+        pass
+    st = os.stat(os.path.join(spells_dir, INDEX_FILE))
+    return commit, st.st_size, st.st_mtime_ns
+
+
+def _spell_sort_key(entry):
+    category = entry['category']
+    if category == '_unassigned_spells':
+        return ('z', entry['name'])
+    return (category, entry['name'])
+
+
+class SpellsIndex:
+    def __init__(self, revision, spells, categories, keywords):
+        """ Compiled spells index
+
+        Arguments:
+        revision: registry revision the index was built from
+        spells: spell entries in picker order
+        categories: mapping of category names to spell keys
+        keywords: mapping of keywords to the keys of spells they match
+        """
+        self.revision = revision
+        self.spells = spells
+        self.by_key = {entry['key']: entry for entry in spells}
+        self.position = {entry['key']: i for i, entry in enumerate(spells)}
+        self.categories = categories
+        self.keywords = keywords
+
+    @classmethod
+    def build(cls, spells_dir, revision=None):
+        """ Parses the spells index and every spell's metadata
+        """
+        if revision is None:
+            revision = _registry_revision(spells_dir)
+        with open(os.path.join(spells_dir, INDEX_FILE)) as fp:
+            raw_index = yaml.safe_load(fp.read())
+
+        spells = []
+        for category, cat_dict in raw_index.items():
+            for sd in cat_dict['spells']:
+                metadata_path = os.path.join(spells_dir, sd['key'],
+                                             'metadata.yaml')
+                try:
+                    with open(metadata_path) as fp:
+                        metadata = yaml.safe_load(fp.read()) or {}
+                except FileNotFoundError:
+                    metadata = {}
+                spells.append({
+                    'category': category,
+                    'key': sd['key'],
+                    'name': sd.get('name', sd['key']),
+                    'description': sd.get('description',
+                                          metadata.get('description', '')),
+                    'cloud-whitelist': metadata.get('cloud-whitelist', []),
+                    'cloud-blacklist': metadata.get('cloud-blacklist', []),
+                    'spell': sd,
+                })
+        spells.sort(key=_spell_sort_key)
+
+        categories = OrderedDict()
+        keywords = defaultdict(set)
+        for entry in spells:
+            categories.setdefault(entry['category'], []).append(entry['key'])
+            for field in ('category', 'key', 'name', 'description'):
+                for token in tokenize(entry[field]):
+                    keywords[token].add(entry['key'])
+        return cls(revision, spells, categories, dict(keywords))
+
+    def _results(self, keys):
+        """ Returns (category, spell) pairs in picker order, leaving out
+        spells that aren't available on this platform
+        """
+        entries = [self.by_key[key]
+                   for key in sorted(set(keys), key=self.position.get)]
+        return [(entry['category'], deepcopy(entry['spell']))
+                for entry in entries if self._available(entry)]
+
+    def _available(self, entry):
+        """ Returns True if spell is available on macOS
+        """
+        if is_darwin() and 'localhost' in entry['cloud-whitelist']:
+            return False
+        return True
+
+    def find_all(self):
+        """ Returns every available spell
+        """
+        return self._results(self.by_key)
+
+    def find_exact(self, key):
+        """ Finds spells by category, then by spell key
+
+        Returns:
+        list of (category, spell) pairs
+        """
+        if key in self.categories:
+            return self._results(self.categories[key])
+        if key in self.by_key:
+            return self._results([key])
+        return []
+
+    def find_matching(self, key):
+        """ Finds spells by category, then by spell key, then by keywords
+
+        Returns:
+        list of (category, spell) pairs
+        """
+        if key in self.categories or key in self.by_key:
+            return self.find_exact(key)
+
+        tokens = tokenize(key)
+        if not tokens:
+            return []
+        matches = set(self.keywords.get(tokens[0], ()))
+        for token in tokens[1:]:
+            matches &= self.keywords.get(token, set())
+        return self._results(matches)
+
+
+def load(spells_dir):
+    """ Loads the compiled spells index, rebuilding it if the registry
+    has changed since it was compiled
+
+    Arguments:
+    spells_dir: spells registry directory
+
+    Returns:
+    SpellsIndex
+    """
+    revision = _registry_revision(spells_dir)
+    compiled_path = os.path.join(spells_dir, COMPILED_FILE)
+    try:
+        with open(compiled_path, 'rb') as f:
+            version, index = pickle.load(f)
+        if version == VERSION and index.revision == revision:
+            return index
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        app.log.debug('Rebuilding spells index: {}'.format(e))
+
+    index = SpellsIndex.build(spells_dir, revision)
+    tmp_path = '{}.{}.tmp'.format(compiled_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((VERSION, index), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, compiled_path)
+    except OSError as e:
+        app.log.debug('Unable to save spells index: {}'.format(e))
+    return index
@@ -5,7 +5,7 @@ import requests
 
 from conjureup import __version__ as VERSION
 from conjureup.app_config import app
-from conjureup.async import submit
+from conjureup.async import PRIORITY_LOW, submit
 
 GA_ID = "UA-1018242-61"
 SENTRY_DSN = ('https://27ee3b60dbb8412e8acf6bc159979165:'
@@ -22,7 +22,7 @@ def track_screen(screen_name):
         args['cd1'] = app.config['spell']
 
     submit(partial(_post_track, args), lambda _: None,
-           queue_name=TELEMETRY_ASYNC_QUEUE)
+           queue_name=TELEMETRY_ASYNC_QUEUE, priority=PRIORITY_LOW)
 
 
 def track_event(category, action, label):
@@ -36,7 +36,7 @@ def track_event(category, action, label):
     if 'spell' in app.config:
         args['cd1'] = app.config['spell']
     submit(partial(_post_track, args), lambda _: None,
-           queue_name=TELEMETRY_ASYNC_QUEUE)
+           queue_name=TELEMETRY_ASYNC_QUEUE, priority=PRIORITY_LOW)
 
 
 def track_exception(description, is_fatal=True):
@@ -50,7 +50,7 @@ def track_exception(description, is_fatal=True):
     if 'spell' in app.config:
         args['cd1'] = app.config['spell']
     submit(partial(_post_track, args), lambda _: None,
-           queue_name=TELEMETRY_ASYNC_QUEUE)
+           queue_name=TELEMETRY_ASYNC_QUEUE, priority=PRIORITY_LOW)
 
 
 def _post_track(arg_dict):
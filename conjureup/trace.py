@@ -0,0 +1,201 @@
+""" Deployment timeline tracing
+
+Records timed spans for event waits, steps, Juju API calls and
+subprocesses, and writes them out in the Chrome trace event format, which
+chrome://tracing and https://ui.perfetto.dev can open.
+
+Each asyncio task and thread gets its own lane in the timeline, so
+concurrent work shows up side by side.
+
+Usage:
+
+from conjureup import trace
+
+trace.enable('/tmp/deploy.json')
+
+@trace.traced('juju')
+async def deploy_service(service, ...):
+    ...
+
+with trace.span('step', step.title):
+    ...
+
+trace.save()
+
+Recording costs a single flag check while tracing is disabled.
+"""
+
+import asyncio
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+_enabled = False
+_path = None
+_epoch = time.monotonic()
+_records = []
+_lanes = {}
+
+
+def enable(path):
+    """ Starts recording spans, to be written to path by save()
+    """
+    global _enabled, _path, _epoch
+    _path = os.path.abspath(path)
+    _epoch = time.monotonic()
+    del _records[:]
+    _lanes.clear()
+    _enabled = True
+
+
+def is_enabled():
+    return _enabled
+
+
+def now():
+    """ Returns the current trace timestamp in microseconds
+    """
+    return (time.monotonic() - _epoch) * 1e6
+
+
+def _lane():
+    """ Returns the id of the current asyncio task, or thread if not in
+    a task, naming it the first time it is seen
+    """
+    task = None
+    if threading.current_thread() is threading.main_thread():
+        try:
+            task = asyncio.Task.current_task()
+        except RuntimeError:
+            pass  # no event loop
+    if task is not None:
+        lane = id(task)
+        if lane not in _lanes:
+            coro = getattr(task, '_coro', None)
+            _lanes[lane] = 'task {}'.format(
+                getattr(coro, '__qualname__', None) or repr(task))
+    else:
+        lane = threading.get_ident()
+        if lane not in _lanes:
+            _lanes[lane] = 'thread {}'.format(
+                threading.current_thread().name)
+    return lane
+
+
+def complete(cat, name, start, args=None):
+    """ Records a span that started at start and ends now
+
+    Arguments:
+    cat: category, eg. juju, step, event or subprocess
+    name: span name
+    start: timestamp from now()
+    args: dict of extra details shown for the span
+    """
+    if not _enabled:
+        return
+    record = {'ph': 'X', 'cat': cat, 'name': name, 'ts': start,
+              'dur': now() - start, 'tid': _lane()}
+    if args:
+        record['args'] = args
+    _records.append(record)
+
+
+def instant(cat, name, args=None):
+    """ Records a point in time, such as an event being set
+    """
+    if not _enabled:
+        return
+    record = {'ph': 'i', 's': 't', 'cat': cat, 'name': name, 'ts': now(),
+              'tid': _lane()}
+    if args:
+        record['args'] = args
+    _records.append(record)
+
+
+@contextmanager
+def span(cat, name, args=None):
+    """ Records the time spent in the with block, including any awaits
+    """
+    if not _enabled:
+        yield
+        return
+    start = now()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        if error is not None:
+            args = dict(args or {}, error=repr(error))
+        complete(cat, name, start, args)
+
+
+def traced(cat, name=None):
+    """ Decorator recording a span for each call of a function or
+    coroutine function
+
+    Arguments:
+    cat: span category
+    name: span name, or a callable taking the function's arguments and
+    returning the name, defaults to the function's name
+    """
+    def decorator(func):
+        def span_name(args, kwargs):
+            if name is None:
+                return func.__name__
+            if callable(name):
+                return name(*args, **kwargs)
+            return name
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await func(*args, **kwargs)
+                with span(cat, span_name(args, kwargs)):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with span(cat, span_name(args, kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def to_chrome_trace():
+    """ Returns the recorded spans as a Chrome trace object
+    """
+    pid = os.getpid()
+    trace_events = []
+    for lane, lane_name in sorted(_lanes.items()):
+        trace_events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid,
+                             'tid': lane, 'args': {'name': lane_name}})
+    for record in list(_records):
+        trace_events.append(dict(record, pid=pid))
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def save(path=None):
+    """ Writes the trace to the file given to enable()
+
+    Returns:
+    path written to, or None if tracing isn't enabled
+    """
+    path = path or _path
+    if not _enabled or path is None:
+        return None
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(to_chrome_trace(), f)
+    os.replace(tmp_path, path)
+    return path
@@ -79,7 +79,7 @@ class AppArchitectureView(WidgetWrap):
         if not self.buttons_selected:
             self.buttons_selected = True
             self.frame.focus_position = 'footer'
-            self.buttons.focus_position = 3
+            self.buttons.focus_position = len(self.buttons.contents) - 2
         else:
             self.buttons_selected = False
             self.frame.focus_position = 'body'
@@ -118,7 +118,7 @@ class AppArchitectureView(WidgetWrap):
                           label="\n  BACK\n")
         self.apply_button = menu_btn(on_press=self.do_commit,
                                      label="\n APPLY\n")
-        self.buttons = Columns([
+        buttons = [
             ('fixed', 2, Text("")),
             ('fixed', 13, Color.menu_button(
                 cancel,
@@ -128,7 +128,15 @@ class AppArchitectureView(WidgetWrap):
                 self.apply_button,
                 focus_map='button_primary focus')),
             ('fixed', 2, Text(""))
-        ])
+        ]
+        cloud_type = get_cloud_types_by_name()[app.provider.cloud]
+        if cloud_type == cloud_types.MAAS:
+            auto_place = menu_btn(on_press=self.do_auto_place,
+                                  label="\n AUTO PLACE\n")
+            buttons.insert(2, ('fixed', 20, Color.menu_button(
+                auto_place,
+                focus_map='button_primary focus')))
+        self.buttons = Columns(buttons)
 
         footer = Pile([
             HR(top=0),
@@ -228,6 +236,28 @@ class AppArchitectureView(WidgetWrap):
                             self.shadow_pins.items()
                             if m != maas_machine}
 
+    def do_auto_place(self, sender):
+        """Pin this application's unpinned machines to ready maas machines,
+        spread across zones
+        """
+        if not app.maas.client or app.maas.client.get_machines() is None:
+            self.description_w.set_text("MAAS machines are still loading.")
+            return
+        assignments = {j_m_id: self.get_all_assignments(j_m_id)
+                       for j_m_id, al in self.shadow_assignments.items()
+                       if len(al) > 0}
+        pins, unplaced = self.controller.auto_place_machines(
+            self._machines, assignments, self.shadow_pins)
+        self.shadow_pins.update(pins)
+        if unplaced:
+            self.description_w.set_text(
+                "No ready MAAS machine matches the constraints of "
+                "machine{} {}.".format("" if len(unplaced) == 1 else "s",
+                                       ", ".join(unplaced)))
+        else:
+            self.description_w.set_text("")
+        self.update_now()
+
     def get_constraints(self, juju_machine_id):
         cstr = self._machines[juju_machine_id].get(
             'constraints', {})
@@ -43,13 +43,17 @@ class FilterBox(WidgetWrap):
                   ])
         super().__init__(w)
 
-    def set_info(self, n_showing, n_total):
-        m = ["Filter ", ('label', "({} of {} shown): ".format(n_showing,
-                                                              n_total))]
+    def set_info(self, n_showing, n_total, error=None):
+        if error:
+            m = ["Filter ", ('error_major', "({}): ".format(error))]
+        else:
+            m = ["Filter ", ('label', "({} of {} shown): ".format(n_showing,
+                                                                  n_total))]
         self.editbox.set_caption(m)
         if False:   # WORKAROUND for issue #194
             t = ''
         else:
             t = ('label',
-                 "  Filter on hostname or hardware info like 'cores:4'")
+                 "  Filter on hostname or hardware like "
+                 "'cores>=8 mem>=64G zone:az1 tag:ssd status:ready'")
         self.info_text.set_text(t)
@@ -19,6 +19,12 @@ from operator import attrgetter
 from ubuntui.widgets.buttons import PlainButton
 from urwid import AttrMap, Columns, Divider, Pile, Text, WidgetWrap
 
+from conjureup.machine_filter import (
+    FilterError,
+    MachineIndex,
+    compile_filter,
+    juju_machine_fields
+)
 from conjureup.ui.widgets.filter_box import FilterBox
 from conjureup.ui.widgets.juju_machine_widget import JujuMachineWidget
 
@@ -74,6 +80,9 @@ class JujuMachinesList(WidgetWrap):
         self.show_filter_box = show_filter_box
         self.show_pins = show_pins
         self.filter_string = ""
+        self._index = MachineIndex()
+        self._filter = compile_filter("")
+        self._filter_error = None
         w = self.build_widgets(title_widgets)
         self.update()
         super().__init__(w)
@@ -129,6 +138,12 @@ class JujuMachinesList(WidgetWrap):
 
     def handle_filter_change(self, edit_button, userdata):
         self.filter_string = userdata
+        try:
+            self._filter = compile_filter(userdata)
+            self._filter_error = None
+        except FilterError as e:
+            # keep showing the last filter that worked
+            self._filter_error = str(e)
         self.update()
 
     def find_machine_widget(self, midx):
@@ -136,12 +151,15 @@ class JujuMachinesList(WidgetWrap):
                      mw.juju_machine_id == midx), None)
 
     def update(self):
+        for midx in list(self._index.fields):
+            if midx not in self.machines:
+                self._index.remove(midx)
+        for midx, md in self.machines.items():
+            self._index.add(midx, juju_machine_fields(midx, md))
+        matches = self._filter.match(self._index)
 
         for midx, md in sorted(self.machines.items()):
-            allvalues = ["{}={}".format(k, v) for k, v in md.items()]
-            filter_label = midx + " " + " ".join(allvalues)
-            if self.filter_string != "" and \
-               self.filter_string not in filter_label:
+            if matches is not None and midx not in matches:
                 self.remove_machine_widget(midx)
                 continue
 
@@ -151,8 +169,9 @@ class JujuMachinesList(WidgetWrap):
             mw.all_assigned = self.all_assigned
             mw.update()
 
-        n = len(self.machine_widgets)
-        self.filter_edit_box.set_info(n, n)
+        self.filter_edit_box.set_info(len(self.machine_widgets),
+                                      len(self.machines),
+                                      self._filter_error)
 
         self.sort_machine_widgets()
 
@@ -81,12 +81,9 @@ class MachineWidget(WidgetWrap):
         Assumes that machine exists - machines going away is handled
         in machineslist.update().
         """
-        machines = app.maas.client.get_machines()
-        if machines is None:
-            return
-        self.machine = next((m for m in machines
-                             if m.instance_id == self.machine.instance_id),
-                            None)
+        machine = app.maas.client.get_machine(self.machine.system_id)
+        if machine is not None:
+            self.machine = machine
 
     def __repr__(self):
         return "widget for " + str(self.machine)
@@ -14,12 +14,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses>.
 
 import logging
+from bisect import bisect_left
 
 from urwid import Columns, Divider, Pile, Text, WidgetWrap
 
 from conjureup.app_config import app
 from conjureup.juju import constraints_from_dict
-from conjureup.maas import MaasMachineStatus, satisfies
+from conjureup.maas import MaasMachineStatus, MachineMatcher
+from conjureup.machine_filter import (
+    FilterError,
+    MachineIndex,
+    compile_filter,
+    maas_machine_fields
+)
 from conjureup.ui.widgets.filter_box import FilterBox
 from conjureup.ui.widgets.machine_widget import MachineWidget
 
@@ -69,7 +76,19 @@ class MachinesList(WidgetWrap):
         self.current_pin_cb = current_pin_cb
 
         self.n_selected = 0
-        self.machine_widgets = []
+        # instance_id -> MachineWidget of the machines shown
+        self._widgets = {}
+        # (sort key, instance_id) of the machines shown, in display order
+        self._order = []
+        # instance_id -> machine the list was last updated with
+        self._seen = {}
+        # instance_ids of the machines matching the constraints
+        self._satisfying = set()
+        # fields of every machine seen, for the filter box
+        self._index = MachineIndex()
+        self._filter = compile_filter("")
+        self._filter_error = None
+        self._applied_filter = self._filter
         if constraints is None:
             self.constraints = {}
         else:
@@ -112,16 +131,25 @@ class MachinesList(WidgetWrap):
         header_label_col = Columns([Text(m) for m in labels])
         header_widgets.append(header_label_col)
         self.header_padding = len(header_widgets)
-        self.machine_pile = Pile(header_widgets + self.machine_widgets)
+        self.machine_pile = Pile(header_widgets)
         return self.machine_pile
 
     def handle_filter_change(self, edit_button, userdata):
         self.filter_string = userdata
+        try:
+            self._filter = compile_filter(userdata)
+            self._filter_error = None
+        except FilterError as e:
+            # keep showing the last filter that worked
+            self._filter_error = str(e)
         self.update()
 
+    @property
+    def machine_widgets(self):
+        return [self._widgets[instance_id] for _, instance_id in self._order]
+
     def find_machine_widget(self, m):
-        return next((mw for mw in self.machine_widgets if
-                     mw.machine.instance_id == m.instance_id), None)
+        return self._widgets.get(m.instance_id)
 
     def update(self):
         if app.maas.client:
@@ -141,47 +169,63 @@ class MachinesList(WidgetWrap):
             self.loading = False
             self.machine_pile.contents = self.machine_pile.contents[:-1]
 
-        if self.show_only_ready:
-            machines = [m for m in machines
-                        if m.status == MaasMachineStatus.READY]
-        for mw in self.machine_widgets:
-            machine = next((m for m in machines if
-                            mw.machine.instance_id == m.instance_id), None)
-            if machine is None:
-                self.remove_machine(mw.machine)
-
-        n_satisfying_machines = len(machines)
-
-        def get_placement_filter_label(d):
-            s = ""
-            for atype, al in d.items():
-                s += " ".join(["{} {}".format(cc.service_name,
-                                              cc.display_name)
-                               for cc in al])
-            return s
-
-        for m in machines:
-            if not satisfies(m, self.constraints)[0]:
-                self.remove_machine(m)
-                n_satisfying_machines -= 1
+        current = {m.instance_id: m for m in machines}
+        for instance_id in list(self._seen):
+            if instance_id not in current:
+                del self._seen[instance_id]
+                self._satisfying.discard(instance_id)
+                self._index.remove(instance_id)
+                self._remove_widget(instance_id)
+
+        # the client keeps the same object for machines that haven't
+        # changed, so only changed machines are checked again, unless
+        # the filter changed too
+        refilter = self._filter is not self._applied_filter
+        self._applied_filter = self._filter
+        changed_machines = [m for instance_id, m in current.items()
+                            if self._seen.get(instance_id) is not m]
+        for m in changed_machines:
+            self._satisfying.discard(m.instance_id)
+            self._index.add(m.instance_id, maas_machine_fields(m))
+        self._satisfying.update(m.instance_id
+                                for m in self._satisfies(changed_machines))
+
+        matches = self._filter.match(self._index)
+        for instance_id, m in current.items():
+            changed = self._seen.get(instance_id) is not m
+            if not changed and not refilter:
                 continue
+            self._seen[instance_id] = m
 
-            filter_label = m.filter_label()
-            if self.filter_string != "" and \
-               self.filter_string not in filter_label:
-                self.remove_machine(m)
+            if instance_id not in self._satisfying or (
+                    matches is not None and instance_id not in matches):
+                self._remove_widget(instance_id)
                 continue
 
-            mw = self.find_machine_widget(m)
+            mw = self._widgets.get(instance_id)
             if mw is None:
                 mw = self.add_machine_widget(m)
-
+            elif changed:
+                mw.machine = m
+                self._reposition_widget(mw)
             mw.update()
 
-        self.filter_edit_box.set_info(len(self.machine_widgets),
-                                      n_satisfying_machines)
+        self.filter_edit_box.set_info(len(self._widgets),
+                                      len(self._satisfying),
+                                      self._filter_error)
+
+    def _satisfies(self, machines):
+        """ Returns the machines matching the constraints
+        """
+        if self.show_only_ready:
+            machines = [m for m in machines
+                        if m.status == MaasMachineStatus.READY]
+        if not machines:
+            return []
+        return MachineMatcher(machines).match(self.constraints).machines()
 
-        self.sort_machine_widgets()
+    def _sort_key(self, m):
+        return m.sort_key
 
     def add_machine_widget(self, machine):
         mw = MachineWidget(machine,
@@ -189,48 +233,45 @@ class MachinesList(WidgetWrap):
                            self.handle_unselect,
                            self.target_info,
                            self.current_pin_cb)
-
-        self.machine_widgets.append(mw)
-        options = self.machine_pile.options()
-        self.machine_pile.contents.append((mw, options))
-
+        mw.sort_key = self._sort_key(machine)
+        self._widgets[machine.instance_id] = mw
+        self._insert_widget(mw)
         return mw
 
-    def remove_machine(self, machine):
-        mw = self.find_machine_widget(machine)
-        if mw is None:
+    def _insert_widget(self, mw):
+        entry = (mw.sort_key, mw.machine.instance_id)
+        idx = bisect_left(self._order, entry)
+        self._order.insert(idx, entry)
+        self.machine_pile.contents.insert(self.header_padding + idx,
+                                          (mw, self.machine_pile.options()))
+
+    def _detach_widget(self, mw):
+        idx = bisect_left(self._order, (mw.sort_key, mw.machine.instance_id))
+        del self._order[idx]
+        del self.machine_pile.contents[self.header_padding + idx]
+
+    def _reposition_widget(self, mw):
+        sort_key = self._sort_key(mw.machine)
+        if sort_key == mw.sort_key:
             return
+        self._detach_widget(mw)
+        mw.sort_key = sort_key
+        self._insert_widget(mw)
 
-        self.machine_widgets.remove(mw)
-        mw_idx = 0
-        for w, opts in self.machine_pile.contents:
-            if w == mw:
-                break
-            mw_idx += 1
-
-        c = self.machine_pile.contents[:mw_idx] + \
-            self.machine_pile.contents[mw_idx + 1:]
-        self.machine_pile.contents = c
-
-    def sort_machine_widgets(self):
-        def keyfunc(mw):
-            m = mw.machine
-            hwinfo = " ".join(map(str, [m.arch, m.cpu_cores, m.mem,
-                                        m.storage]))
-            if str(mw.machine.status) == 'ready':
-                skey = 'A'
-            else:
-                skey = str(mw.machine.status)
-            return skey + mw.machine.hostname + hwinfo
-        self.machine_widgets.sort(key=keyfunc)
+    def _remove_widget(self, instance_id):
+        mw = self._widgets.pop(instance_id, None)
+        if mw is not None:
+            self._detach_widget(mw)
 
-        def wrappedkeyfunc(t):
-            mw, options = t
-            if not isinstance(mw, MachineWidget):
-                return 'A'
-            return keyfunc(mw)
+    def remove_machine(self, machine):
+        self._remove_widget(machine.instance_id)
 
-        self.machine_pile.contents.sort(key=wrappedkeyfunc)
+    def update_pins(self):
+        """ Refreshes the pin buttons, which can change for any machine
+        when one is selected
+        """
+        for mw in self._widgets.values():
+            mw.update()
 
     def focus_prev_or_top(self):
         self.update()
@@ -244,8 +285,10 @@ class MachinesList(WidgetWrap):
         self.select_cb(machine)
         self.n_selected += 1
         self.update()
+        self.update_pins()
 
     def handle_unselect(self, machine):
         self.unselect_cb(machine)
         self.n_selected -= 1
         self.update()
+        self.update_pins()
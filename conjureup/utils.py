@@ -1,7 +1,6 @@
 import asyncio
 import codecs
 import errno
-import json
 import logging
 import os
 import pty
@@ -22,10 +21,9 @@ from bundleplacer.bundle import Bundle
 from bundleplacer.charmstore_api import MetadataController
 from bundleplacer.config import Config
 from pkg_resources import parse_version
-from raven.processors import SanitizePasswordsProcessor
 from termcolor import cprint
 
-from conjureup import charm
+from conjureup import charm, trace
 from conjureup.app_config import app
 from conjureup.telemetry import track_event
 
@@ -45,6 +43,15 @@ def chdir(directory):
         os.chdir(cur)
 
 
+def _trace_name(cmd, *args, **kwargs):
+    """ Names the trace span of a command
+    """
+    if not isinstance(cmd, str):
+        cmd = ' '.join(map(str, cmd))
+    return cmd if len(cmd) <= 80 else cmd[:77] + '...'
+
+
+@trace.traced('subprocess', name=_trace_name)
 def run(cmd, **kwargs):
     """ Compatibility function to support python 3.4
     """
@@ -63,6 +70,7 @@ def run_script(path, stderr=PIPE, stdout=PIPE):
     return run(path, shell=True, stderr=stderr, stdout=stdout, env=app.env)
 
 
+@trace.traced('subprocess', name=_trace_name)
 def run_attach(cmd, output_cb=None):
     """ run command and attach output to cb
 
@@ -127,6 +135,7 @@ def run_attach(cmd, output_cb=None):
                                          subproc.returncode))
 
 
+@trace.traced('subprocess', name=_trace_name)
 async def arun(cmd, input=None, check=False, env=None, encoding='utf8',
                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                stderr=subprocess.PIPE, **kwargs):
@@ -417,6 +426,20 @@ def setup_metadata_controller():
 
     bundle = Bundle(bundle_data=bundle_data)
     app.metadata_controller = MetadataController(bundle, Config('bundle-cfg'))
+    app.loop.create_task(prefetch_charm_ids(bundle))
+
+
+async def prefetch_charm_ids(bundle):
+    """ Resolves the revisions of the bundle's unpinned charms in the
+    background so deploy doesn't have to wait on the charm store
+    """
+    try:
+        await charm.resolve_charm_ids(
+            [service.csid for service in bundle.services],
+            bundle.series, app.argv.channel)
+    except Exception as e:
+        # deploy will retry any charms left unresolved
+        app.log.debug('Unable to prefetch charm revisions: {}'.format(e))
 
 
 def set_chosen_spell(spell_name, spell_dir):
@@ -448,44 +471,22 @@ def get_spell_metadata(spell):
     return metadata
 
 
-def __available_on_darwin(key):
-    """ Returns True if spell is available on macOS
+def find_spells():
+    """ Find spells, excluding localhost only spells if not linux
     """
-    metadata = get_spell_metadata(key)
-    if is_darwin() and 'cloud-whitelist' in metadata \
-       and 'localhost' in metadata['cloud-whitelist']:
-        return False
-    return True
+    return app.spells_index.find_all()
 
 
-def find_spells():
-    """ Find spells, excluding localhost only spells if not linux
+def find_spells_exact(key):
+    """ Find spells by category or spell key only
     """
-    _spells = []
-    for category, cat_dict in app.spells_index.items():
-        for sd in cat_dict['spells']:
-            if not __available_on_darwin(sd['key']):
-                continue
-            _spells.append((category, sd))
-    return _spells
+    return app.spells_index.find_exact(key)
 
 
 def find_spells_matching(key):
-    if key in app.spells_index:
-        _spells = []
-        for sd in app.spells_index[key]['spells']:
-            if not __available_on_darwin(sd['key']):
-                continue
-            _spells.append((key, sd))
-        return _spells
-
-    for category, d in app.spells_index.items():
-        for spell in d['spells']:
-            if spell['key'] == key:
-                if not __available_on_darwin(spell['key']):
-                    continue
-                return [(category, spell)]
-    return []
+    """ Find spells by category, spell key or keywords
+    """
+    return app.spells_index.find_matching(key)
 
 
 def get_options_whitelist(service_name):
@@ -656,60 +657,6 @@ class IterQueue(asyncio.Queue):
         await self.put(self.sentinal)
 
 
-class SanitizeDataProcessor(SanitizePasswordsProcessor):
-    """
-    Sanitize data sent to Sentry.
-
-    Performs the same santiziations as the SanitizePasswordsProcessor, but
-    also sanitizes values.
-    """
-
-    def sanitize(self, key, value):
-        value = super().sanitize(key, value)
-
-        if value is None:
-            return value
-
-        def _check_str(s):
-            sl = s.lower()
-            for field in self.FIELDS:
-                if field not in sl:
-                    continue
-                if 'invalid' in s or 'error' in s:
-                    return '***(contains invalid {})***'.format(field)
-                else:
-                    return '***(contains {})***'.format(field)
-            return s
-
-        if isinstance(value, str):
-            # handle basic strings
-            value = _check_str(value)
-        elif isinstance(value, bytes):
-            # handle bytes
-            value = _check_str(value.decode('utf8', 'replace'))
-        elif isinstance(value, (list, tuple, set)):
-            # handle list-like
-            orig_type = type(value)
-            value = list(value)
-            for i, item in enumerate(value):
-                value[i] = self.sanitize(key, item)
-            value = orig_type(value)
-        elif isinstance(value, dict):
-            # handle dicts
-            for key, value in value.items():
-                value[key] = self.sanitize(key, value)
-        else:
-            # handle everything else by sanitizing its JSON encoding
-            # note that we don't want to use the JSON encoded value if it's
-            # not being santizied, because it will end up double-encoded
-            value_json = json.dumps(value)
-            sanitized = _check_str(value_json)
-            if sanitized != value_json:
-                value = sanitized
-
-        return value
-
-
 class TestError(Exception):
     def __init__(self):
         super().__init__('This is a dummy error for testing reporting')
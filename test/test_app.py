@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#
+# tests app.py
+#
+# Copyright Canonical, Ltd.
+
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch, sentinel
+
+from conjureup import app as conjureup_app
+from conjureup.download import EndpointType
+
+from .helpers import test_loop
+
+
+class CheckJujuDataTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.juju_dir = self.tmpdir.name
+        for name in ('accounts.yaml', 'controllers.yaml'):
+            with open(os.path.join(self.juju_dir, name), 'w') as f:
+                f.write('{}')
+
+    def tearDown(self):
+        os.chmod(os.path.join(self.juju_dir, 'accounts.yaml'), 0o644)
+        self.tmpdir.cleanup()
+
+    def test_missing_dir(self):
+        "app.check_juju_data ignores a missing data dir"
+        missing = os.path.join(self.juju_dir, 'missing')
+        assert conjureup_app.check_juju_data(missing) == []
+
+    def test_readable(self):
+        "app.check_juju_data accepts readable files"
+        assert conjureup_app.check_juju_data(self.juju_dir) == []
+
+    @unittest.skipIf(os.geteuid() == 0, 'root can read any file')
+    def test_unreadable(self):
+        "app.check_juju_data reports unreadable files"
+        path = os.path.join(self.juju_dir, 'accounts.yaml')
+        os.chmod(path, 0)
+        assert conjureup_app.check_juju_data(self.juju_dir) == [path]
+
+
+class PreflightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.calls = []
+
+        def record(name, delay=0, result=None):
+            def func(*args):
+                with self.lock:
+                    self.calls.append(('start', name))
+                time.sleep(delay)
+                with self.lock:
+                    self.calls.append(('finish', name))
+                return result
+            return func
+
+        self.record = record
+        self.app_patcher = patch.object(conjureup_app, 'app')
+        self.mock_app = self.app_patcher.start()
+        self.mock_app.argv.spell = 'openstack'
+        self.mock_app.endpoint_type = EndpointType.LOCAL_SEARCH
+
+        for name, func in [
+                ('check_juju_data', record('juju-data', result=[])),
+                ('sync_registry', record('registry-sync', 0.1)),
+                ('load_spells_index', record('spells-index', 0.05)),
+                ('load_spell', record('spell'))]:
+            patcher = patch.object(conjureup_app, name, func)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(conjureup_app.utils, 'juju_version',
+                               record('juju-version', 0.1, sentinel.version))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.app_patcher.stop()
+
+    def test_ordering(self):
+        "app.preflight only orders the stages that depend on each other"
+        with test_loop() as loop:
+            self.mock_app.loop = loop
+            conjureup_app.preflight('stable')
+
+        calls = self.calls
+        assert calls.index(('finish', 'registry-sync')) < \
+            calls.index(('start', 'spells-index'))
+        assert calls.index(('finish', 'spells-index')) < \
+            calls.index(('start', 'spell'))
+        # the juju version check overlaps the registry sync
+        assert calls.index(('start', 'juju-version')) < \
+            calls.index(('finish', 'registry-sync'))
+        assert calls.index(('start', 'registry-sync')) < \
+            calls.index(('finish', 'juju-version'))
+
+        logged = ' '.join(str(call) for call in
+                          self.mock_app.log.debug.call_args_list)
+        for stage in ('juju-data', 'juju-version', 'registry-sync',
+                      'spells-index', 'spell', 'preflight'):
+            assert 'Start up: {} took'.format(stage) in logged
+
+    def test_spell_from_dir(self):
+        "app.preflight loads a local spell without waiting on the index"
+        self.mock_app.endpoint_type = EndpointType.LOCAL_DIR
+        with test_loop() as loop:
+            self.mock_app.loop = loop
+            conjureup_app.preflight()
+
+        assert ('start', 'registry-sync') not in self.calls
+        assert self.calls.index(('start', 'spell')) < \
+            self.calls.index(('finish', 'spells-index'))
+
+    def test_unreadable_juju_data(self):
+        "app.preflight fails if the juju data can't be read"
+        with patch.object(conjureup_app, 'check_juju_data',
+                          MagicMock(return_value=['accounts.yaml'])):
+            with test_loop() as loop:
+                self.mock_app.loop = loop
+                with self.assertRaises(conjureup_app.PreflightError):
+                    conjureup_app.preflight()
+
+
+class BackgroundRegistrySyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app_patcher = patch('conjureup.app.app')
+        self.mock_app = self.app_patcher.start()
+        self.sync_patcher = patch('conjureup.app.download_or_sync_registry',
+                                  side_effect=PermissionError('denied'))
+        self.sync_patcher.start()
+        self.load_patcher = patch('conjureup.app.load_spells_index')
+        self.mock_load = self.load_patcher.start()
+
+    def tearDown(self):
+        self.load_patcher.stop()
+        self.sync_patcher.stop()
+        self.app_patcher.stop()
+
+    def test_os_error(self):
+        "app._sync_registry gives up quietly on filesystem errors"
+        with test_loop() as loop:
+            self.mock_app.loop = loop
+            loop.run_until_complete(conjureup_app._sync_registry('stable'))
+        assert not self.mock_load.called
+
+
+class LoadSpellTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app_patcher = patch.object(conjureup_app, 'app')
+        self.mock_app = self.app_patcher.start()
+        self.mock_app.endpoint_type = EndpointType.LOCAL_SEARCH
+        self.mock_app.argv.cloud = None
+        self.utils_patcher = patch.object(conjureup_app, 'utils')
+        self.mock_utils = self.utils_patcher.start()
+        self.mock_utils.find_spells_exact.return_value = []
+        self.mock_utils.find_spells_matching.return_value = [
+            ('kubernetes', {'key': 'kubernetes-core'})]
+        self.download_patcher = patch.object(conjureup_app, 'download_local')
+        self.mock_download = self.download_patcher.start()
+
+    def tearDown(self):
+        self.download_patcher.stop()
+        self.utils_patcher.stop()
+        self.app_patcher.stop()
+
+    def test_keyword_match(self):
+        "app.load_spell leaves a single keyword match to the picker"
+        conjureup_app.load_spell('minimal')
+        assert not self.mock_download.called
+        assert self.mock_app.endpoint_type == EndpointType.LOCAL_SEARCH
+
+    def test_keyword_match_headless(self):
+        "app.load_spell lists keyword matches instead of deploying one"
+        self.mock_app.argv.cloud = 'localhost'
+        with self.assertRaises(conjureup_app.PreflightError) as cm:
+            conjureup_app.load_spell('minimal')
+        assert 'kubernetes-core' in str(cm.exception)
+        assert not self.mock_download.called
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+#
+# tests async.py
+#
+# Copyright Canonical, Ltd.
+
+
+import itertools
+import threading
+import time
+import unittest
+from concurrent.futures import wait
+from unittest.mock import patch
+
+from conjureup.async import (
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+    CancelToken,
+    JobQueue,
+    ThreadCancelledException,
+    TimerService,
+    get_queue,
+    sleep_until
+)
+
+
+class JobQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.shutdown()
+
+    def make_queue(self, workers=1):
+        queue = JobQueue('test', workers)
+        self.queues.append(queue)
+        return queue
+
+    def block(self, queue):
+        """ Occupies the queue's only worker until the returned event is set
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocker():
+            started.set()
+            release.wait(5)
+        queue.submit(blocker, kind='blocker')
+        assert started.wait(5)
+        return release
+
+    def test_priority(self):
+        "async.JobQueue runs queued jobs in priority order"
+        queue = self.make_queue()
+        release = self.block(queue)
+        order = []
+        futures = [
+            queue.submit(lambda: order.append('low'), PRIORITY_LOW),
+            queue.submit(lambda: order.append('normal')),
+            queue.submit(lambda: order.append('high'), PRIORITY_HIGH),
+            queue.submit(lambda: order.append('normal-2')),
+        ]
+        release.set()
+        wait(futures, 5)
+        assert order == ['high', 'normal', 'normal-2', 'low']
+
+    def test_workers(self):
+        "async.JobQueue runs up to its worker count at once"
+        queue = self.make_queue(workers=3)
+        barrier = threading.Barrier(3, timeout=5)
+        futures = [queue.submit(barrier.wait) for _ in range(3)]
+        wait(futures, 10)
+        assert all(f.exception() is None for f in futures)
+
+    def test_workers_after_idle(self):
+        "async.JobQueue grows past an idle worker for a burst of jobs"
+        queue = self.make_queue(workers=3)
+        queue.submit(lambda: None).result(5)
+        barrier = threading.Barrier(3, timeout=5)
+        futures = [queue.submit(barrier.wait) for _ in range(3)]
+        wait(futures, 10)
+        assert all(f.exception() is None for f in futures)
+
+    def test_coalesce(self):
+        "async.JobQueue shares the future of a queued job with the same key"
+        queue = self.make_queue()
+        release = self.block(queue)
+        calls = []
+        first = queue.submit(lambda: calls.append(1) or 'machines',
+                             key='machines')
+        second = queue.submit(lambda: calls.append(2) or 'other',
+                              key='machines')
+        assert first is second
+        release.set()
+        assert first.result(5) == 'machines'
+        assert calls == [1]
+        assert queue.stats()['kinds']['machines']['coalesced'] == 1
+
+        # once finished, the key runs again
+        third = queue.submit(lambda: 'again', key='machines')
+        assert third is not first
+        assert third.result(5) == 'again'
+
+    def test_resubmit_when_done(self):
+        "async.JobQueue runs a key again once its result is available"
+        queue = self.make_queue()
+        resubmitted = []
+        first = queue.submit(lambda: 'first', key='machines')
+        first.add_done_callback(lambda f: resubmitted.append(
+            queue.submit(lambda: 'second', key='machines')))
+        first.result(5)
+        assert resubmitted[0] is not first
+        assert resubmitted[0].result(5) == 'second'
+
+    def test_cancel_token(self):
+        "async.JobQueue skips queued jobs whose token was cancelled"
+        queue = self.make_queue()
+        release = self.block(queue)
+        token = CancelToken()
+        calls = []
+        future = queue.submit(lambda: calls.append(1), kind='append',
+                              token=token)
+        token.cancel()
+        release.set()
+        wait([future], 5)
+        assert future.cancelled()
+        assert calls == []
+        assert queue.stats()['kinds']['append']['cancelled'] == 1
+
+    def waiter(self, future):
+        """ Waits on future from another thread, returns an event set once
+        the wait returns without timing out
+        """
+        woken = threading.Event()
+
+        def wait_for_future():
+            if wait([future], 5).done:
+                woken.set()
+        threading.Thread(target=wait_for_future, daemon=True).start()
+        time.sleep(0.1)
+        return woken
+
+    def test_cancel_token_wakes_waiters(self):
+        "async.JobQueue wakes up threads waiting on a cancelled job"
+        queue = self.make_queue()
+        release = self.block(queue)
+        token = CancelToken()
+        future = queue.submit(lambda: None, token=token)
+        woken = self.waiter(future)
+        token.cancel()
+        release.set()
+        assert woken.wait(1)
+        assert future.cancelled()
+
+    def test_sleep_until_token(self):
+        "async.sleep_until stops when its token is cancelled"
+        token = CancelToken()
+        token.cancel()
+        with self.assertRaises(ThreadCancelledException):
+            sleep_until(5, token)
+
+    def test_stats(self):
+        "async.JobQueue records depth, errors and timings per job kind"
+        queue = self.make_queue()
+        release = self.block(queue)
+
+        def fail():
+            raise ValueError('failed')
+        ok = queue.submit(lambda: None, kind='ok')
+        failed = queue.submit(fail)
+        stats = queue.stats()
+        assert stats['queued'] == 2
+        assert stats['running'] == 1
+
+        release.set()
+        wait([ok, failed], 5)
+        assert isinstance(failed.exception(), ValueError)
+        queue.shutdown()
+        for thread in queue._threads:
+            thread.join(5)
+        kinds = queue.stats()['kinds']
+        assert kinds['ok']['count'] == 1
+        assert kinds['ok']['errors'] == 0
+        assert kinds['JobQueueTestCase.test_stats.<locals>.fail'][
+            'errors'] == 1
+        assert kinds['blocker']['run_max'] > 0
+
+    def test_shutdown(self):
+        "async.JobQueue cancels queued jobs when shut down"
+        queue = self.make_queue()
+        release = self.block(queue)
+        future = queue.submit(lambda: None)
+        queue.shutdown()
+        release.set()
+        assert future.cancelled()
+        with self.assertRaises(RuntimeError):
+            queue.submit(lambda: None)
+
+    def test_shutdown_wakes_waiters(self):
+        "async.JobQueue wakes up threads waiting on jobs it cancels"
+        queue = self.make_queue()
+        release = self.block(queue)
+        future = queue.submit(lambda: None)
+        woken = self.waiter(future)
+        queue.shutdown()
+        assert woken.wait(1)
+        release.set()
+
+
+class TimerServiceTestCase(unittest.TestCase):
+    # test case instances are freed after each test, so id(self) repeats
+    queue_ids = itertools.count()
+
+    def setUp(self):
+        self.timers = TimerService()
+        self.queue_name = 'timer-test-{}'.format(next(self.queue_ids))
+
+    def tearDown(self):
+        self.timers.shutdown()
+        get_queue(self.queue_name).shutdown()
+
+    def test_call_later(self):
+        "async.TimerService submits a delayed job once it is due"
+        done = threading.Event()
+        started = time.monotonic()
+        self.timers.schedule(0.1, done.set, queue_name=self.queue_name)
+        assert self.timers.pending() == 1
+        assert done.wait(5)
+        assert time.monotonic() - started >= 0.1
+        assert self.timers.pending() == 0
+
+    def test_ordering(self):
+        "async.TimerService wakes up for a timer due before the current one"
+        order = []
+        done = threading.Event()
+        self.timers.schedule(0.3, lambda: order.append('late') or done.set(),
+                             queue_name=self.queue_name)
+        self.timers.schedule(0.05, lambda: order.append('early'),
+                             queue_name=self.queue_name)
+        assert done.wait(5)
+        assert order == ['early', 'late']
+
+    def test_periodic(self):
+        "async.TimerService repeats periodic jobs until cancelled"
+        runs = []
+        enough = threading.Event()
+
+        def tick():
+            runs.append(time.monotonic())
+            if len(runs) == 3:
+                enough.set()
+        timer = self.timers.schedule(0.02, tick, interval=0.02, jitter=0.5,
+                                     queue_name=self.queue_name)
+        assert enough.wait(5)
+        timer.cancel()
+        assert self.timers.pending() == 0
+        count = len(runs)
+        time.sleep(0.1)
+        assert len(runs) <= count + 1
+
+    def test_periodic_not_submitted(self):
+        "async.TimerService cancels periodic timers it couldn't submit"
+        with patch('conjureup.async.submit', return_value=None) as submit:
+            timer = self.timers.schedule(0.01, lambda: None, interval=0.01,
+                                         queue_name=self.queue_name)
+            deadline = time.monotonic() + 5
+            while self.timers.pending() and time.monotonic() < deadline:
+                time.sleep(0.01)
+        assert timer.cancelled
+        assert self.timers.pending() == 0
+        submit.assert_called_once()
+
+    def test_replaces_closed_queue(self):
+        "async.get_queue replaces a queue that has been shut down"
+        queue = get_queue(self.queue_name)
+        queue.shutdown()
+        assert get_queue(self.queue_name) is not queue
+        assert get_queue(self.queue_name).submit(lambda: 1).result(5) == 1
+
+    def test_shutdown(self):
+        "async.TimerService cancels pending timers on shutdown"
+        calls = []
+        timer = self.timers.schedule(0.1, lambda: calls.append(1),
+                                     queue_name=self.queue_name)
+        self.timers.shutdown()
+        assert timer.cancelled
+        assert self.timers.pending() == 0
+        time.sleep(0.2)
+        assert calls == []
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# tests charm.py
+#
+# Copyright Canonical, Ltd.
+
+
+import json
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from unittest.mock import patch
+
+from bundleplacer.charmstore_api import CharmStoreID
+
+from conjureup import charm
+
+from .helpers import test_loop
+
+
+class CharmRevisionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache_file = Path(self.cache_dir.name) / 'charm-revisions.json'
+        self.app_patcher = patch('conjureup.charm.app')
+        self.mock_app = self.app_patcher.start()
+        self.mock_app.argv.cache_dir = self.cache_dir.name
+        self.info_patcher = patch('conjureup.charm.get_channel_info',
+                                  side_effect=self.channel_info)
+        self.mock_info = self.info_patcher.start()
+        charm._revisions.clear()
+        charm._pending_revisions.clear()
+
+    def tearDown(self):
+        charm._revisions.clear()
+        charm._pending_revisions.clear()
+        self.info_patcher.stop()
+        self.app_patcher.stop()
+        self.cache_dir.cleanup()
+
+    def channel_info(self, name, channel):
+        return {'Id': 'cs:{}-7'.format(name)}
+
+    def resolve(self, loop, ids):
+        self.mock_app.loop = loop
+        loop.run_until_complete(charm.resolve_charm_ids(
+            [CharmStoreID(i) for i in ids], 'xenial', 'stable'))
+
+    def test_resolve(self):
+        "Unpinned charms are resolved once and cached on disk"
+        with test_loop() as loop:
+            self.resolve(loop, ['mysql', 'cs:xenial/wordpress', 'nova-3'])
+            assert self.mock_info.call_count == 2
+            self.resolve(loop, ['mysql'])
+            assert self.mock_info.call_count == 2
+            charm_id = loop.run_until_complete(charm.get_charm_id(
+                CharmStoreID('mysql'), 'xenial', 'stable'))
+        assert charm_id == 'cs:xenial/mysql-7'
+        cache = json.loads(self.cache_file.read_text())
+        assert cache['stable']['xenial/wordpress']['id'] == \
+            'cs:xenial/wordpress-7'
+
+    def test_disk_cache(self):
+        "Fresh revisions are read from disk, stale ones looked up again"
+        self.cache_file.write_text(json.dumps({'stable': {
+            'xenial/mysql': {'id': 'cs:xenial/mysql-1', 'time': time.time()},
+            'xenial/nova': {'id': 'cs:xenial/nova-1', 'time': 0},
+        }}))
+        with test_loop() as loop:
+            self.resolve(loop, ['mysql', 'nova'])
+        self.mock_info.assert_called_once_with('xenial/nova', 'stable')
+        assert charm._revisions[('stable', 'xenial/mysql')] == \
+            'cs:xenial/mysql-1'
+        assert charm._revisions[('stable', 'xenial/nova')] == \
+            'cs:xenial/nova-7'
+
+    def test_pinned(self):
+        "Charms with a revision aren't looked up"
+        with test_loop() as loop:
+            charm_id = loop.run_until_complete(charm.get_charm_id(
+                CharmStoreID('cs:trusty/mysql-3'), 'xenial', 'stable'))
+        assert charm_id == 'cs:trusty/mysql-3'
+        assert not self.mock_info.called
+
+
+class CharmStoreStandIn(BaseHTTPRequestHandler):
+    etag = '"rev-1"'
+    requests = []
+    status = None
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.status is not None:
+            self.send_response(self.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps({'Id': 'cs:xenial/mysql-57'}).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CharmHTTPCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.app_patcher = patch('conjureup.charm.app')
+        self.mock_app = self.app_patcher.start()
+        self.mock_app.argv.cache_dir = self.cache_dir.name
+        CharmStoreStandIn.requests = []
+        CharmStoreStandIn.status = None
+        self.server = HTTPServer(('127.0.0.1', 0), CharmStoreStandIn)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.cs_patcher = patch('conjureup.charm.cs', 'http://{}:{}'.format(
+            *self.server.server_address))
+        self.cs_patcher.start()
+        self.stats_patcher = patch.dict(charm.http_cache_stats,
+                                        {'hits': 0, 'misses': 0, 'stale': 0})
+        self.stats_patcher.start()
+
+    def tearDown(self):
+        self.stop_server()
+        self.stats_patcher.stop()
+        self.cs_patcher.stop()
+        self.app_patcher.stop()
+        self.cache_dir.cleanup()
+
+    def stop_server(self):
+        if self.server_thread.is_alive():
+            self.server.shutdown()
+            self.server.server_close()
+            self.server_thread.join()
+
+    def test_revalidates(self):
+        "Cached responses are revalidated with their ETag"
+        for i in range(2):
+            info = charm.get_channel_info('mysql')
+            assert info == {'Id': 'cs:xenial/mysql-57'}
+        assert charm.http_cache_stats == {'hits': 1, 'misses': 1,
+                                          'stale': 0}
+        assert len(CharmStoreStandIn.requests) == 2
+
+    def test_offline(self):
+        "Cached responses are served when the charm store is unreachable"
+        charm.get_channel_info('mysql')
+        self.stop_server()
+        assert charm.get_channel_info('mysql') == {'Id': 'cs:xenial/mysql-57'}
+        assert charm.http_cache_stats['stale'] == 1
+        with self.assertRaises(Exception):
+            charm.get_channel_info('wordpress')
+
+    def test_server_error(self):
+        "Cached responses are served when the charm store fails"
+        charm.get_channel_info('mysql')
+        CharmStoreStandIn.status = 503
+        assert charm.get_channel_info('mysql') == {'Id': 'cs:xenial/mysql-57'}
+        assert charm.http_cache_stats['stale'] == 1
+        with self.assertRaises(Exception):
+            charm.get_channel_info('wordpress')
+
+    def test_timeout(self):
+        "Requests time out rather than hanging"
+        session = charm.get_session()
+        with patch.object(session, 'get', wraps=session.get) as mock_get:
+            charm.get_channel_info('mysql')
+        assert mock_get.call_args[1]['timeout'] == charm.HTTP_TIMEOUT
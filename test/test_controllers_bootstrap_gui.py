@@ -23,7 +23,7 @@ class BootstrapGUIRenderTestCase(unittest.TestCase):
         self.controller.do_bootstrap = AsyncMock()
         self.controller.wait = MagicMock(
             return_value=sentinel.wait)
-        self.controller.is_existing_controller = MagicMock()
+        self.controller.is_existing_controller = AsyncMock()
 
         self.controllers_patcher = patch(
             'conjureup.controllers.bootstrap.gui.controllers')
@@ -58,8 +58,18 @@ class BootstrapGUIRenderTestCase(unittest.TestCase):
         self.track_screen_patcher.stop()
 
     def test_render(self):
-        self.controller.run = MagicMock(return_value=sentinel.run)
+        self.controller._render = MagicMock(return_value=sentinel._render)
         self.controller.render()
+        self.mock_app.loop.create_task.assert_called_once_with(
+            sentinel._render)
+
+    def test__render(self):
+        self.controller.run = MagicMock(return_value=sentinel.run)
+        self.mock_app.is_jaas = False
+        self.controller.is_existing_controller.return_value = False
+        self.mock_app.provider.controller = 'controller'
+        with test_loop() as loop:
+            loop.run_until_complete(self.controller._render())
         self.assertEqual(self.mock_app.loop.create_task.mock_calls, [
             call(sentinel.run),
             call(sentinel.wait)])
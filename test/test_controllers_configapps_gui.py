@@ -5,11 +5,16 @@
 # Copyright 2016 Canonical, Ltd.
 
 
+import asyncio
 import unittest
 from unittest.mock import MagicMock, patch, sentinel
 
 from conjureup import events
 from conjureup.controllers.configapps.gui import ConfigAppsController
+from conjureup.placement import zone_name
+
+from .helpers import test_loop
+from .test_placement import node
 
 
 class ConfigAppsGUIRenderTestCase(unittest.TestCase):
@@ -109,3 +114,70 @@ class ConfigAppsGUIFinishTestCase(unittest.TestCase):
         events.Bootstrapped.clear()
         self.controller.finish()
         self.mock_controllers.use.assert_called_once_with('bootstrap')
+
+
+class ConfigAppsGUIMaasTagsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with patch.object(ConfigAppsController, 'init_machines_assignments'):
+            self.controller = ConfigAppsController()
+        self.app_patcher = patch(
+            'conjureup.controllers.configapps.gui.app')
+        self.mock_app = self.app_patcher.start()
+        self.mock_assign = self.mock_app.maas.client.assign_id_tags
+        self.mock_assign.side_effect = lambda nodes: {
+            m.system_id: True for m in nodes}
+
+        for j_m_id, system_id in [('0', 'aaaaaa'), ('1', 'bbbbbb')]:
+            maas_machine = MagicMock(system_id=system_id)
+            maas_machine.instance_id = '/MAAS/api/2.0/machines/{}/'.format(
+                system_id)
+            self.controller.maas_machine_map[j_m_id] = maas_machine
+
+    def tearDown(self):
+        self.app_patcher.stop()
+
+    def test_get_maas_constraints(self):
+        "configapps.gui.test_get_maas_constraints tags pins in one call"
+        with test_loop() as loop:
+            self.mock_app.loop = loop
+            constraints = loop.run_until_complete(asyncio.gather(
+                self.controller.get_maas_constraints('0'),
+                self.controller.get_maas_constraints('1'),
+                self.controller.get_maas_constraints('2')))
+        assert constraints == ['tags=aaaaaa', 'tags=bbbbbb', '']
+        assert self.mock_assign.call_count == 1
+        assert len(self.mock_assign.call_args[0][0]) == 2
+
+
+class ConfigAppsGUIAutoPlaceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with patch.object(ConfigAppsController, 'init_machines_assignments'):
+            self.controller = ConfigAppsController()
+        self.app_patcher = patch(
+            'conjureup.controllers.configapps.gui.app')
+        self.mock_app = self.app_patcher.start()
+        self.nodes = [node(0, zone='a'), node(1, zone='a'),
+                      node(2, zone='b'), node(3, zone='b', cores=1)]
+        self.mock_app.maas.client.get_machines.return_value = self.nodes
+        self.mysql = MagicMock(service_name='mysql')
+        self.machines = {'0': {}, '1': {}, '2': {'constraints': 'cores=2'},
+                         '3': {}}
+
+    def tearDown(self):
+        self.app_patcher.stop()
+
+    def test_auto_place_machines(self):
+        "configapps.gui.auto_place_machines spreads apps and commits nothing"
+        assignments = {'0': [(self.mysql, sentinel.atype)],
+                       '1': [(self.mysql, sentinel.atype)],
+                       '2': [(self.mysql, sentinel.atype)],
+                       '3': []}
+        pins, unplaced = self.controller.auto_place_machines(
+            self.machines, assignments, {'0': self.nodes[0]})
+        assert sorted(pins) == ['1', '2']
+        assert {zone_name(pins['1']), zone_name(pins['2'])} == {'a', 'b'}
+        assert pins['2'] is not self.nodes[3]
+        assert unplaced == []
+        assert self.controller.maas_machine_map == {}
@@ -9,9 +9,10 @@ import asyncio
 import unittest
 from unittest.mock import MagicMock, patch
 
+from conjureup import events
 from conjureup.controllers.deploy import common
 
-from .helpers import test_loop
+from .helpers import AsyncMock, test_loop
 
 
 class DeployCommonDoDeployTestCase(unittest.TestCase):
@@ -34,9 +35,14 @@ class DeployCommonDoDeployTestCase(unittest.TestCase):
         self.mock_juju = self.juju_patcher.start()
 
         self.mock_pre_deploy.return_value = dummy()
-        self.mock_juju.add_machines.return_value = dummy()
-        self.mock_juju.deploy_service.return_value = dummy()
-        self.mock_juju.set_relations.return_value = dummy()
+        self.mock_juju.reconcile_model = AsyncMock(return_value=({}, {}))
+        self.mock_juju.add_machines = AsyncMock(return_value={'0': '3'})
+        self.mock_juju.deploy_service = AsyncMock()
+        self.mock_juju.add_relation = AsyncMock()
+        self.mock_juju.add_units = AsyncMock()
+        self.mock_app.argv.deploy_concurrency = 2
+        self.mock_juju.aget_cloud_types_by_name = AsyncMock(
+            return_value=MagicMock())
 
     def tearDown(self):
         self.pre_deploy_patcher.stop()
@@ -44,13 +50,14 @@ class DeployCommonDoDeployTestCase(unittest.TestCase):
         self.events_app_patcher.stop()
         self.juju_patcher.stop()
 
-    def test_do_deploy(self):
-        "call do_deploy"
-        self.mock_app.metadata_controller.bundle.services = [
-            MagicMock(service_name='service'),
-        ]
+    def service(self, service_name, placement_spec, relations):
+        return MagicMock(service_name=service_name,
+                         placement_spec=placement_spec,
+                         relations=relations,
+                         subordinate=False,
+                         num_units=1)
 
-        msg_cb = MagicMock()
+    def run_deploy(self, msg_cb):
         with test_loop() as loop:
             # have to patch out the event because the existing one is
             # attached to a different event loop
@@ -59,7 +66,103 @@ class DeployCommonDoDeployTestCase(unittest.TestCase):
             with patch('conjureup.events.ModelConnected', new_event):
                 loop.run_until_complete(common.do_deploy(msg_cb))
 
+    def test_do_deploy(self):
+        "call do_deploy"
+        self.mock_app.metadata_controller.bundle.services = [
+            self.service('mysql', ['lxd:0'], [('wordpress:db', 'mysql:db')]),
+            self.service('wordpress', None, [('mysql:db', 'wordpress:db')]),
+        ]
+
+        msg_cb = MagicMock()
+        self.run_deploy(msg_cb)
+
         assert self.mock_pre_deploy.called
         assert self.mock_juju.add_machines.called
-        assert self.mock_juju.deploy_service.called
-        assert self.mock_juju.set_relations.called
+        assert self.mock_juju.deploy_service.call_count == 2
+        mysql = self.mock_app.metadata_controller.bundle.services[0]
+        assert mysql.placement_spec == ['lxd:3']
+        self.mock_juju.add_relation.assert_called_once_with(
+            ('mysql:db', 'wordpress:db'), msg_cb=msg_cb)
+
+    def test_do_deploy_machines_per_app(self):
+        "Each application's machines are added by their own step"
+        self.mock_app.metadata_controller.bundle.machines = {
+            vmid: {'series': 'xenial'} for vmid in ('0', '1', '2')}
+        self.mock_app.metadata_controller.bundle.services = [
+            self.service('mysql', ['0', 'lxd:1'], []),
+            self.service('wordpress', ['lxd:1', '2'], []),
+        ]
+
+        def add_machines(services, machines, msg_cb):
+            return {vmid: str(int(vmid) + 3) for vmid in machines}
+        self.mock_juju.add_machines.side_effect = add_machines
+
+        self.run_deploy(MagicMock())
+
+        added = [(c[1][0][0].service_name, sorted(c[1][1]))
+                 for c in self.mock_juju.add_machines.mock_calls]
+        assert sorted(added) == [('mysql', ['0', '1']), ('wordpress', ['2'])]
+        wordpress = self.mock_app.metadata_controller.bundle.services[1]
+        assert wordpress.placement_spec == ['lxd:4', '5']
+
+    def test_do_deploy_resumes(self):
+        "do_deploy skips what is already in the model"
+        self.mock_app.metadata_controller.bundle.services = [
+            self.service('rs-mysql', ['lxd:0'],
+                         [('rs-wordpress:db', 'rs-mysql:db')]),
+            self.service('rs-wordpress', ['1'],
+                         [('rs-mysql:db', 'rs-wordpress:db'),
+                          ('rs-wordpress:cache', 'rs-redis:cache')]),
+        ]
+
+        def reconcile_model(applications, machines):
+            events.AppDeployed.set('rs-mysql')
+            events.RelationsAdded.set('rs-mysql:db <-> rs-wordpress:db')
+            return {'0': '5'}, {}
+        self.mock_juju.reconcile_model.side_effect = reconcile_model
+        self.mock_juju.add_machines.return_value = {'1': '6'}
+
+        msg_cb = MagicMock()
+        try:
+            self.run_deploy(msg_cb)
+        finally:
+            events.AppDeployed.clear('rs-mysql')
+            events.RelationsAdded.clear('rs-mysql:db <-> rs-wordpress:db')
+
+        deployed = [c[1][0] for c in self.mock_juju.deploy_service.mock_calls]
+        assert [s.service_name for s in deployed] == ['rs-wordpress']
+        assert deployed[0].placement_spec == ['6']
+        self.mock_juju.add_relation.assert_called_once_with(
+            ('rs-redis:cache', 'rs-wordpress:cache'), msg_cb=msg_cb)
+
+    def test_do_deploy_adds_missing_units(self):
+        "Partially deployed applications only get their missing units"
+        self.mock_app.metadata_controller.bundle.machines = {
+            vmid: {'series': 'xenial'} for vmid in ('0', '1', '2')}
+        self.mock_app.metadata_controller.bundle.services = [
+            self.service('mysql', ['0', 'lxd:1', '2'], []),
+        ]
+        self.mock_juju.reconcile_model.return_value = (
+            {'0': '4', '1': '5'}, {'mysql': ['lxd:1', '2']})
+        self.mock_juju.add_machines.return_value = {'2': '6'}
+
+        msg_cb = MagicMock()
+        self.run_deploy(msg_cb)
+
+        machines = self.mock_juju.add_machines.call_args[0][1]
+        assert list(machines) == ['2']
+        assert not self.mock_juju.deploy_service.called
+        mysql = self.mock_app.metadata_controller.bundle.services[0]
+        self.mock_juju.add_units.assert_called_once_with(
+            mysql, ['lxd:5', '6'], msg_cb=msg_cb)
+
+
+class DeployCommonCostTestCase(unittest.TestCase):
+
+    def test_deploy_cost(self):
+        "Subordinates are cheap, principals cost more with more units"
+        subordinate = MagicMock(subordinate=True, num_units=0)
+        small = MagicMock(subordinate=False, num_units=1)
+        big = MagicMock(subordinate=False, num_units=5)
+        assert common._deploy_cost(subordinate) < \
+            common._deploy_cost(small) < common._deploy_cost(big)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+#
+# tests controllers/spellpicker/gui.py
+#
+# Copyright Canonical, Ltd.
+
+
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from conjureup.controllers.spellpicker.gui import SpellPickerController
+
+from .helpers import test_loop
+
+
+class SpellPickerGUIFinishTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = SpellPickerController()
+        self.spells_dir = tempfile.TemporaryDirectory()
+        self.app_patcher = patch(
+            'conjureup.controllers.spellpicker.gui.app')
+        self.mock_app = self.app_patcher.start()
+        self.mock_app.registry_sync = None
+        self.mock_app.config = {'spells-dir': self.spells_dir.name,
+                                'spell-dir': '/tmp/spell-dir'}
+        self.download_patcher = patch(
+            'conjureup.controllers.spellpicker.gui.download_local')
+        self.mock_download = self.download_patcher.start()
+
+    def tearDown(self):
+        self.download_patcher.stop()
+        self.app_patcher.stop()
+        self.spells_dir.cleanup()
+
+    def test_missing_spell(self):
+        "A spell gone from the registry isn't copied"
+        self.controller.finished = True
+        with test_loop() as loop:
+            loop.run_until_complete(self.controller._finish('missing'))
+        assert not self.mock_download.called
+        assert not self.controller.finished
+        assert self.mock_app.ui.set_footer.called
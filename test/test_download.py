@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+#
+# tests download.py
+#
+# Copyright Canonical, Ltd.
+
+
+import fcntl
+import hashlib
+import io
+import json
+import os
+import socket
+import stat
+import subprocess
+import tarfile
+import tempfile
+import threading
+import unittest
+import zipfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+
+from conjureup import download
+
+
+def make_zip():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        zf.writestr('spell-master/metadata.yaml', 'friendly-name: Test\n')
+        info = zipfile.ZipInfo('spell-master/steps/00_deploy-done')
+        info.external_attr = (stat.S_IFREG | 0o755) << 16
+        zf.writestr(info, '#!/bin/bash\n' + 'x' * 4096)
+    return buf.getvalue()
+
+
+def make_tar(links=()):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+        data = b'friendly-name: Test\n'
+        info = tarfile.TarInfo('spell-master/metadata.yaml')
+        info.size = len(data)
+        tf.addfile(info, io.BytesIO(data))
+        for name, target in links:
+            info = tarfile.TarInfo('spell-master/' + name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tf.addfile(info)
+    return buf.getvalue()
+
+
+class ArchiveServer(BaseHTTPRequestHandler):
+    body = b''
+    ranges = True
+    etag = '"v1"'
+    requests = []
+
+    def do_HEAD(self):
+        self.send_headers(200, len(self.body))
+
+    def do_GET(self):
+        rng = self.headers.get('Range')
+        self.requests.append(rng)
+        if rng and self.ranges:
+            start, end = (int(i) for i in rng[len('bytes='):].split('-'))
+            self.send_headers(206, end - start + 1)
+            self.wfile.write(self.body[start:end + 1])
+        else:
+            self.send_headers(200, len(self.body))
+            self.wfile.write(self.body)
+
+    def send_headers(self, code, length):
+        self.send_response(code)
+        self.send_header('Content-Length', str(length))
+        if self.etag:
+            self.send_header('ETag', self.etag)
+        if self.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dst = os.path.join(self.tmpdir.name, 'spell')
+        self.env_patcher = patch.dict(os.environ,
+                                      {'TEMPDIR': self.tmpdir.name})
+        self.env_patcher.start()
+        self.app_patcher = patch('conjureup.download.app')
+        self.app_patcher.start()
+        self.segment_patcher = patch.multiple(
+            'conjureup.download', SEGMENT_MIN_SIZE=512, CHUNK_SIZE=256,
+            STATE_SAVE_INTERVAL=256)
+        self.segment_patcher.start()
+        ArchiveServer.body = make_zip()
+        ArchiveServer.ranges = True
+        ArchiveServer.etag = '"v1"'
+        ArchiveServer.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), ArchiveServer)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.url = 'http://{}:{}/spell.zip'.format(*self.server.server_address)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        self.segment_patcher.stop()
+        self.app_patcher.stop()
+        self.env_patcher.stop()
+        self.tmpdir.cleanup()
+
+    def check_spell(self):
+        with open(os.path.join(self.dst, 'metadata.yaml')) as f:
+            assert f.read() == 'friendly-name: Test\n'
+
+    def test_parallel_segments(self):
+        "Range capable servers are downloaded in segments and extracted"
+        download.download(self.url, self.dst)
+        self.check_spell()
+        step = os.path.join(self.dst, 'steps', '00_deploy-done')
+        assert os.stat(step).st_mode & 0o777 == 0o755
+        assert len(ArchiveServer.requests) == download.SEGMENTS
+        assert all(r.startswith('bytes=') for r in ArchiveServer.requests)
+        assert not [f for f in os.listdir(self.tmpdir.name)
+                    if f.endswith(('.part', '.json', '.lock'))]
+
+    def write_partial(self, validator):
+        body = ArchiveServer.body
+        name = 'conjure-up-{}'.format(
+            hashlib.sha1(self.url.encode('utf8')).hexdigest())
+        part_path = os.path.join(self.tmpdir.name, name + '.part')
+        half = len(body) // 2
+        with open(part_path, 'wb') as f:
+            f.write(body[:half])
+            f.truncate(len(body))
+        with open(part_path + '.json', 'w') as f:
+            json.dump({'url': self.url, 'length': len(body),
+                       'validator': validator,
+                       'segments': [[half, len(body)]]}, f)
+        return half
+
+    def test_resume(self):
+        "Interrupted downloads only fetch what's missing"
+        half = self.write_partial('"v1"')
+        download.download(self.url, self.dst)
+        self.check_spell()
+        assert ArchiveServer.requests == [
+            'bytes={}-{}'.format(half, len(ArchiveServer.body) - 1)]
+
+    def test_no_validator(self):
+        "Downloads aren't resumed without an ETag or Last-Modified"
+        ArchiveServer.etag = None
+        self.write_partial(None)
+        download.download(self.url, self.dst)
+        self.check_spell()
+        assert len(ArchiveServer.requests) == download.SEGMENTS
+        assert any(r.startswith('bytes=0-') for r in ArchiveServer.requests)
+
+    def test_timeout(self):
+        "Stalled servers time out rather than hanging"
+        with socket.socket() as stalled:
+            stalled.bind(('127.0.0.1', 0))
+            stalled.listen(1)
+            url = 'http://{}:{}/spell.zip'.format(*stalled.getsockname())
+            with patch('conjureup.download.HTTP_TIMEOUT', (1, 0.2)):
+                with self.assertRaises(Exception):
+                    download.download(url, self.dst)
+
+    def test_no_ranges(self):
+        "Servers without range support are streamed, tars extracted too"
+        ArchiveServer.body = make_tar()
+        ArchiveServer.ranges = False
+        download.download(self.url, self.dst)
+        self.check_spell()
+        assert ArchiveServer.requests == [None]
+
+    def test_checksum(self):
+        "Archives not matching the checksum are rejected"
+        digest = hashlib.sha256(ArchiveServer.body).hexdigest()
+        download.download(self.url, self.dst,
+                          checksum='sha256:{}'.format(digest))
+        self.check_spell()
+        with self.assertRaises(Exception):
+            download.download(self.url, self.dst, checksum='sha256:00')
+
+    def test_contended(self):
+        "Downloads that can't take the lock clean up after themselves"
+        name = 'conjure-up-{}'.format(
+            hashlib.sha1(self.url.encode('utf8')).hexdigest())
+        lock_path = os.path.join(self.tmpdir.name, name + '.lock')
+        with open(lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with self.assertRaises(Exception):
+                download.download(self.url, self.dst, checksum='sha256:00')
+        leftover = sorted(os.listdir(self.tmpdir.name))
+        assert leftover == [name + '.lock', 'spell']
+
+    def test_symlinks(self):
+        "Symlinks inside the spell are kept, ones pointing out are not"
+        ArchiveServer.body = make_tar(links=[('readme', 'metadata.yaml'),
+                                             ('steps/up', '../readme'),
+                                             ('passwd', '/etc/passwd'),
+                                             ('out', '../../outside')])
+        download.download(self.url, self.dst)
+        assert os.readlink(os.path.join(self.dst, 'readme')) == \
+            'metadata.yaml'
+        with open(os.path.join(self.dst, 'steps', 'up')) as f:
+            assert f.read() == 'friendly-name: Test\n'
+        assert not os.path.lexists(os.path.join(self.dst, 'passwd'))
+        assert not os.path.lexists(os.path.join(self.dst, 'out'))
+
+    def test_chained_symlinks(self):
+        "Chains of symlinks can't take members outside the spell"
+        buf = io.BytesIO(make_zip())
+        with zipfile.ZipFile(buf, 'a') as zf:
+            for name, target in [('sub/d', '..'), ('sub/x', 'd/../..')]:
+                info = zipfile.ZipInfo('spell-master/' + name)
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                zf.writestr(info, target)
+            zf.writestr('spell-master/sub/x/evil.txt', 'evil')
+        ArchiveServer.body = buf.getvalue()
+        download.download(self.url, self.dst)
+        self.check_spell()
+        assert os.readlink(os.path.join(self.dst, 'sub', 'd')) == '..'
+        assert not os.path.islink(os.path.join(self.dst, 'sub', 'x'))
+        assert os.path.isfile(os.path.join(self.dst, 'sub', 'x', 'evil.txt'))
+        assert not os.path.exists(os.path.join(self.tmpdir.name, '..',
+                                               'evil.txt'))
+
+    def test_zip_symlinks(self):
+        "Symlinks in zip archives are kept"
+        buf = io.BytesIO(make_zip())
+        with zipfile.ZipFile(buf, 'a') as zf:
+            for name, target in [('readme', 'metadata.yaml'),
+                                 ('passwd', '/etc/passwd')]:
+                info = zipfile.ZipInfo('spell-master/' + name)
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                zf.writestr(info, target)
+        ArchiveServer.body = buf.getvalue()
+        download.download(self.url, self.dst)
+        assert os.readlink(os.path.join(self.dst, 'readme')) == \
+            'metadata.yaml'
+        assert not os.path.lexists(os.path.join(self.dst, 'passwd'))
+
+
+class DownloadLocalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, 'spells', 'spell')
+        self.dst = os.path.join(self.tmpdir.name, 'cache', 'spell')
+        os.makedirs(os.path.join(self.src, 'steps'))
+        os.makedirs(os.path.dirname(self.dst))
+        self.write('metadata.yaml', 'friendly-name: Test\n')
+        self.write('steps/00_deploy-done', '#!/bin/bash\n')
+        os.chmod(os.path.join(self.src, 'steps', '00_deploy-done'), 0o755)
+        self.app_patcher = patch('conjureup.download.app')
+        self.app_patcher.start()
+
+    def tearDown(self):
+        self.app_patcher.stop()
+        self.tmpdir.cleanup()
+
+    def write(self, rel_path, text):
+        with open(os.path.join(self.src, rel_path), 'w') as f:
+            f.write(text)
+
+    def read(self, rel_path):
+        with open(os.path.join(self.dst, rel_path)) as f:
+            return f.read()
+
+    def test_sync(self):
+        "Only changed files are copied and removed files are deleted"
+        download.download_local(self.src, self.dst)
+        assert self.read('metadata.yaml') == 'friendly-name: Test\n'
+        step = os.path.join(self.dst, 'steps', '00_deploy-done')
+        assert os.stat(step).st_mode & 0o777 == 0o755
+
+        os.remove(os.path.join(self.src, 'steps', '00_deploy-done'))
+        self.write('metadata.yaml', 'friendly-name: Changed\n')
+        self.write('bundle.yaml', 'series: xenial\n')
+        with open(os.path.join(self.dst, 'results.txt'), 'w') as f:
+            f.write('stale')
+        with patch('conjureup.download._clone_file',
+                   wraps=download._clone_file) as mock_clone:
+            download.download_local(self.src, self.dst)
+        assert sorted(c[0][0] for c in mock_clone.call_args_list) == [
+            os.path.join(self.src, 'bundle.yaml'),
+            os.path.join(self.src, 'metadata.yaml')]
+        assert self.read('metadata.yaml') == 'friendly-name: Changed\n'
+        assert sorted(os.listdir(self.dst)) == ['bundle.yaml',
+                                                'metadata.yaml', 'steps']
+        assert os.listdir(os.path.join(self.dst, 'steps')) == []
+
+    def test_unchanged(self):
+        "An unchanged spell is detected from the manifest"
+        download.download_local(self.src, self.dst)
+        with patch('conjureup.download._sync_tree') as mock_sync:
+            download.download_local(self.src, self.dst)
+        assert not mock_sync.called
+
+    def test_independent_copy(self):
+        "Modifying the spell in place leaves the source untouched"
+        download.download_local(self.src, self.dst)
+        with open(os.path.join(self.dst, 'metadata.yaml'), 'r+') as f:
+            f.write('changed')
+        with open(os.path.join(self.src, 'metadata.yaml')) as f:
+            assert f.read() == 'friendly-name: Test\n'
+
+
+class RegistrySyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.remote = os.path.join(self.tmpdir.name, 'registry')
+        self.spells_dir = os.path.join(self.tmpdir.name, 'spells')
+        self.app_patcher = patch('conjureup.download.app')
+        self.app_patcher.start()
+        os.makedirs(self.remote)
+        self.git('init', '-q')
+        self.git('checkout', '-q', '-b', 'stable')
+        self.commit('spells-index.yaml', 'v1')
+
+    def tearDown(self):
+        self.app_patcher.stop()
+        self.tmpdir.cleanup()
+
+    def git(self, *args):
+        subprocess.check_call(['git', '-c', 'user.name=test',
+                               '-c', 'user.email=test@example.com'] +
+                              list(args), cwd=self.remote)
+
+    def commit(self, name, text):
+        with open(os.path.join(self.remote, name), 'w') as f:
+            f.write(text)
+        self.git('add', name)
+        self.git('commit', '-q', '-m', text)
+
+    def read(self, name):
+        with open(os.path.join(self.spells_dir, name)) as f:
+            return f.read()
+
+    def sync(self):
+        download.download_or_sync_registry(self.remote, self.spells_dir,
+                                           branch='stable', timeout=30)
+
+    def test_sync(self):
+        "The registry is cloned, then updated with shallow fetches"
+        assert download.registry_sync_due(self.remote, self.spells_dir,
+                                          'stable', 60)
+        self.sync()
+        assert self.read('spells-index.yaml') == 'v1'
+        assert not download.registry_sync_due(self.remote, self.spells_dir,
+                                              'stable', 60)
+        assert download.registry_sync_due(self.remote, self.spells_dir,
+                                          'stable', 0)
+        assert download.registry_sync_due(self.remote, self.spells_dir,
+                                          'master', 60)
+
+        self.commit('spells-index.yaml', 'v2')
+        with open(os.path.join(self.spells_dir, 'spells-index.yaml'),
+                  'w') as f:
+            f.write('local change')
+        self.sync()
+        assert self.read('spells-index.yaml') == 'v2'
+
+    def test_offline(self):
+        "A failed sync leaves the existing registry in place"
+        self.sync()
+        os.rename(self.remote, self.remote + '.gone')
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.sync()
+        assert self.read('spells-index.yaml') == 'v1'
+        assert sorted(os.listdir(self.tmpdir.name)) == [
+            'registry.gone', 'spells', 'spells.synced']
+
+    def test_fresh_copy(self):
+        "A registry that can't be updated is replaced by a fresh clone"
+        self.sync()
+        subprocess.check_call(['git', 'remote', 'set-url', 'origin',
+                               self.remote + '.gone'], cwd=self.spells_dir)
+        self.commit('spells-index.yaml', 'v2')
+        download.download_or_sync_registry(self.remote, self.spells_dir,
+                                           branch='stable', timeout=30)
+        assert self.read('spells-index.yaml') == 'v2'
+        assert sorted(os.listdir(self.tmpdir.name)) == [
+            'registry', 'spells', 'spells.synced']
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# tests events.py
+#
+# Copyright Canonical, Ltd.
+
+
+import unittest
+from unittest.mock import patch
+
+from conjureup import events
+
+from .helpers import test_loop
+
+
+class EventTraceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.trace_patcher = patch.object(events, '_trace',
+                                          events.deque(maxlen=8))
+        self.trace_patcher.start()
+        self.tracing_patcher = patch.object(events, '_tracing', False)
+        self.tracing_patcher.start()
+
+    def tearDown(self):
+        self.trace_patcher.stop()
+        self.tracing_patcher.stop()
+
+    def test_records_transitions(self):
+        "events.Event records transitions without caller frames"
+        event = events.Event('Test')
+        event.set()
+        event.clear()
+        trace = events.get_trace()
+        assert [(name, action) for _, name, action, _, _ in trace] == [
+            ('Test', 'Setting'), ('Test', 'Clearing')]
+        assert all(caller is None for *_, caller in trace)
+
+    def test_ring_buffer(self):
+        "events.Event keeps only the most recent transitions"
+        named = events.NamedEvent('Machine')
+        for i in range(10):
+            named.set(str(i))
+        names = [entry[1] for entry in events.get_trace()]
+        assert names == ['Machine:{}'.format(i) for i in range(2, 10)]
+
+    def test_tracing_callers(self):
+        "events.enable_tracing records the caller outside the event methods"
+        events.enable_tracing(size=16)
+        named = events.NamedEvent('App')
+        named.set('mysql')
+        code, lineno = events.get_trace()[-1][4]
+        assert code.co_name == 'test_tracing_callers'
+
+        with test_loop() as loop:
+            async def waiter():
+                await named.wait('mysql')
+            loop.run_until_complete(waiter())
+        awaiting, received = events.get_trace()[-2:]
+        assert awaiting[2] == 'Awaiting'
+        assert awaiting[3] is not None
+        assert awaiting[4][0].co_name == 'waiter'
+        assert received[2] == 'Received'
+
+    @patch('conjureup.events.app')
+    def test_dump(self, mock_app):
+        "events.dump_trace writes the trace to the log"
+        events.enable_tracing()
+        events.Event('Dumped').set()
+        events.dump_trace('test')
+        lines = [call[0][0] for call in mock_app.log.debug.call_args_list]
+        assert 'test' in lines[0]
+        assert 'Setting Dumped' in lines[1]
+        assert 'test/test_events.py' in lines[1]
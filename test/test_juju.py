@@ -0,0 +1,557 @@
+#!/usr/bin/env python
+#
+# tests juju.py
+#
+# Copyright Canonical, Ltd.
+
+
+import asyncio
+import gc
+import os
+import tempfile
+import unittest
+import warnings
+from pathlib import Path
+from unittest.mock import MagicMock, call, patch
+
+import yaml
+
+from conjureup import events, juju
+
+from .helpers import AsyncMock, test_loop
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+
+class JujuCachedQueryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.juju_dir = tempfile.TemporaryDirectory()
+        self.juju_path_patcher = patch('conjureup.juju.juju_path',
+                                       return_value=self.juju_dir.name)
+        self.juju_path_patcher.start()
+        self.controllers_yaml = os.path.join(self.juju_dir.name,
+                                             'controllers.yaml')
+        with open(self.controllers_yaml, 'w') as f:
+            f.write('controllers: {}\n')
+        juju.invalidate_cache()
+
+        self.query = MagicMock(name='query', __name__='query',
+                               side_effect=lambda *a: {'args': list(a)})
+        self.cached = juju.cached_query('controllers')(self.query)
+
+    def tearDown(self):
+        juju.invalidate_cache()
+        self.juju_path_patcher.stop()
+        self.juju_dir.cleanup()
+
+    def test_reuses_result(self):
+        "Repeated queries with the same arguments only run once"
+        assert self.cached('a') == {'args': ['a']}
+        assert self.cached('a') == {'args': ['a']}
+        assert self.query.call_count == 1
+        self.cached('b')
+        assert self.query.call_count == 2
+
+    def test_returns_copy(self):
+        "Callers can't modify the cached result"
+        self.cached('a')['args'].append('b')
+        assert self.cached('a') == {'args': ['a']}
+
+    def test_invalidated_on_change(self):
+        "Changing the config file invalidates the cache"
+        self.cached()
+        with open(self.controllers_yaml, 'w') as f:
+            f.write('controllers: {foo: {}}\n')
+        self.cached()
+        assert self.query.call_count == 2
+
+    def test_invalidate_cache(self):
+        "Explicit invalidation forces a new query"
+        self.cached()
+        juju.invalidate_cache()
+        self.cached()
+        assert self.query.call_count == 2
+
+    def test_models_not_cached(self):
+        "Model lists always come from the controller"
+        with patch('conjureup.juju._juju',
+                   return_value=(0, 'models: []\n', '')) as mock_juju:
+            juju.get_models('foo')
+            juju.get_models('foo')
+        assert mock_juju.call_count == 2
+
+
+class JujuConfigReaderTestCase(unittest.TestCase):
+    """ Checks the config readers return what the juju CLI would
+    """
+
+    def setUp(self):
+        self.use_juju_data('basic')
+        self.app_patcher = patch('conjureup.juju.app')
+        self.app_patcher.start()
+        juju.invalidate_cache()
+
+    def tearDown(self):
+        juju.invalidate_cache()
+        self.app_patcher.stop()
+        self.juju_path_patcher.stop()
+
+    def use_juju_data(self, name):
+        if hasattr(self, 'juju_path_patcher'):
+            self.juju_path_patcher.stop()
+        self.juju_path_patcher = patch(
+            'conjureup.juju.juju_path',
+            return_value=str(FIXTURES / 'juju-data' / name))
+        self.juju_path_patcher.start()
+
+    def cli_output(self, name):
+        return (FIXTURES / 'juju-cli' / 'basic' / name).read_text()
+
+    def test_controllers_parity(self):
+        "read_controllers matches juju list-controllers"
+        expected = yaml.safe_load(self.cli_output('list-controllers.yaml'))
+        assert juju.read_controllers() == expected
+
+    def test_clouds_parity(self):
+        "read_clouds matches juju list-clouds"
+        expected = yaml.safe_load(self.cli_output('list-clouds.yaml'))
+        assert juju.read_clouds() == expected
+
+    def test_credentials_parity(self):
+        "read_credentials matches juju list-credentials --show-secrets"
+        expected = yaml.safe_load(self.cli_output('list-credentials.yaml'))
+        assert juju.read_credentials() == expected['credentials']
+
+    def test_models_parity(self):
+        "read_models matches the locally known fields of juju list-models"
+        expected = yaml.safe_load(self.cli_output('list-models-lxd.yaml'))
+        models = juju.read_models('lxd')
+        assert models['current-model'] == expected['current-model']
+        assert len(models['models']) == len(expected['models'])
+        for model, expected_model in zip(models['models'],
+                                         expected['models']):
+            for key, value in model.items():
+                assert expected_model[key] == value, key
+
+    def test_regions(self):
+        "get_regions reads regions without calling juju"
+        with patch('conjureup.juju.run') as mock_run:
+            assert sorted(juju.get_regions('aws')) == ['us-east-1',
+                                                       'us-west-2']
+            assert juju.get_regions('mymaas') == {}
+        assert not mock_run.called
+
+    def test_getters_skip_cli(self):
+        "The getters don't call juju when the config files are usable"
+        with patch('conjureup.juju.run') as mock_run:
+            assert juju.get_current_controller() == 'lxd'
+            assert juju.get_controller('aws-east')['cloud'] == 'aws'
+            assert juju.get_cloud('mymaas')['type'] == 'maas'
+            assert 'work' in juju.get_credentials()['aws']
+            assert juju.get_model('lxd', 'default')['owner'] == 'admin'
+        assert not mock_run.called
+
+    def test_unknown_schema(self):
+        "Unrecognized config files are rejected"
+        self.use_juju_data('unknown-schema')
+        for reader in (juju.read_controllers, juju.read_clouds,
+                       juju.read_credentials):
+            with self.assertRaises(juju.JujuConfigError):
+                reader()
+        with self.assertRaises(juju.JujuConfigError):
+            juju.read_models('lxd')
+
+    def test_missing_files(self):
+        "Missing config files are rejected"
+        self.use_juju_data('does-not-exist')
+        with self.assertRaises(juju.JujuConfigError):
+            juju.read_controllers()
+
+    def test_cli_fallback(self):
+        "The getters fall back to juju when the config files are unusable"
+        self.use_juju_data('unknown-schema')
+        output = self.cli_output('list-controllers.yaml')
+        with patch('conjureup.juju.run') as mock_run:
+            mock_run.return_value.returncode = 0
+            mock_run.return_value.stdout = output.encode('utf8')
+            assert juju.get_controllers() == yaml.safe_load(output)
+        assert mock_run.call_args[0][0] == ['juju', 'list-controllers',
+                                            '--format', 'yaml']
+
+    def test_async_getters(self):
+        "The async getters read the config files too"
+        with patch('conjureup.juju.utils.arun') as mock_arun:
+            with test_loop() as loop:
+                controllers, clouds = loop.run_until_complete(
+                    asyncio.gather(juju.aget_controllers(),
+                                   juju.aget_clouds()))
+        assert controllers == juju.read_controllers()
+        assert clouds == juju.read_clouds()
+        assert not mock_arun.called
+
+    def test_async_cli_fallback(self):
+        "The async getters fall back to running juju asynchronously"
+        self.use_juju_data('unknown-schema')
+        output = self.cli_output('list-controllers.yaml')
+        mock_arun = AsyncMock(return_value=(0, output, ''))
+        with patch('conjureup.juju.utils.arun', mock_arun):
+            with test_loop() as loop:
+                controllers = loop.run_until_complete(juju.aget_controllers())
+        assert controllers == yaml.safe_load(output)
+        mock_arun.assert_called_once_with(['juju', 'list-controllers',
+                                           '--format', 'yaml'])
+
+
+class JujuAddMachinesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app_patcher = patch('conjureup.juju.app')
+        self.mock_app = self.app_patcher.start()
+        self.ev_app_patcher = patch('conjureup.events.app', self.mock_app)
+        self.ev_app_patcher.start()
+        self.facade_patcher = patch(
+            'juju.client.client.ClientFacade.from_connection')
+        self.facade = self.facade_patcher.start().return_value
+        self.facade.AddMachines = AsyncMock(side_effect=self.add_machines)
+        self.ann_patcher = patch(
+            'juju.client.client.AnnotationsFacade.from_connection')
+        self.ann_facade = self.ann_patcher.start().return_value
+        self.ann_facade.Set = AsyncMock(return_value=MagicMock(results=[]))
+        self.mock_app.config = {'spell': 'am-spell'}
+        self.next_id = 0
+        events.PreDeployComplete.set()
+
+    def tearDown(self):
+        events.PreDeployComplete.clear()
+        for vmid in ('0', '1', '2'):
+            events.MachinePending.clear(vmid)
+            events.MachineCreated.clear(vmid)
+            events.MachineFailed.clear(vmid)
+        self.ann_patcher.stop()
+        self.facade_patcher.stop()
+        self.ev_app_patcher.stop()
+        self.app_patcher.stop()
+
+    def add_machines(self, params):
+        results = []
+        for param in params:
+            results.append(MagicMock(machine=str(self.next_id), error=None))
+            self.next_id += 1
+        return MagicMock(machines=results)
+
+    def test_batches(self):
+        "Machines are requested in batches of at most batch_size"
+        machines = {vmid: {'series': 'xenial', 'constraints': 'mem=4096'}
+                    for vmid in ('0', '1', '2')}
+        with test_loop() as loop:
+            new_machines = loop.run_until_complete(juju.add_machines(
+                [], machines, msg_cb=MagicMock(), batch_size=2))
+        assert new_machines == {'0': '0', '1': '1', '2': '2'}
+        batches = [c[0][0] for c in self.facade.AddMachines.call_args_list]
+        assert [len(b) for b in batches] == [2, 1]
+        assert batches[0][0].constraints.mem == 4096
+        annotated = [ann for c in self.ann_facade.Set.call_args_list
+                     for ann in c[0][0]]
+        assert [(ann.entity, ann.annotations) for ann in annotated] == [
+            ('machine-{}'.format(i), {juju.MACHINE_ANNOTATION:
+                                      'am-spell:{}'.format(i)})
+            for i in range(3)]
+        assert events.MachineCreated.is_set('2')
+
+    def test_skips_created(self):
+        "Machines that already exist aren't requested again"
+        events.MachineCreated.set('0')
+        machines = {vmid: {'series': 'xenial'} for vmid in ('0', '1')}
+        with test_loop() as loop:
+            new_machines = loop.run_until_complete(juju.add_machines(
+                [], machines, msg_cb=MagicMock(), batch_size=10))
+        assert new_machines == {'1': '0'}
+        self.facade.AddMachines.assert_called_once()
+
+    def test_failed_machines(self):
+        "A failed machine doesn't stop the rest of its batch being created"
+        def add_machines(params):
+            results = [MagicMock(machine='5', error=None),
+                       MagicMock(machine='', error=MagicMock(message='no'))]
+            return MagicMock(machines=results)
+        self.facade.AddMachines.side_effect = add_machines
+        machines = {vmid: {'series': 'xenial'} for vmid in ('0', '1', '2')}
+        with test_loop() as loop:
+            with self.assertRaisesRegex(ValueError, '1: no'):
+                loop.run_until_complete(juju.add_machines(
+                    [], machines, msg_cb=MagicMock(), batch_size=2))
+        assert events.MachineCreated.is_set('0')
+        assert not events.MachineCreated.is_set('1')
+        for vmid in ('0', '1', '2'):
+            assert not events.MachinePending.is_set(vmid)
+
+    def test_connection_error(self):
+        "A batch that fails outright leaves no machine pending"
+        self.facade.AddMachines.side_effect = ConnectionError('gone')
+        machines = {vmid: {'series': 'xenial'} for vmid in ('0', '1', '2')}
+        with test_loop() as loop:
+            with self.assertRaises(ConnectionError):
+                loop.run_until_complete(juju.add_machines(
+                    [], machines, msg_cb=MagicMock(), batch_size=2))
+        for vmid in ('0', '1', '2'):
+            assert not events.MachinePending.is_set(vmid)
+            assert not events.MachineCreated.is_set(vmid)
+
+    def test_failed_shared_machine(self):
+        "Calls waiting on a machine another call failed to add fail too"
+        async def add_machines(params):
+            await asyncio.sleep(0.01)
+            raise ConnectionError('gone')
+        self.facade.AddMachines = add_machines
+        with test_loop() as loop:
+            # tasks start in the order they're created, so the first call
+            # is the one requesting machine 1
+            tasks = [
+                loop.create_task(juju.add_machines(
+                    [], {vmid: {'series': 'xenial'} for vmid in '01'},
+                    msg_cb=MagicMock(), batch_size=2)),
+                loop.create_task(juju.add_machines(
+                    [], {'1': {'series': 'xenial'}},
+                    msg_cb=MagicMock(), batch_size=2))]
+            results = loop.run_until_complete(asyncio.wait_for(
+                asyncio.gather(*tasks, return_exceptions=True), timeout=5))
+        assert isinstance(results[0], ConnectionError)
+        assert isinstance(results[1], ValueError)
+        assert events.MachineFailed.is_set('1')
+
+        # a later call retries the failed machine
+        self.facade.AddMachines = AsyncMock(side_effect=self.add_machines)
+        with test_loop() as loop:
+            new_machines = loop.run_until_complete(juju.add_machines(
+                [], {'1': {'series': 'xenial'}}, msg_cb=MagicMock(),
+                batch_size=2))
+        assert new_machines == {'1': '0'}
+        assert not events.MachineFailed.is_set('1')
+
+    def test_failed_batch_with_waits(self):
+        "A failed batch leaves no wait on other calls' machines unawaited"
+        self.facade.AddMachines.side_effect = ConnectionError('gone')
+        events.MachinePending.set('1')
+        machines = {vmid: {'series': 'xenial'} for vmid in ('0', '1')}
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with test_loop() as loop:
+                with self.assertRaises(ConnectionError):
+                    loop.run_until_complete(juju.add_machines(
+                        [], machines, msg_cb=MagicMock(), batch_size=2))
+            gc.collect()
+        assert not [w for w in caught if 'never awaited' in str(w.message)]
+        assert events.MachinePending.is_set('1')
+
+    def test_missing_results(self):
+        "Fewer results than machines requested is an error"
+        self.facade.AddMachines.side_effect = lambda params: MagicMock(
+            machines=[MagicMock(machine='5', error=None)])
+        machines = {vmid: {'series': 'xenial'} for vmid in ('0', '1')}
+        with test_loop() as loop:
+            with self.assertRaisesRegex(ValueError, 'got 1 results'):
+                loop.run_until_complete(juju.add_machines(
+                    [], machines, msg_cb=MagicMock(), batch_size=2))
+        assert not events.MachineCreated.is_set('0')
+        assert not events.MachinePending.is_set('1')
+
+
+class JujuReconcileModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app_patcher = patch('conjureup.juju.app')
+        self.mock_app = self.app_patcher.start()
+        self.ev_app_patcher = patch('conjureup.events.app', self.mock_app)
+        self.ev_app_patcher.start()
+        self.status = MagicMock()
+        self.status.relations = []
+        self.mock_app.juju.client.get_status = AsyncMock(
+            return_value=self.status)
+        self.mock_app.config = {'spell': 'rc-spell'}
+        self.annotations = {}
+        self.ann_patcher = patch(
+            'juju.client.client.AnnotationsFacade.from_connection')
+        self.ann_facade = self.ann_patcher.start().return_value
+        self.ann_facade.Get = AsyncMock(side_effect=self.get_annotations)
+
+    def tearDown(self):
+        self.ann_patcher.stop()
+        for name in ('rc-mysql', 'rc-wordpress'):
+            events.AppDeployed.clear(name)
+        for vmid in ('0', '1', '2', '3'):
+            events.MachineCreated.clear(vmid)
+        events.RelationsAdded.clear('rc-mysql:db <-> rc-wordpress:db')
+        self.ev_app_patcher.stop()
+        self.app_patcher.stop()
+
+    def get_annotations(self, entities):
+        return MagicMock(results=[
+            MagicMock(annotations=self.annotations.get(e.tag, {}))
+            for e in entities])
+
+    def unit(self, machine):
+        return MagicMock(machine=machine)
+
+    def machine(self, series='xenial', hardware=None, jobs=('JobHostUnits',)):
+        return MagicMock(series=series, hardware=hardware, jobs=list(jobs))
+
+    def relation(self, *endpoints):
+        eps = []
+        for app_name, name in endpoints:
+            ep = MagicMock(application=app_name)
+            ep.name = name
+            eps.append(ep)
+        return MagicMock(endpoints=eps)
+
+    def reconcile(self, applications, machines):
+        with test_loop() as loop:
+            return loop.run_until_complete(
+                juju.reconcile_model(applications, machines))
+
+    def test_reconcile(self):
+        "Deployed applications, their machines and relations are marked done"
+        applications = [
+            MagicMock(service_name='rc-mysql', num_units=2,
+                      placement_spec=['lxd:0', 'lxd:1'],
+                      relations=[('rc-wordpress:db', 'rc-mysql:db')]),
+            MagicMock(service_name='rc-wordpress', num_units=1,
+                      placement_spec=['2'],
+                      relations=[('rc-wordpress', 'rc-mysql:shared-db')]),
+        ]
+        machines = {vmid: {'series': 'xenial'} for vmid in ('0', '1', '2')}
+        self.status.applications = {
+            'rc-mysql': MagicMock(units={
+                'rc-mysql/10': self.unit('7/lxd/1'),
+                'rc-mysql/9': self.unit('4/lxd/0'),
+            }),
+            'other': MagicMock(units={'other/0': self.unit('8')}),
+        }
+        self.status.machines = {'4': self.machine(), '7': self.machine(),
+                                '8': self.machine(),
+                                '9': self.machine(series='trusty')}
+        self.status.relations = [
+            self.relation(('rc-mysql', 'db'), ('rc-wordpress', 'db')),
+            self.relation(('rc-mysql', 'cluster')),
+        ]
+
+        machine_map, missing_units = self.reconcile(applications, machines)
+
+        assert machine_map == {'0': '4', '1': '7'}
+        assert missing_units == {}
+        assert events.AppDeployed.is_set('rc-mysql')
+        assert not events.AppDeployed.is_set('rc-wordpress')
+        assert events.MachineCreated.is_set('1')
+        assert not events.MachineCreated.is_set('2')
+        assert events.RelationsAdded.is_set('rc-mysql:db <-> rc-wordpress:db')
+        assert not events.RelationsAdded.is_set(
+            'rc-mysql:shared-db <-> rc-wordpress')
+
+    def test_missing_units(self):
+        "Applications missing units aren't marked deployed"
+        applications = [
+            MagicMock(service_name='rc-mysql', num_units=3,
+                      placement_spec=['0', 'lxd:1', '2'], relations=[]),
+            MagicMock(service_name='rc-wordpress', num_units=2,
+                      placement_spec=None, relations=[]),
+        ]
+        machines = {vmid: {'series': 'xenial'} for vmid in ('0', '1', '2')}
+        self.status.applications = {
+            'rc-mysql': MagicMock(units={'rc-mysql/0': self.unit('4')}),
+            'rc-wordpress': MagicMock(units={}),
+        }
+        self.status.machines = {'4': self.machine()}
+
+        machine_map, missing_units = self.reconcile(applications, machines)
+
+        assert machine_map == {'0': '4'}
+        assert missing_units == {'rc-mysql': ['lxd:1', '2'],
+                                 'rc-wordpress': [None, None]}
+        assert not events.AppDeployed.is_set('rc-mysql')
+        assert not events.AppDeployed.is_set('rc-wordpress')
+
+    def test_machines_without_units(self):
+        "Machines the spell added without units are reused if they still fit"
+        machines = {
+            '0': {'series': 'xenial', 'constraints': 'mem=4G'},
+            '1': {'series': 'xenial', 'constraints': 'tags=abc'},
+            '2': {'series': 'trusty'},
+            '3': {'series': 'xenial', 'constraints': 'tags=def'},
+        }
+        self.status.applications = {}
+        self.status.machines = {
+            '0': self.machine(jobs=['JobManageModel']),
+            '5': self.machine(hardware='arch=amd64 mem=2048M tags=abc'),
+            '6': self.machine(hardware='arch=amd64 mem=8192M'),
+            '7': self.machine(series='trusty'),
+            '8': self.machine(),
+            '9': self.machine(hardware='arch=amd64 tags=def'),
+        }
+        label = juju.MACHINE_ANNOTATION
+        self.annotations = {
+            'machine-5': {label: 'rc-spell:1'},
+            'machine-6': {label: 'rc-spell:0'},
+            'machine-7': {label: 'rc-spell:2'},
+            'machine-8': {label: 'rc-spell:4'},
+            'machine-9': {label: 'other-spell:3'},
+        }
+
+        machine_map, _ = self.reconcile([], machines)
+
+        assert machine_map == {'0': '6', '1': '5', '2': '7'}
+        assert events.MachineCreated.is_set('2')
+        assert not events.MachineCreated.is_set('3')
+        tags = [e.tag for e in self.ann_facade.Get.call_args[0][0]]
+        assert tags == ['machine-5', 'machine-6', 'machine-7', 'machine-8',
+                        'machine-9']
+
+    def test_annotations_error(self):
+        "Idle machines aren't reused if their annotations can't be read"
+        self.ann_facade.Get.side_effect = ConnectionError('gone')
+        machines = {'0': {'series': 'xenial'}}
+        self.status.applications = {}
+        self.status.machines = {'5': self.machine()}
+
+        machine_map, _ = self.reconcile([], machines)
+
+        assert machine_map == {}
+        assert not events.MachineCreated.is_set('0')
+        assert self.mock_app.log.warning.called
+
+    def test_other_machines(self):
+        "Machines the spell didn't add are left alone"
+        machines = {'0': {'series': 'xenial'}}
+        self.status.applications = {}
+        self.status.machines = {'3': self.machine()}
+
+        machine_map, _ = self.reconcile([], machines)
+
+        assert machine_map == {}
+        assert not events.MachineCreated.is_set('0')
+
+
+class JujuAddUnitsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app_patcher = patch('conjureup.juju.app')
+        self.mock_app = self.app_patcher.start()
+        self.ev_app_patcher = patch('conjureup.events.app', self.mock_app)
+        self.ev_app_patcher.start()
+        self.app_inst = MagicMock()
+        self.app_inst.add_unit = AsyncMock()
+        self.mock_app.juju.client.applications = {'au-mysql': self.app_inst}
+
+    def tearDown(self):
+        events.AppDeployed.clear('au-mysql')
+        self.ev_app_patcher.stop()
+        self.app_patcher.stop()
+
+    def test_add_units(self):
+        "Missing units are added where they were placed"
+        service = MagicMock(service_name='au-mysql')
+        with test_loop() as loop:
+            loop.run_until_complete(juju.add_units(
+                service, ['lxd:4', None, '5', None], msg_cb=MagicMock()))
+        assert self.app_inst.add_unit.call_args_list == [
+            call(count=2), call(to='lxd:4'), call(to='5')]
+        assert events.AppDeployed.is_set('au-mysql')
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# tests maas.py
+#
+# Copyright Canonical, Ltd.
+
+
+import random
+import unittest
+from concurrent.futures import Future
+from unittest.mock import MagicMock, patch
+
+from conjureup.maas import (
+    MaasAPIError,
+    MaasClient,
+    MaasMachine,
+    MaasMachineStatus,
+    MachineMatcher,
+    satisfies
+)
+
+from .helpers import test_loop
+
+
+def response(status_code, body=None, headers=None):
+    r = MagicMock()
+    r.status_code = status_code
+    r.ok = status_code < 400
+    r.json.return_value = body
+    r.headers = headers or {}
+    r.text = str(body)
+    return r
+
+
+def machine(system_id, **fields):
+    return dict({'system_id': system_id, 'hostname': system_id}, **fields)
+
+
+class MaasResourceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MaasClient('http://maas', 'consumer', 'key', 'secret')
+        self.client.session = MagicMock()
+        self.resource = self.client.resource('machines')
+
+    def test_diff(self):
+        "maas.MaasResource reports added, changed and removed machines"
+        self.client.session.get.return_value = response(
+            200, [machine('a'), machine('b'), machine('c')])
+        assert self.resource.refresh() == (['a', 'b', 'c'], [], [])
+
+        self.client.session.get.return_value = response(
+            200, [machine('a'), machine('c', status=6), machine('d')])
+        assert self.resource.refresh() == (['d'], ['c'], ['b'])
+        assert list(self.resource.items) == ['a', 'c', 'd']
+
+    def test_conditional(self):
+        "maas.MaasResource sends the last ETag and skips unchanged data"
+        listener = MagicMock()
+        self.resource.listeners.append(listener)
+        self.client.session.get.return_value = response(
+            200, [machine('a')], {'ETag': '"v1"'})
+        self.resource.refresh()
+        assert listener.call_count == 1
+
+        self.client.session.get.return_value = response(304)
+        assert self.resource.refresh() == ([], [], [])
+        headers = self.client.session.get.call_args[1]['headers']
+        assert headers['If-None-Match'] == '"v1"'
+        assert listener.call_count == 1
+        assert list(self.resource.items) == ['a']
+
+    def test_error(self):
+        "maas.MaasResource raises on API errors"
+        self.client.session.get.return_value = response(500, 'broken')
+        with self.assertRaises(MaasAPIError):
+            self.resource.refresh()
+
+    def test_machines_reused(self):
+        "maas.MaasClient only rebuilds machines that changed"
+        self.resource.update([machine('a'), machine('b')])
+        first = {m.system_id: m for m in self.client.get_machines()}
+        self.resource.update([machine('a'), machine('b', status=6)])
+        second = {m.system_id: m for m in self.client.get_machines()}
+        assert first['a'] is second['a']
+        assert first['b'] is not second['b']
+        assert second['b'].machine['status'] == 6
+        self.client.stop_polling('machines')
+
+
+class MaasPollingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MaasClient('http://maas', 'consumer', 'key', 'secret')
+        self.client.session = MagicMock()
+        self.client.session.get.return_value = response(
+            200, [machine('a')])
+
+    def tearDown(self):
+        self.client.stop_polling('machines')
+
+    def test_single_poller(self):
+        "maas.MaasClient starts one poller per collection"
+        with patch('conjureup.maas.call_every') as call_every, \
+                patch('conjureup.maas.submit') as submit:
+            assert self.client.get_cached('machines') is None
+            self.client.get_cached('machines')
+            self.client.get_machines()
+        assert call_every.call_count == 1
+        assert submit.call_count == 1
+
+    def test_arefresh(self):
+        "maas.MaasClient.arefresh refreshes from asyncio code"
+        with test_loop() as loop:
+            diff = loop.run_until_complete(self.client.arefresh('machines'))
+        assert diff == (['a'], [], [])
+        assert self.client.get_cached('machines') == [machine('a')]
+
+
+class MaasMachineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.machine = MaasMachine(machine('a', status=4, cpu_count=4,
+                                           memory=8192, storage=20480,
+                                           architecture='amd64/generic',
+                                           tag_names=['ssd']))
+
+    def test_fields(self):
+        "maas.MaasMachine parses hardware fields once, in gigabytes"
+        assert self.machine.status == MaasMachineStatus.READY
+        assert self.machine.cpu_cores == 4
+        assert self.machine.mem_gb == 8
+        assert self.machine.storage_gb == 20
+        assert self.machine.mem == "8.0 G"
+        assert self.machine.storage == "20.0 G"
+        assert 'hostname:a' in self.machine.filter_label()
+        assert not hasattr(self.machine, '__dict__')
+
+    def test_satisfies(self):
+        "maas.satisfies compares juju constraints in juju units"
+        assert satisfies(self.machine, {'mem': 4096, 'root-disk': '16G',
+                                        'cores': 4, 'arch': 'amd64',
+                                        'tags': ['ssd']}) == (True, [])
+        assert satisfies(self.machine, {'mem': '16G', 'root-disk': 40960,
+                                        'cores': 8, 'spaces': 'db'}) == (
+            False, ['mem', 'root-disk', 'cores'])
+
+    def test_wildcard(self):
+        "maas.satisfies matches any constraint for '*' values"
+        wildcard = MaasMachine(machine('b', cpu_count='*', memory='*',
+                                       storage='*', architecture='*'))
+        assert wildcard.mem == "N/A"
+        assert satisfies(wildcard, {'mem': '64G', 'root-disk': '1T',
+                                    'cores': 64, 'arch': 'arm64'}) == (
+            True, [])
+
+
+class MachineMatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(42)
+        self.machines = []
+        for i in range(200):
+            self.machines.append(MaasMachine(machine(
+                'm{}'.format(i),
+                cpu_count=rand.choice([1, 2, 4, 8, '*']),
+                memory=rand.choice([512, 2048, 4096, 16384, '*']),
+                storage=rand.choice([8192, 20480, 102400, '*', None]),
+                architecture=rand.choice(['amd64/generic', 'amd64',
+                                          'arm64/xgene', '*']),
+                tag_names=rand.choice([[], ['ssd'], ['ssd', 'gpu'],
+                                       ['gpu', 'ssd']]))))
+        self.matcher = MachineMatcher(self.machines)
+
+    def test_same_as_satisfies(self):
+        "maas.MachineMatcher agrees with satisfies for every machine"
+        for constraints in [{}, None,
+                            {'mem': 2048},
+                            {'mem': '4G', 'root-disk': 20480},
+                            {'cores': 4, 'arch': 'amd64'},
+                            {'arch': 'arm64/xgene', 'tags': ['gpu', 'ssd']},
+                            {'storage': '100G', 'cpu-cores': '2',
+                             'spaces': ['db']}]:
+            result = self.matcher.match(constraints)
+            expected = [i for i, m in enumerate(self.machines)
+                        if satisfies(m, constraints)[0]]
+            assert result.indices == expected, constraints
+            for i, m in enumerate(self.machines):
+                assert result.failures(i) == satisfies(m, constraints)[1]
+
+    def test_machines(self):
+        "maas.MachineMatcher returns the matching machines in order"
+        result = self.matcher.match({'cores': 8, 'mem': 16384})
+        assert result.machines() == [self.machines[i]
+                                     for i in result.indices]
+        assert all(m.cpu_cores == 8 or m.machine['cpu_count'] == '*'
+                   for m in result.machines())
+        assert len(MachineMatcher([]).match({'cores': 1})) == 0
+
+
+class MaasTaggingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MaasClient('http://maas', 'consumer', 'key', 'secret')
+        self.client.session = MagicMock()
+        self.client.session.get.return_value = response(
+            200, [{'name': 'b'}])
+        self.client.session.post.return_value = response(200)
+
+    def posts(self, op=None):
+        return sorted(c[2]['url'] for c in self.client.session.post.mock_calls
+                      if c[2]['data'].get('op') == op)
+
+    def test_assign_id_tags(self):
+        "maas.MaasClient.assign_id_tags reads tags once and skips tagged"
+        nodes = [MaasMachine(machine(system_id, tag_names=tag_names))
+                 for system_id, tag_names in [('a', []), ('b', []),
+                                              ('c', ['c'])]]
+        results = self.client.assign_id_tags(nodes)
+        assert results == {'a': True, 'b': True, 'c': True}
+        assert self.client.session.get.call_count == 1
+        assert self.posts() == ['http://maas/api/2.0/tags/']
+        assert self.posts('update_nodes') == ['http://maas/api/2.0/tags/a/',
+                                              'http://maas/api/2.0/tags/b/']
+
+    def test_batches(self):
+        "maas.MaasClient.bulk_tag tags machines in batches per tag"
+        self.client.TAG_BATCH_SIZE = 2
+        self.client.session.post.side_effect = lambda url, data: response(
+            500 if 'd' in data.get('add', []) else 200)
+        results = self.client.bulk_tag({'b': ['a', 'b', 'c', 'd', 'e']})
+        assert results == {'a': True, 'b': True, 'c': False, 'd': False,
+                           'e': True}
+        assert len(self.posts('update_nodes')) == 3
+        assert self.posts() == []
+
+    def test_cancelled(self):
+        "maas.MaasClient.bulk_tag reports cancelled tag jobs as untagged"
+        cancelled = Future()
+        cancelled.cancel()
+        with patch('conjureup.maas.submit', return_value=cancelled), \
+                patch('conjureup.maas.app'):
+            results = self.client.bulk_tag({'b': ['a', 'b']})
+        assert results == {'a': False, 'b': False}
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# tests machine_filter.py
+#
+# Copyright Canonical, Ltd.
+
+
+import unittest
+
+from conjureup.maas import MaasMachine
+from conjureup.machine_filter import (
+    FilterError,
+    MachineIndex,
+    compile_filter,
+    juju_machine_fields,
+    maas_machine_fields
+)
+
+
+def maas_machine(hostname, cores=4, memory=8192, storage=102400, status=4,
+                 zone='default', tag_names=()):
+    return MaasMachine({'system_id': hostname,
+                        'hostname': hostname,
+                        'status': status,
+                        'cpu_count': cores,
+                        'memory': memory,
+                        'storage': storage,
+                        'architecture': 'amd64/generic',
+                        'tag_names': list(tag_names),
+                        'zone': {'name': zone}})
+
+
+class MachineFilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = MachineIndex()
+        for m in [maas_machine('compute-1', cores=16, memory=65536,
+                               zone='az1', tag_names=['ssd']),
+                  maas_machine('compute-2', cores=8, memory=32768,
+                               zone='az2', tag_names=['ssd', 'gpu']),
+                  maas_machine('storage-1', cores=4, storage=4194304,
+                               zone='az1', status=6),
+                  maas_machine('db', cores='*', memory='*')]:
+            self.index.add(m.hostname, maas_machine_fields(m))
+
+    def match(self, text):
+        matches = compile_filter(text).match(self.index)
+        return None if matches is None else sorted(matches)
+
+    def test_numbers(self):
+        "machine_filter compares numbers and sizes"
+        assert self.match('cores>=8') == ['compute-1', 'compute-2']
+        assert self.match('cores>8') == ['compute-1']
+        assert self.match('cores:4') == ['storage-1']
+        assert self.match('mem>=64G') == ['compute-1']
+        assert self.match('mem<16384m') == ['storage-1']
+        assert self.match('storage>=4T') == ['storage-1']
+
+    def test_keywords(self):
+        "machine_filter matches tags, zones, status and architecture"
+        assert self.match('zone:az1') == ['compute-1', 'storage-1']
+        assert self.match('tag:ssd zone:az1') == ['compute-1']
+        assert self.match('status:ready') == ['compute-1', 'compute-2', 'db']
+        assert self.match('status~deploy') == ['storage-1']
+        assert self.match('arch:amd64') == self.match('arch=amd64/generic')
+
+    def test_text(self):
+        "machine_filter matches host names and bare words"
+        assert self.match('host~compute') == ['compute-1', 'compute-2']
+        assert self.match('hostname:e-1') == ['compute-1', 'storage-1']
+        assert self.match('host=db') == ['db']
+        assert self.match('gpu') == ['compute-2']
+        assert self.match('') is None
+        assert self.match('nothing') == []
+
+    def test_errors(self):
+        "machine_filter rejects terms it can't evaluate"
+        for text in ['cores>=many', 'cores>=4G', 'mem~4', 'zone>1', 'tag:']:
+            with self.assertRaises(FilterError):
+                compile_filter(text)
+
+    def test_update(self):
+        "machine_filter.MachineIndex replaces and removes machines"
+        m = maas_machine('compute-1', cores=2, zone='az3')
+        self.index.add('compute-1', maas_machine_fields(m))
+        assert self.match('cores>=8') == ['compute-2']
+        assert self.match('zone:az3') == ['compute-1']
+        self.index.remove('compute-1')
+        self.index.remove('compute-1')
+        assert self.match('compute') == ['compute-2']
+        assert len(self.index) == 3
+
+    def test_juju_machines(self):
+        "machine_filter indexes bundle machines by their constraints"
+        index = MachineIndex()
+        index.add('0', juju_machine_fields('0', {
+            'series': 'xenial', 'constraints': 'mem=4G cores=2 tags=ssd'}))
+        index.add('1', juju_machine_fields('1', {
+            'series': 'bionic', 'constraints': 'root-disk=102400 mem='}))
+        assert compile_filter('mem>=4').match(index) == {'0'}
+        assert compile_filter('storage>=100').match(index) == {'1'}
+        assert compile_filter('xenial').match(index) == {'0'}
+        assert compile_filter('tag:ssd id:0').match(index) == {'0'}
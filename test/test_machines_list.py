@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+# tests ui/widgets/machines_list.py
+#
+# Copyright Canonical, Ltd.
+
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+from conjureup.maas import MaasMachine, MachineMatcher
+from conjureup.ui.widgets.machine_widget import MachineWidget
+from conjureup.ui.widgets.machines_list import MachinesList
+
+
+def maas_machine(system_id, hostname, status=4, **fields):
+    return MaasMachine(dict({'system_id': system_id,
+                             'hostname': hostname,
+                             'resource_uri': '/machines/' + system_id,
+                             'status': status,
+                             'cpu_count': 4,
+                             'memory': 4096,
+                             'storage': 10240,
+                             'architecture': 'amd64/generic',
+                             'tag_names': []}, **fields))
+
+
+class MachinesListTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.machines = []
+        client = MagicMock()
+        client.get_machines.side_effect = lambda: list(self.machines)
+        client.get_machine.side_effect = lambda system_id: next(
+            (m for m in self.machines if m.system_id == system_id), None)
+        for module in ('machines_list', 'machine_widget'):
+            patcher = patch('conjureup.ui.widgets.{}.app'.format(module))
+            mock_app = patcher.start()
+            mock_app.maas.client = client
+            self.addCleanup(patcher.stop)
+
+        self.machines = [maas_machine('c', 'charlie'),
+                         maas_machine('a', 'alpha'),
+                         maas_machine('b', 'bravo', status=6)]
+        self.mlist = MachinesList(MagicMock(), MagicMock(), 'app',
+                                  MagicMock(return_value=None))
+
+    def shown(self):
+        rows = [w.machine.hostname for w, _ in self.mlist.machine_pile.contents
+                if isinstance(w, MachineWidget)]
+        assert rows == [mw.machine.hostname
+                        for mw in self.mlist.machine_widgets]
+        return rows
+
+    def test_sorted(self):
+        "machines_list.MachinesList shows ready machines first, by name"
+        assert self.shown() == ['alpha', 'charlie', 'bravo']
+
+    def test_added_removed(self):
+        "machines_list.MachinesList inserts and removes in sorted order"
+        self.machines = [m for m in self.machines if m.system_id != 'a']
+        self.machines.append(maas_machine('d', 'delta'))
+        self.mlist.update()
+        assert self.shown() == ['charlie', 'delta', 'bravo']
+
+    def test_changed_only(self):
+        "machines_list.MachinesList only checks machines that changed"
+        self.machines[0] = maas_machine('c', 'charlie', status=6)
+        with patch('conjureup.ui.widgets.machines_list.MachineMatcher',
+                   wraps=MachineMatcher) as matcher:
+            self.mlist.update()
+        assert matcher.call_count == 1
+        assert matcher.call_args[0][0] == [self.machines[0]]
+        assert self.shown() == ['alpha', 'bravo', 'charlie']
+
+    def test_filter(self):
+        "machines_list.MachinesList applies the filter and constraints"
+        self.mlist.handle_filter_change(None, 'hostname:b')
+        assert self.shown() == ['bravo']
+        self.mlist.handle_filter_change(None, '')
+        assert self.shown() == ['alpha', 'charlie', 'bravo']
+
+        self.mlist.show_only_ready = True
+        self.mlist._seen.clear()
+        self.mlist.update()
+        assert self.shown() == ['alpha', 'charlie']
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# tests placement.py
+#
+# Copyright Canonical, Ltd.
+
+
+import unittest
+from collections import Counter
+
+from conjureup.maas import MaasMachine
+from conjureup.placement import place, zone_name
+
+
+def node(i, zone='default', cores=4, memory=8192, storage=102400,
+         status=4):
+    return MaasMachine({'system_id': 'n{}'.format(i),
+                        'hostname': 'node-{}'.format(i),
+                        'resource_uri': '/MAAS/api/2.0/machines/n{}/'.format(i),
+                        'status': status,
+                        'cpu_count': cores,
+                        'memory': memory,
+                        'storage': storage,
+                        'architecture': 'amd64/generic',
+                        'tag_names': [],
+                        'zone': {'name': zone}})
+
+
+class PlaceTestCase(unittest.TestCase):
+
+    def test_best_fit(self):
+        "placement.place uses the smallest ready machine that fits"
+        nodes = [node(0, cores=32, memory=131072),
+                 node(1, cores=8, memory=16384),
+                 node(2, cores=8, memory=16384, status=6),
+                 node(3, cores=2, memory=4096)]
+        pins, unplaced = place({'0': {'cores': 8}, '1': {}}, nodes)
+        assert pins['0'].hostname == 'node-1'
+        assert pins['1'].hostname == 'node-3'
+        assert unplaced == []
+
+    def test_unplaced(self):
+        "placement.place reports machines nothing matches"
+        pins, unplaced = place({'0': {'mem': 65536}, '1': {}}, [node(0)])
+        assert list(pins) == ['1']
+        assert unplaced == ['0']
+
+    def test_pinned(self):
+        "placement.place skips pinned machines and their MAAS machines"
+        nodes = [node(0), node(1)]
+        pins, unplaced = place({'0': {}, '1': {}}, nodes,
+                               pinned={'0': nodes[0]})
+        assert list(pins) == ['1']
+        assert pins['1'] is nodes[1]
+
+    def test_spread_zones(self):
+        "placement.place spreads each group across zones"
+        nodes = [node(i, zone='zone{}'.format(i % 3)) for i in range(12)]
+        juju_machines = {str(i): {} for i in range(6)}
+        groups = {str(i): 'app{}'.format(i % 2) for i in range(6)}
+        pins, unplaced = place(juju_machines, nodes, groups=groups)
+        for group in ('app0', 'app1'):
+            zones = Counter(zone_name(m) for j_id, m in pins.items()
+                            if groups[j_id] == group)
+            assert sorted(zones.values()) == [1, 1, 1]
+
+    def test_exact(self):
+        "placement.place moves earlier choices to place every machine"
+        # the smallest machine for '1' is the only one left for '2'
+        nodes = [node(0, cores=8, memory=4096),
+                 node(1, cores=4, memory=8192),
+                 node(2, cores=2, memory=16384)]
+        juju_machines = {'0': {'mem': 16384}, '1': {'cores': 4},
+                         '2': {'mem': 8192}}
+        pins, unplaced = place(juju_machines, nodes, exact=False)
+        assert unplaced == ['2']
+
+        pins, unplaced = place(juju_machines, nodes)
+        assert unplaced == []
+        assert [pins[j_id].hostname for j_id in ('0', '1', '2')] == [
+            'node-2', 'node-0', 'node-1']
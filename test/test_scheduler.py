@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# tests scheduler.py
+#
+# Copyright Canonical, Ltd.
+
+
+import asyncio
+import unittest
+
+from conjureup.scheduler import Scheduler, SchedulerError
+
+from .helpers import test_loop
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.started = []
+
+    def node(self, name, result=None):
+        async def run():
+            self.started.append(name)
+            await asyncio.sleep(0)
+            return result
+        return run
+
+    def test_dependencies(self):
+        "Nodes start after their dependencies finish"
+        scheduler = Scheduler()
+        scheduler.add('relation', self.node('relation'), deps=['a', 'b'])
+        scheduler.add('a', self.node('a', 1), deps=['machines'])
+        scheduler.add('b', self.node('b', 2))
+        scheduler.add('machines', self.node('machines'))
+        with test_loop() as loop:
+            results = loop.run_until_complete(scheduler.run())
+        assert self.started.index('relation') == 3
+        assert self.started.index('a') > self.started.index('machines')
+        assert results['a'] == 1 and results['b'] == 2
+        for started, finished in scheduler.timings().values():
+            assert started <= finished
+
+    def test_critical_path_first(self):
+        "Ready nodes with the longest chain behind them start first"
+        scheduler = Scheduler(concurrency=1)
+        scheduler.add('short', self.node('short'))
+        scheduler.add('long', self.node('long'))
+        scheduler.add('long-2', self.node('long-2'), deps=['long'])
+        scheduler.add('cheap', self.node('cheap'), cost=0.5)
+        with test_loop() as loop:
+            loop.run_until_complete(scheduler.run())
+        assert self.started == ['long', 'short', 'long-2', 'cheap']
+
+    def test_concurrency(self):
+        "No more than concurrency nodes run at once"
+        running = []
+        peak = []
+
+        async def run():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0)
+            running.pop()
+
+        scheduler = Scheduler(concurrency=2)
+        for i in range(5):
+            scheduler.add(str(i), run)
+        with test_loop() as loop:
+            loop.run_until_complete(scheduler.run())
+        assert max(peak) == 2
+
+    def test_failure(self):
+        "A failing node stops the run and cancels the others"
+        async def fail():
+            raise ValueError('boom')
+
+        async def slow():
+            await asyncio.sleep(10)
+
+        scheduler = Scheduler()
+        scheduler.add('slow', slow)
+        scheduler.add('fail', fail)
+        scheduler.add('after', self.node('after'), deps=['fail'])
+        with test_loop() as loop:
+            with self.assertRaises(ValueError):
+                loop.run_until_complete(scheduler.run())
+            loop.run_until_complete(asyncio.sleep(0))
+        assert scheduler.nodes['slow'].finished is None
+        assert 'after' not in self.started
+
+    def test_invalid_graph(self):
+        "Cycles and unknown dependencies are rejected"
+        scheduler = Scheduler()
+        scheduler.add('a', self.node('a'), deps=['b'])
+        scheduler.add('b', self.node('b'), deps=['a'])
+        with test_loop() as loop:
+            with self.assertRaises(SchedulerError):
+                loop.run_until_complete(scheduler.run())
+        scheduler = Scheduler()
+        scheduler.add('a', self.node('a'), deps=['missing'])
+        with test_loop() as loop:
+            with self.assertRaises(SchedulerError):
+                loop.run_until_complete(scheduler.run())
+        with self.assertRaises(SchedulerError):
+            scheduler.add('a', self.node('a'))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# tests spells_index.py
+#
+# Copyright Canonical, Ltd.
+
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import yaml
+
+from conjureup import spells_index
+
+
+class SpellsIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.spells_dir = tempfile.TemporaryDirectory()
+        self.write_index({
+            'kubernetes': {'spells': [
+                {'key': 'kubernetes-core', 'name': 'Kubernetes Core',
+                 'description': 'A minimal kubernetes cluster'},
+                {'key': 'canonical-kubernetes', 'name': 'Canonical K8s',
+                 'description': 'The canonical distribution of kubernetes'},
+            ]},
+            '_unassigned_spells': {'spells': [
+                {'key': 'hadoop-spark', 'name': 'Hadoop Spark',
+                 'description': 'Big data'},
+            ]},
+            'openstack': {'spells': [
+                {'key': 'openstack-novalxd', 'name': 'OpenStack nova-lxd',
+                 'description': 'OpenStack with LXD containers'},
+            ]},
+        })
+        self.write_metadata('openstack-novalxd',
+                            {'cloud-whitelist': ['localhost']})
+        self.app_patcher = patch('conjureup.spells_index.app')
+        self.app_patcher.start()
+        self.darwin_patcher = patch('conjureup.spells_index.is_darwin',
+                                    return_value=False)
+        self.mock_darwin = self.darwin_patcher.start()
+
+    def tearDown(self):
+        self.darwin_patcher.stop()
+        self.app_patcher.stop()
+        self.spells_dir.cleanup()
+
+    def write_index(self, index):
+        path = os.path.join(self.spells_dir.name, 'spells-index.yaml')
+        with open(path, 'w') as f:
+            yaml.safe_dump(index, f)
+
+    def write_metadata(self, key, metadata):
+        os.makedirs(os.path.join(self.spells_dir.name, key))
+        path = os.path.join(self.spells_dir.name, key, 'metadata.yaml')
+        with open(path, 'w') as f:
+            yaml.safe_dump(metadata, f)
+
+    def keys(self, results):
+        return [spell['key'] for category, spell in results]
+
+    def test_find(self):
+        "Spells are found by category, key and keyword, in picker order"
+        index = spells_index.load(self.spells_dir.name)
+        assert self.keys(index.find_all()) == [
+            'canonical-kubernetes', 'kubernetes-core', 'openstack-novalxd',
+            'hadoop-spark']
+        assert self.keys(index.find_matching('kubernetes')) == [
+            'canonical-kubernetes', 'kubernetes-core']
+        assert index.find_matching('hadoop-spark') == [
+            ('_unassigned_spells', {'key': 'hadoop-spark',
+                                    'name': 'Hadoop Spark',
+                                    'description': 'Big data'})]
+        assert self.keys(index.find_matching('minimal kubernetes')) == [
+            'kubernetes-core']
+        assert index.find_matching('nothing') == []
+
+    def test_find_exact(self):
+        "Only categories and spell keys are exact matches"
+        index = spells_index.load(self.spells_dir.name)
+        assert self.keys(index.find_exact('openstack')) == [
+            'openstack-novalxd']
+        assert self.keys(index.find_exact('kubernetes-core')) == [
+            'kubernetes-core']
+        assert index.find_exact('minimal') == []
+        assert self.keys(index.find_matching('minimal')) == [
+            'kubernetes-core']
+
+    def test_darwin(self):
+        "Localhost only spells are left out on macOS"
+        self.mock_darwin.return_value = True
+        index = spells_index.load(self.spells_dir.name)
+        assert 'openstack-novalxd' not in self.keys(index.find_all())
+
+    def test_compiled(self):
+        "The compiled index is reused until the registry changes"
+        spells_index.load(self.spells_dir.name)
+        with patch('conjureup.spells_index.yaml') as mock_yaml:
+            spells_index.load(self.spells_dir.name)
+        assert not mock_yaml.safe_load.called
+
+        self.write_index({'other': {'spells': [{'key': 'new',
+                                                'name': 'New'}]}})
+        index = spells_index.load(self.spells_dir.name)
+        assert self.keys(index.find_all()) == ['new']
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+#
+# tests start up import time
+#
+# Copyright Canonical, Ltd.
+
+
+import os
+import subprocess
+import sys
+import unittest
+
+TOOL = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    'tools', 'importtime.py')
+# generous by default so slow CI machines don't flake, tighten locally
+BUDGET = os.environ.get('CONJUREUP_IMPORT_BUDGET', '3.0')
+
+
+class StartupImportTestCase(unittest.TestCase):
+
+    def test_import_budget(self):
+        "The entry point imports within budget and loads heavy deps lazily"
+        proc = subprocess.run([sys.executable, TOOL, '--budget', BUDGET],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+        output = proc.stdout.decode('utf8')
+        assert proc.returncode == 0, output
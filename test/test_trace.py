@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# tests trace.py
+#
+# Copyright Canonical, Ltd.
+
+
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from conjureup import events, trace
+
+from .helpers import test_loop
+
+
+@trace.traced('test', name=lambda name: 'work {}'.format(name))
+async def work(name):
+    await asyncio.sleep(0.01)
+    return name
+
+
+@trace.traced('test')
+def blocking():
+    return 'done'
+
+
+class TraceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'trace.json')
+        self.patchers = [patch.object(trace, '_records', []),
+                         patch.object(trace, '_lanes', {}),
+                         patch.object(trace, '_enabled', False)]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        self.tmpdir.cleanup()
+
+    def test_disabled(self):
+        "trace records nothing until enabled"
+        assert blocking() == 'done'
+        assert trace._records == []
+        assert trace.save() is None
+
+    def test_spans(self):
+        "trace.traced records spans for functions and coroutines"
+        trace.enable(self.path)
+        assert blocking() == 'done'
+        with test_loop() as loop:
+            results = loop.run_until_complete(
+                asyncio.gather(work('a'), work('b')))
+        assert results == ['a', 'b']
+
+        spans = {record['name']: record for record in trace._records}
+        assert set(spans) == {'blocking', 'work a', 'work b'}
+        assert spans['work a']['ph'] == 'X'
+        assert spans['work a']['dur'] >= 10000
+        # concurrent tasks get their own lanes
+        assert spans['work a']['tid'] != spans['work b']['tid']
+
+    def test_span_error(self):
+        "trace.span records the error raised in the block"
+        trace.enable(self.path)
+        with self.assertRaises(ValueError):
+            with trace.span('test', 'failing'):
+                raise ValueError('failed')
+        assert 'ValueError' in trace._records[0]['args']['error']
+
+    def test_events(self):
+        "trace records event transitions and waits"
+        trace.enable(self.path)
+
+        async def waiter():
+            await event.wait()
+
+        async def setter():
+            await asyncio.sleep(0.01)
+            event.set()
+
+        with test_loop() as loop:
+            event = events.Event('Traced')
+            loop.run_until_complete(asyncio.gather(waiter(), setter()))
+        names = [(record['ph'], record['name'])
+                 for record in trace._records]
+        assert ('i', 'set Traced') in names
+        assert ('X', 'wait Traced') in names
+
+    def test_save(self):
+        "trace.save writes a Chrome trace file"
+        trace.enable(self.path)
+        blocking()
+        assert trace.save() == self.path
+        with open(self.path) as f:
+            data = json.load(f)
+        phases = [event['ph'] for event in data['traceEvents']]
+        assert phases == ['M', 'X']
+        assert data['traceEvents'][1]['pid'] == os.getpid()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+# importtime - Cold start import benchmark for conjure-up
+#
+# Imports the conjure-up entry point in a fresh interpreter and fails if
+# it takes longer than the budget, or if it pulls in modules that should
+# only be loaded lazily. On Python 3.7+ the slowest imports are reported
+# from `python -X importtime`.
+#
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ENTRY_POINT = 'conjureup.app'
+
+# Only needed for the UI, vSphere, error reporting or a connected model
+LAZY_MODULES = [
+    'conjureup.models.provider',
+    'conjureup.ui',
+    'conjureup.vsphere',
+    'juju.model',
+    'prettytable',
+    'pyVmomi',
+    'raven',
+    'ubuntui.ev',
+]
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'elapsed': time.perf_counter() - start,
+                  'modules': sorted(sys.modules)}}))
+"""
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module=ENTRY_POINT, python=sys.executable):
+    """ Imports module in a new interpreter
+
+    Returns:
+    tuple of seconds taken, modules loaded and, if the interpreter
+    supports -X importtime, a list of (cumulative us, module) tuples
+    """
+    cmd = [python]
+    importtime = sys.version_info >= (3, 7)
+    if importtime:
+        cmd += ['-X', 'importtime']
+    cmd += ['-c', CHILD.format(module=module)]
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          cwd=TOPDIR, env=env, check=True)
+    result = json.loads(proc.stdout.decode('utf8').splitlines()[-1])
+
+    timings = []
+    if importtime:
+        for line in proc.stderr.decode('utf8').splitlines():
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            fields = line[len('import time:'):].split('|')
+            try:
+                timings.append((int(fields[1]), fields[2].strip()))
+            except ValueError:
+                continue  # header
+        timings.sort(reverse=True)
+    return result['elapsed'], result['modules'], timings
+
+
+def check(budget, runs=3, lazy_modules=LAZY_MODULES, top=10, out=sys.stdout):
+    """ Runs the benchmark
+
+    Arguments:
+    budget: maximum seconds the best run may take
+    runs: number of cold starts to take the best of
+    lazy_modules: modules that must not be imported at start up
+
+    Returns:
+    list of problems found, empty if within budget
+    """
+    best = None
+    for i in range(runs):
+        elapsed, modules, timings = measure()
+        if best is None or elapsed < best[0]:
+            best = (elapsed, modules, timings)
+    elapsed, modules, timings = best
+
+    out.write('Importing {} took {:.3f}s (budget {:.3f}s)\n'.format(
+        ENTRY_POINT, elapsed, budget))
+    for us, name in timings[:top]:
+        out.write('  {:8.1f}ms  {}\n'.format(us / 1000, name))
+
+    problems = []
+    if elapsed > budget:
+        problems.append('import took {:.3f}s, over the {:.3f}s budget'.format(
+            elapsed, budget))
+    for name in lazy_modules:
+        if name in modules:
+            problems.append('{} is imported at start up'.format(name))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Cold start import benchmark for conjure-up')
+    parser.add_argument('--budget', type=float, default=1.0,
+                        help='Maximum seconds the import may take')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Number of cold starts to take the best of')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Number of slowest imports to show')
+    opts = parser.parse_args()
+
+    problems = check(opts.budget, opts.runs, top=opts.top)
+    for problem in problems:
+        print('FAIL: {}'.format(problem))
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
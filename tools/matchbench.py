@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#
+# matchbench - Constraint matching benchmark for conjure-up
+#
+# Builds synthetic MAAS fleets and times matching a set of constraints
+# one machine at a time with satisfies() against MachineMatcher.
+#
+#   PYTHONPATH=. tools/matchbench.py 10000 100000
+#
+
+import argparse
+import random
+import sys
+import time
+
+from conjureup.maas import MaasMachine, MachineMatcher, satisfies
+
+CONSTRAINTS = [
+    {'mem': 4096},
+    {'mem': '8G', 'root-disk': 40960, 'cores': 4},
+    {'arch': 'amd64', 'tags': ['ssd']},
+    {'cores': 16, 'mem': '64G', 'arch': 'arm64/generic'},
+]
+
+
+def fleet(size, seed=0):
+    """ Returns size synthetic machines
+    """
+    rand = random.Random(seed)
+    machines = []
+    for i in range(size):
+        machines.append(MaasMachine({
+            'system_id': 'node-{}'.format(i),
+            'hostname': 'node-{}'.format(i),
+            'resource_uri': '/MAAS/api/2.0/machines/node-{}/'.format(i),
+            'status': rand.choice([4, 4, 4, 6, 10]),
+            'cpu_count': rand.choice([2, 4, 8, 16, 32, '*']),
+            'memory': rand.choice([2048, 4096, 8192, 32768, 65536, '*']),
+            'storage': rand.randint(10, 2000) * 1024,
+            'architecture': rand.choice(['amd64/generic', 'arm64/generic',
+                                         'ppc64el/generic', '*']),
+            'tag_names': rand.choice([[], ['ssd'], ['ssd', 'gpu']]),
+        }))
+    return machines
+
+
+def best_of(runs, func):
+    best = None
+    for i in range(runs):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def run(size, runs=3, out=sys.stdout):
+    """ Runs the benchmark for a fleet of size machines
+
+    Returns:
+    list of problems found, empty if both agree
+    """
+    machines = fleet(size)
+    out.write('{} machines\n'.format(size))
+    build, matcher = best_of(runs, lambda: MachineMatcher(machines))
+    out.write('  {:>8.1f}ms  build MachineMatcher\n'.format(build * 1000))
+
+    problems = []
+    for constraints in CONSTRAINTS:
+        loop, expected = best_of(runs, lambda: [
+            i for i, m in enumerate(machines)
+            if satisfies(m, constraints)[0]])
+        match, result = best_of(runs, lambda: matcher.match(constraints))
+        out.write('  {:>8.1f}ms  {:>8.1f}ms  {:>5.1f}x  {} matched  '
+                  '{}\n'.format(loop * 1000, match * 1000, loop / match,
+                                len(result), constraints))
+        if result.indices != expected:
+            problems.append('{} machines, {}: results differ'.format(
+                size, constraints))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Constraint matching benchmark for conjure-up')
+    parser.add_argument('sizes', type=int, nargs='*',
+                        default=[10000, 100000],
+                        help='Fleet sizes to benchmark')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Number of runs to take the best of')
+    opts = parser.parse_args()
+
+    print('  satisfies   matcher  speedup')
+    problems = []
+    for size in opts.sizes:
+        problems += run(size, opts.runs)
+    for problem in problems:
+        print('FAIL: {}'.format(problem))
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()